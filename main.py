@@ -7,6 +7,9 @@ import torch
 from torch import cuda
 
 from src.utils import *
+from src.precision import PRECISIONS
+from src.negatives import NEG_SAMPLERS
+from src.telemetry import TELEMETRY
 import src.classifier
 import src.train
 import src.embeddings
@@ -20,8 +23,19 @@ def main():
     parser.add_argument('--method', required=True, help='Name of the method')
     parser.add_argument('--dataset', required=False, help='Name of the dataset')
     parser.add_argument('--query', default=None, help='A SPARQL query')
+    parser.add_argument('--endpoint', default=SPARQL_ENDPOINT, help='URL of the SPARQL endpoint')
+    parser.add_argument('--page_size', required=False, default=None, type=int, help='Split each keyword query in LIMIT/OFFSET pages of this size, \
+                            fetched concurrently. Disabled by default.')
+    parser.add_argument('--query_workers', required=False, default=4, type=int, help='Number of pages fetched concurrently when --page_size is set')
+    parser.add_argument('--max_retries', required=False, default=5, type=int, help='Number of attempts per SPARQL request before giving up')
+    parser.add_argument('--ntriples', action='store_true', help='Request query results as N-Triples and parse them while they are received')
+    parser.add_argument('--cache_dir', required=False, default='data/cache', type=str, help='Directory of the per-keyword query result cache')
+    parser.add_argument('--cache_ttl', required=False, default=None, type=float, help='Lifetime of cached keyword results in hours. Never expire by default.')
+    parser.add_argument('--no_cache', action='store_true', help='Re-query every keyword without reading or writing the cache')
 
     parser.add_argument('--normalize_parameters', action='store_true', help='Whether to normalize entity embeddings. Recommended.')
+    parser.add_argument('--telemetry_dir', required=False, default=None, type=str, help='Write per-stage and per-epoch metrics (timings, triples/s, \
+                            peak RSS) of the run to this directory, as JSON lines and as a Prometheus textfile')
     parser.add_argument('--train_classifier', nargs='*', help='Train a classifier on the embeddings. \
                             Add nargs to specify the model type(s) to train. See Pycaret docs for the full list of supported models.')
 
@@ -31,13 +45,69 @@ def main():
     # TorchKGE arguments
     parser.add_argument('--n_epochs', required=False, default=20, type=int, help='Number of epochs')
     parser.add_argument('--batch_size', required=False, default=128, type=int, help='Batch size')
+    parser.add_argument('--prefetch_workers', required=False, default=1, type=int, help='Number of threads producing batches and negative samples \
+                            ahead of the training loop. 0 produces them synchronously.')
+    parser.add_argument('--prefetch_depth', required=False, default=4, type=int, help='Maximum number of batches produced ahead of the training loop')
+    parser.add_argument('--workers', required=False, default=1, type=int, help='Number of CPU processes training the model in parallel (Hogwild), \
+                            each on its own shard of the training triples. 1 trains in the main process.')
+    parser.add_argument('--checkpoint_every', required=False, default=0, type=int, help='Save a checkpoint of the model, optimizer and RNG states \
+                            every N epochs. Disabled by default.')
+    parser.add_argument('--checkpoint_dir', required=False, default='models/checkpoints', type=str, help='Directory of the training checkpoints')
+    parser.add_argument('--resume', required=False, default=None, type=str, help='Resume training from a checkpoint (.ckpt)')
+    parser.add_argument('--patience', required=False, default=None, type=int, help='Stop training when the validation loss has not improved for N epochs \
+                            and keep the weights of the best epoch. Disabled by default.')
+    parser.add_argument('--memory_budget', required=False, default=None, type=float, help='Out-of-core training: entity embeddings are kept in \
+                            memory-mapped files and trained by buckets fitting in this budget (MiB), with row-wise Adagrad. Disabled by default.')
+    parser.add_argument('--partition_dir', required=False, default='models/partitions', type=str, help='Directory of the memory-mapped embedding tables')
+    parser.add_argument('--val_every', required=False, default=1, type=int, help='Compute the validation loss every N epochs, and after the last one')
+    parser.add_argument('--val_size', required=False, default=None, type=int, help='Compute the validation loss on a fixed random subsample of N \
+                            validation triples whose negatives are drawn once. All triples with fresh negatives by default.')
+    parser.add_argument('--val_background', action='store_true', help='Compute the validation loss in a background process on a snapshot of the weights, \
+                            so that training does not wait for it. Not supported with --patience.')
+    parser.add_argument('--autotune', action='store_true', help='Choose the batch size and number of threads of training and evaluation by measuring \
+                            triples/s on a few steps. Settings are stored per (method, embedding size, number of entities) and reused.')
+    parser.add_argument('--autotune_file', required=False, default='models/autotune.json', type=str, help='File of the autotuned settings')
+    parser.add_argument('--autotune_memory', required=False, default=None, type=float, help='Discard autotuned settings whose peak memory \
+                            exceeds this many MiB (resident memory on CPU, allocated memory on GPU)')
     parser.add_argument('--lr', required=False, default=0.0001, type=float, help='Learning rate')
     parser.add_argument('--weight_decay', required=False, default=0.0001, type=float, help='Weight decay')
+    parser.add_argument('--sparse', action='store_true', help='Sparse gradients and lazy row-wise Adam: only the embedding rows used by a batch are updated \
+                            and regularized. One of TransE, TorusE, DistMult, ComplEx.')
+    parser.add_argument('--precision', required=False, default='fp32', choices=PRECISIONS, help='fp32, or bf16 to run the forward pass, loss \
+                            and candidate scoring in bfloat16 while weights and optimizer states stay in fp32.')
+    parser.add_argument('--compile', action='store_true', help='Compile the training step and candidate scoring with torch.compile, \
+                            falling back to eager mode for models that do not compile. Intended for TransE, TorusE, DistMult, ComplEx, ANALOGY.')
+    parser.add_argument('--neg_sampler', required=False, default='bernoulli', choices=NEG_SAMPLERS, help='Negative sampler. bernoulli draws random entities, \
+                            adversarial draws among neg_candidates random ones by their score, cached draws from caches of hard negatives per (entity, relation).')
+    parser.add_argument('--neg_candidates', required=False, default=32, type=int, help='Candidates scored per triple (adversarial) or per pair at each refresh (cached)')
+    parser.add_argument('--neg_cache_size', required=False, default=32, type=int, help='Hard negatives cached per (entity, relation) pair')
+    parser.add_argument('--neg_temperature', required=False, default=1.0, type=float, help='Inverse temperature of the softmax over candidate scores. 0 draws uniformly.')
+    parser.add_argument('--neg_refresh', required=False, default=1, type=int, help='Refresh the hard negative caches every N epochs')
     parser.add_argument('--loss_fn', required=False, default="margin", type=str, help='loss function. ne of "margin", "bce", "logistic".')
     parser.add_argument('--ent_emb_dim', required=False, default=50, type=int, help='Size of entity embeddings')
     parser.add_argument('--eval_task', required=False, default="relation-prediction", type=str, help='Task on which to evaluate the embedding model. \
                             One of "link-prediction", "relation-prediction".')
+    parser.add_argument('--eval_memory', required=False, default=1024, type=float, help='Approximate memory (MiB) of the candidate scores \
+                            held at once by link prediction evaluation')
+    parser.add_argument('--eval_threads', required=False, default=1, type=int, help='Threads ranking batches of test triples concurrently \
+                            in link prediction evaluation')
+    parser.add_argument('--eval_mode', required=False, default="full", type=str, choices=['full', 'sampled'], help='Rank link prediction test triples against all entities \
+                            ("full") or against --eval_candidates sampled negatives ("sampled"), with bootstrap confidence intervals')
+    parser.add_argument('--eval_candidates', required=False, default=100, type=int, help='Negatives per test triple with --eval_mode sampled')
+    parser.add_argument('--eval_typed', action='store_true', help='With --eval_mode sampled, draw the negatives of a relation among the entities \
+                            seen in the same position of this relation')
+    parser.add_argument('--eval_undirected', action='store_true', help='Relation prediction: also score relations from tail to head')
+    parser.add_argument('--eval_types', required=False, default="prefix", type=str, choices=['prefix', 'rdf:type'], help='Entity types of the link prediction metrics per type. \
+                            One of "prefix" (namespace of the entity), "rdf:type" (class of its rdf:type triples)')
+    parser.add_argument('--eval_report', required=False, default=None, type=str, help='Write the evaluation metrics per relation and entity type \
+                            (confusion matrix for relation prediction) to this .json file. Defaults to models/[method]_[timestart]_eval.json with --save_model')
     parser.add_argument('--split_ratio', required=False, default=0.8, type=float, help='train/test ratio')
+    parser.add_argument('--validation', action='store_true', help='Split the triples left out of training in validation and test sets. \
+                            Validation loss is then computed on the validation set.')
+    parser.add_argument('--stratify', action='store_true', help='Apply split_ratio per relation')
+    parser.add_argument('--seed', required=False, default=None, type=int, help='Seed of the train/test split')
+    parser.add_argument('--split_file', required=False, default=None, type=str, help='Split indices (.npz) are loaded from this file if it exists, \
+                            else written to it. Allows reusing the same split across runs.')
     parser.add_argument('--dissimilarity_type', required=False, default='L1', type=str, help='Either "L1" or "L2", \
                             representing the type of dissimilarity measure to use')
     parser.add_argument('--margin', required=False, default=1, type=float, help='margin value.')
@@ -50,6 +120,9 @@ def main():
     parser.add_argument('--init_transe', nargs='*', required=False, default=False, help='Whether to initialize ConvKB with transe embeddings. \
                             Additional arguments allows to initialize ConvKB from a pretrained TransE model: \
                              [path to TransE model (.pt)] [TransE entity embedding size] [TransE dissimilarity_type]')
+    parser.add_argument('--registry_dir', required=False, default='models/registry', type=str, help='Directory of the registry of TransE models \
+                            used to initialize ConvKB. A TransE trained with the same hyperparameters on the same training set is reused.')
+    parser.add_argument('--no_registry', action='store_true', help='Train the TransE initializing ConvKB without reading or writing the registry')
     
     args = parser.parse_args()
     config = vars(args)
@@ -70,7 +143,7 @@ def main():
     # Create a file handler for the logger
     if not os.path.exists('./logs/'):
         os.makedirs('./logs/')
-    logfile = f'logs/{timestart}_{config["method"]}_{config["dataset"]}.log'
+    logfile = f'logs/{timestart}_{config["method"]}_{os.path.basename(str(config["dataset"]))}.log'
 
     logging.basicConfig(filename=logfile,
                         level=logging.INFO,
@@ -90,6 +163,13 @@ def main():
 
     logger.info(f"Start time: {timestart}")
 
+    # Structured metrics of the run (see src.telemetry)
+    if config['telemetry_dir']:
+        TELEMETRY.configure(jsonl_path=os.path.join(config['telemetry_dir'], f'{timestart}_{config["method"]}.jsonl'),
+                            prom_path=os.path.join(config['telemetry_dir'], f'kgene_{config["method"]}.prom'),
+                            method=config['method'], dataset=os.path.basename(str(config['dataset'])), run=timestart)
+        logger.info(f"Telemetry written to {config['telemetry_dir']}")
+
 
     # Set device
     use_cuda = cuda.is_available()
@@ -103,12 +183,14 @@ def main():
 
     # Gather data, either from local file or SPARQL endpoint
     if args.query: # Query the SPARQL endpoint
-        dataset = load_by_query(args.query)
+        dataset = load_by_query(args.query, endpoint=args.endpoint)
 
     elif args.dataset and args.method != "PhenoGeneRanker":
         match args.dataset:
             case "celegans":
-                dataset = load_celegans(args.keywords, sep=' ')
+                dataset = load_celegans(args.keywords, sep=' ', endpoint=args.endpoint, page_size=args.page_size,
+                                        n_workers=args.query_workers, max_retries=args.max_retries,
+                                        cache_dir=None if args.no_cache else args.cache_dir, cache_ttl=args.cache_ttl, ntriples=args.ntriples)
             case "toy-example": # Debug dataset
                 dataset = "data/raw/toy-example.txt"
             case _:
@@ -146,7 +228,7 @@ def main():
     else:
         raise Exception("Method not supported. Check spelling ?")
 
-    if dataset not in ['data/raw/local.txt', 'data/raw/toy-example.txt']:
+    if args.query or args.dataset == 'celegans':
         os.remove(dataset) # Do not keep the dataset file if it was downloaded from the SPARQL endpoint
 
     # Train classifier
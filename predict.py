@@ -1,6 +1,7 @@
 
 from tqdm import tqdm
 import argparse
+import os
 from termcolor import colored
 
 import numpy as np
@@ -12,9 +13,14 @@ from torchkge.models import *
 from torchkge.inference import *
 
 from src.embeddings import get_emb
+from src.precision import PRECISIONS, scoring_model
+from src.compile import compiled_scoring
+from src.autotune import autotune
+from src.negatives import model_device
+from src.dataset import is_encoded, load_encoded, load_snapshot, snapshot_path
 from src.classifier import load_classifier, predict
 
-def evaluate(ent_inf, b_size, filter_known_facts, verbose=True):
+def evaluate(ent_inf, b_size, filter_known_facts, verbose=True, precision='fp32', compile=False):
     """Performs evaluation on the given entity inference model.
 
     Args:
@@ -22,6 +28,8 @@ def evaluate(ent_inf, b_size, filter_known_facts, verbose=True):
         b_size (int): Batch size for data loading.
         filter_known_facts (bool, optional): Whether to filter known facts from the scores. Defaults to True.
         verbose (bool, optional): Whether to display progress information. Defaults to True.
+        precision (str, optional): One of fp32, bf16. With bf16, candidates are scored by a bfloat16 copy of the model. Defaults to fp32.
+        compile (bool, optional): Whether candidates are scored by a compiled scoring function, falling back to eager mode if it fails. Defaults to False.
 
     Returns:
         None
@@ -52,19 +60,22 @@ def evaluate(ent_inf, b_size, filter_known_facts, verbose=True):
         - The top-k predictions and scores are stored in `ent_inf.predictions` and `ent_inf.scores`, respectively.
     """
 
+    model = scoring_model(ent_inf.model, precision)
+    if compile:
+        model = compiled_scoring(model)
     with torch.no_grad():
         dataloader = DataLoader_(ent_inf.known_entities, ent_inf.known_relations, batch_size=b_size)
         for i, batch in tqdm(enumerate(dataloader), total=len(dataloader),
                                 unit='batch', disable=(not verbose),
                                 desc='Inference'):
             known_ents, known_rels = batch[0], batch[1]
-            query_emb, _, rel_emb, candidates = ent_inf.model.inference_prepare_candidates(known_ents, known_ents,
+            query_emb, _, rel_emb, candidates = model.inference_prepare_candidates(known_ents, known_ents,
                                                                         known_rels,
                                                                         entities=True)
             if ent_inf.missing == 'heads': # Take into account whether we're predicting a head or a tail
-                scores = ent_inf.model.inference_scoring_function(candidates, query_emb, rel_emb)
+                scores = model.inference_scoring_function(candidates, query_emb, rel_emb)
             else:
-                scores = ent_inf.model.inference_scoring_function(query_emb, candidates, rel_emb)
+                scores = model.inference_scoring_function(query_emb, candidates, rel_emb)
 
             if filter_known_facts: # Remove already known facts
                 scores = filter_scores(scores, ent_inf.dictionary, known_ents, known_rels, None)
@@ -182,7 +193,8 @@ def load_embedding_model(argsmodel, kg):
     return emb_model
 
 def load_graph(graph_path):
-    """Loads a knowledge graph from the specified .csv file.
+    """Loads a knowledge graph from the specified .csv file or integer-encoded dataset directory (see src.dataset).
+    If a snapshot (.pkl) saved at training time sits next to the .csv file, it is loaded instead, which skips rebuilding the graph indexes.
 
     Args:
         graph_path (str): The path to the graph file.
@@ -190,6 +202,12 @@ def load_graph(graph_path):
     Returns:
         object: The loaded knowledge graph.
     """
+    if is_encoded(graph_path):
+        return load_encoded(graph_path)
+    if graph_path.endswith('.pkl'):
+        return load_snapshot(graph_path)
+    if os.path.exists(snapshot_path(graph_path)):
+        return load_snapshot(snapshot_path(graph_path))
     df = pd.read_csv(graph_path, sep=',', header=0, names=['from', 'to', 'rel'])
     kg = KnowledgeGraph(df)
     return kg
@@ -199,10 +217,15 @@ def parse_arguments():
     parser.add_argument('--model', type=str, nargs='+', help='[Model type] [Model path] [embedding dim] [Additional param : One of dissmimilary func (L1/L2) (TorusE/TransE), nb_filter (ConvKB), scalar share (ANALOGY)]', required=True)
     parser.add_argument('--filter_known_facts', action='store_true', help='Removes known facts from the predictions')
     parser.add_argument('--topk', type=int, default=10, help='Number of predictions to return (optional, default=10)')
-    parser.add_argument('--graph', type=str, required=True, help='Path of the model\'s training data file as .csv(required)')
+    parser.add_argument('--graph', type=str, required=True, help='Path of the model\'s training data file as .csv, .pkl snapshot or integer-encoded dataset directory (required)')
     parser.add_argument('--file', type=str, help='CSV file containing queries in the format: [head,relation,?] or [?,relation,tail]')
     parser.add_argument('--triple', type=str, nargs='+', help='URI of triple like [head] [relation] [?] or [?] [relation] [tail] (optional)')
     parser.add_argument('--b_size', type=int, default=264, help='Batch size (optional, default=264)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='Precision of candidate scoring (optional, default=fp32). bf16 halves memory traffic.')
+    parser.add_argument('--compile', action='store_true', help='Compile the scoring function of the model with torch.compile (optional). Pays off on large graphs.')
+    parser.add_argument('--autotune', action='store_true', help='Replace --b_size and the number of threads by the evaluation settings autotuned for this model \
+                        and graph size (see main.py --autotune), measuring them first if there are none (optional).')
+    parser.add_argument('--autotune_file', type=str, default='models/autotune.json', help='File of the autotuned settings (optional, default=models/autotune.json)')
     parser.add_argument('--classifier', type=str, help='Path of the classifier .pkl file. Adding this option will add predictions of a binary classifier on the existence of each link.')
     parser.add_argument('--output', type=str, help='Path of the prediction output file')
     return parser.parse_args()
@@ -235,6 +258,12 @@ def main():
     print("Loading model..")
     emb_model = load_embedding_model(args.model, kg)
 
+    if args.autotune:
+        settings = autotune('eval', args.model[0], scoring_model(emb_model, args.precision), kg, model_device(emb_model), path=args.autotune_file,
+                            precision=args.precision, eval_mode='predict')
+        args.b_size = settings['b_size']
+        torch.set_num_threads(settings['threads'])
+        print(f"Autotuned batch size {args.b_size} with {settings['threads']} threads")
 
     # Convert head, relation, tail to known_entities and known_relations
     known_entities = []
@@ -266,12 +295,12 @@ def main():
 
     # Prediction with filtering on known facts
     ent_inf_filt = EntityInference(emb_model, known_entities, known_relations, top_k=args.topk, missing=missing, dictionary=kg.dict_of_tails if missing == 'tails' else kg.dict_of_heads)
-    evaluate(ent_inf_filt, args.b_size, filter_known_facts=True)
+    evaluate(ent_inf_filt, args.b_size, filter_known_facts=True, precision=args.precision, compile=args.compile)
     filt_pred = format_predictions(args, ent_inf_filt, kg)
     
     # Prediction without filtering on known facts
     ent_inf = EntityInference(emb_model, known_entities, known_relations, top_k=args.topk, missing=missing, dictionary=kg.dict_of_tails if missing == 'tails' else kg.dict_of_heads)
-    evaluate(ent_inf, args.b_size, filter_known_facts=False)
+    evaluate(ent_inf, args.b_size, filter_known_facts=False, precision=args.precision, compile=args.compile)
     unfilt_pred = format_predictions(args, ent_inf, kg)
 
     # Add a new column 'known' by merging the two dataframes and looking for differences. Does not take into account known facts by inference through another annotation (see predict_classif.py)
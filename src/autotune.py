@@ -0,0 +1,219 @@
+import copy
+import json
+import os
+from datetime import datetime as dt
+from resource import getrusage, RUSAGE_SELF
+from time import time
+
+import torch
+
+from src.partition import entity_tables
+from src.ranking import ChunkedLinkPredictionEvaluator, EVAL_MEMORY
+from src.sampled import SampledLinkPredictionEvaluator
+
+AUTOTUNE_FILE = 'models/autotune.json'
+
+
+def thread_counts():
+    """Intra-op thread counts tried: powers of two up to the number of cores, and the number of cores."""
+    n_cores = os.cpu_count() or 1
+    return sorted({2**i for i in range(n_cores.bit_length()) if 2**i <= n_cores} | {n_cores})
+
+def batch_sizes(smallest, largest, n_facts):
+    """Powers of two from `smallest` to `largest`, the ones larger than the graph replaced by its number of triples."""
+    sizes = [2**i for i in range(smallest.bit_length() - 1, largest.bit_length())]
+    return sorted({min(size, n_facts) for size in sizes})
+
+def profile_key(method, emb_model, n_ent, device, precision='fp32'):
+    """Key of a profile: the method, its entity embedding size and the number of entities, in a precision (see src.precision) on a type of device."""
+    dim = getattr(emb_model, entity_tables(emb_model)[0]).embedding_dim
+    return f'{method}_dim{dim}_nent{n_ent}_{precision}_{torch.device(device).type}'
+
+def load_profile(path, key):
+    """Settings tuned for `key`, as {'train': {...}, 'eval_full_1024MiB': {...}, ...}, missing sections if not tuned yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f).get(key, {})
+
+def save_profile(path, key, section, settings):
+    """Record the `section` settings of `key` (see `section_name`), keeping the other profiles."""
+    profiles = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            profiles = json.load(f)
+    profiles.setdefault(key, {})[section] = {**settings, 'n_cores': os.cpu_count(), 'date': str(dt.now())}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    elif os.path.exists('/proc/self/clear_refs'):
+        with open('/proc/self/clear_refs', 'w') as f: # Resets the peak resident set size (VmHWM) of the process
+            f.write('5')
+
+def peak_memory(device):
+    """Peak memory since the last `reset_peak_memory`, in MiB: allocated by torch on a GPU, resident set size of the process on CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024 # Never reset
+
+def measure(step, n_items, n_steps, device, min_time=0.2):
+    """
+    Run `step` once to warm up, then at least `n_steps` times and `min_time` seconds, so that small steps are not timed by the clock resolution.
+
+    Returns
+    -------
+    (float, float) / None
+        Items per second and peak memory (MiB), or None if the step ran out of memory.
+    """
+    try:
+        reset_peak_memory(device)
+        step()
+        t1, done = time(), 0
+        while done < n_steps or time() - t1 < min_time:
+            step()
+            done += 1
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+        return n_items * done / (time() - t1), peak_memory(device)
+    except (RuntimeError, MemoryError) as e: # torch.cuda.OutOfMemoryError is a RuntimeError, CPU allocation failures too
+        if 'memory' not in str(e).lower():
+            raise
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        return None
+
+def search(make_step, sizes, device, n_steps, memory_limit=None, logger=None, name=''):
+    """
+    For each thread count, try increasing sizes until one runs out of memory, exceeds `memory_limit` (MiB)
+    or is 10% slower than the fastest size of this thread count, and keep the fastest setting.
+
+    Parameters
+    ----------
+    make_step : callable
+        make_step(size) returns a function running one step of `size` items.
+    sizes : list of int
+        Increasing sizes to try.
+
+    Returns
+    -------
+    dict
+        size, threads, items_per_s and peak_mib of the chosen setting, and the list of all trials.
+    """
+    threads_before = torch.get_num_threads()
+    best, trials = None, []
+    for threads in thread_counts():
+        torch.set_num_threads(threads)
+        fastest = 0.0
+        for size in sizes:
+            result = measure(make_step(size), size, n_steps, device)
+            if result is None:
+                trials.append({'size': size, 'threads': threads, 'oom': True})
+                break
+            speed, peak = result
+            trials.append({'size': size, 'threads': threads, 'items_per_s': round(speed, 1), 'peak_mib': round(peak, 1)})
+            if logger is not None:
+                logger.info(f'\t autotune {name}: size {size}, {threads} threads: {speed:.0f} triples/s, peak memory {peak:.0f} MiB')
+            if memory_limit and peak > memory_limit:
+                break
+            if best is None or speed > best['items_per_s']:
+                best = {'size': size, 'threads': threads, 'items_per_s': speed, 'peak_mib': peak}
+            if speed < 0.9 * fastest:
+                break
+            fastest = max(fastest, speed)
+    torch.set_num_threads(threads_before)
+    if best is None:
+        raise RuntimeError(f'Autotuning {name} found no setting within the memory limit.')
+    return {**best, 'trials': trials}
+
+def tune_training(emb_model, make_optimizer, step, kg, sampler, device, n_steps=5, memory_limit=None, logger=None):
+    """
+    Training batch size and intra-op threads maximizing triples/s of full training steps: negative sampling and
+    `step(emb_model, optimizer, batch)`, the step of `src.train.train`. Steps run on a copy of `emb_model`, which is left untouched.
+    """
+    model = copy.deepcopy(emb_model).to(device)
+    optimizer = make_optimizer(model)
+
+    def make_step(size):
+        def train_step():
+            idx = torch.randint(0, kg.n_facts, (size,))
+            h, t, r = kg.head_idx[idx], kg.tail_idx[idx], kg.relations[idx]
+            n_h, n_t = sampler.corrupt_batch(h, t, r)
+            step(model, optimizer, tuple(x.to(device) for x in (h, t, r, n_h, n_t)))
+        return train_step
+
+    settings = search(make_step, batch_sizes(64, 16384, kg.n_facts), torch.device(device), n_steps, memory_limit, logger, 'training')
+    return {'batch_size': settings.pop('size'), **settings}
+
+def tune_evaluation(emb_model, kg, device, eval_mode='full', eval_memory=EVAL_MEMORY, eval_threads=1, eval_candidates=100, eval_typed=False,
+                    n_steps=3, memory_limit=None, logger=None):
+    """
+    Evaluation batch size and intra-op threads maximizing triples/s when ranking the heads and tails of a batch of triples,
+    with the evaluator `src.train.evaluate_emb_model` runs for `eval_mode`: ChunkedLinkPredictionEvaluator (full), whose
+    score blocks are bounded by `eval_memory`, or SampledLinkPredictionEvaluator (sampled). With eval_mode 'predict',
+    all candidate tails of a batch are scored at once, as done by `predict.evaluate`.
+    """
+    model = emb_model
+    match eval_mode:
+        case 'full':
+            evaluator = ChunkedLinkPredictionEvaluator(model, kg, memory_budget=eval_memory, n_threads=eval_threads)
+        case 'sampled':
+            evaluator = SampledLinkPredictionEvaluator(model, kg, n_candidates=eval_candidates, typed=eval_typed)
+        case 'predict':
+            evaluator = None
+        case _:
+            raise ValueError(f"Unknown eval_mode {eval_mode}, one of 'full', 'sampled', 'predict'.")
+
+    def make_step(size):
+        start = int(torch.randint(0, kg.n_facts - size + 1, (1,)))
+        if evaluator is not None:
+            return lambda: evaluator.evaluate_batch(start, start + size)
+        h, t, r = (x[start:start + size].to(device) for x in (kg.head_idx, kg.tail_idx, kg.relations))
+        def step():
+            with torch.no_grad():
+                h_emb, t_emb, r_emb, candidates = model.inference_prepare_candidates(h, t, r, entities=True)
+                model.inference_scoring_function(h_emb, candidates, r_emb)
+        return step
+
+    settings = search(make_step, batch_sizes(16, 4096, kg.n_facts), torch.device(device), n_steps, memory_limit, logger, f'evaluation ({eval_mode})')
+    return {'b_size': settings.pop('size'), **settings}
+
+def section_name(section, eval_mode='full', eval_memory=EVAL_MEMORY, **kwargs):
+    """Profile section of the settings: train, eval_full_{eval_memory}MiB, eval_sampled or eval_predict."""
+    if section == 'train':
+        return section
+    return f'eval_full_{eval_memory:g}MiB' if eval_mode == 'full' else f'eval_{eval_mode}'
+
+def autotune(section, method, emb_model, kg, device, path=AUTOTUNE_FILE, logger=None, precision='fp32', **kwargs):
+    """
+    Settings of `section` ('train' or 'eval') for this method, embedding size, number of entities and precision,
+    read from the profiles of `path` if tuned before, else tuned with `tune_training` or `tune_evaluation` (given **kwargs) and stored.
+    Evaluation settings are kept per evaluation mode, and per memory budget of the full evaluation (see `section_name`).
+
+    Returns
+    -------
+    dict
+        For train: batch_size and threads. For eval: b_size and threads. Along with their measured triples/s and peak memory.
+    """
+    key, name = profile_key(method, emb_model, kg.n_ent, device, precision), section_name(section, **kwargs)
+    settings = load_profile(path, key).get(name)
+    if settings is None:
+        if logger is not None:
+            logger.info(f'{dt.now()} - Autotuning {name} settings of {key}..')
+        tune = tune_training if section == 'train' else tune_evaluation
+        settings = tune(emb_model, kg=kg, device=device, logger=logger, **kwargs)
+        save_profile(path, key, name, settings)
+    if logger is not None:
+        size = settings['batch_size'] if section == 'train' else settings['b_size']
+        logger.info(f'Autotuned {name} settings of {key}: size {size}, {settings["threads"]} threads '
+                    f'({settings["items_per_s"]:.0f} triples/s, peak memory {settings["peak_mib"]:.0f} MiB)')
+    return settings
@@ -0,0 +1,162 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+from datetime import datetime as dt
+
+import torch
+
+from src.dataset import is_encoded
+from src.synthetic import generate_graph, synthetic_path, write_graph
+from src.telemetry import TELEMETRY, Timer, peak_rss_mib
+
+BENCHMARK_DIR = 'models/benchmarks'
+
+
+def bench_config(method, dim, n_epochs, batch_size):
+    """Arguments of `src.train.train` (defaults of main.py) for a benchmark run, without evaluation nor saved files."""
+    return {'method': method, 'n_epochs': n_epochs, 'batch_size': batch_size, 'lr': 0.0001, 'weight_decay': 0.0001, 'loss_fn': 'margin',
+            'margin': 1, 'ent_emb_dim': dim, 'rel_emb_dim': dim, 'dissimilarity_type': 'L1', 'n_filters': 10, 'scalar_share': 0.5,
+            'init_transe': False, 'no_registry': True, 'split_ratio': 0.8, 'seed': 0, 'normalize_parameters': True,
+            'save_model': False, 'save_embeddings': False, 'eval_task': None, 'val_size': 10000}
+
+def bench_model_config(dim):
+    """Arguments of `src.train.build_model` for the benchmarks of a single component (ex: src.compile, src.ranking), on models built directly."""
+    return {'ent_emb_dim': dim, 'rel_emb_dim': dim, 'dissimilarity_type': 'L2', 'n_filters': 10, 'scalar_share': 0.5}
+
+def bench_parser(description, methods=True):
+    """Command line of a component benchmark: a dataset, one model (method) or several (methods), and --dim."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('dataset', type=str, help='Triple file or integer-encoded dataset directory')
+    if methods:
+        parser.add_argument('methods', nargs='+', help='Models to benchmark')
+    else:
+        parser.add_argument('method', type=str, help='Model to benchmark')
+    parser.add_argument('--dim', type=int, default=50, help='Embedding size')
+    return parser
+
+def environment():
+    return {'date': str(dt.now()), 'python': platform.python_version(), 'torch': torch.__version__, 'n_cores': os.cpu_count(),
+            'threads': torch.get_num_threads(), 'machine': platform.machine(), 'cuda': torch.cuda.is_available()}
+
+def run(sizes, methods, dim=50, n_epochs=2, batch_size=512, n_eval=1000, seed=0, data_dir='data/synthetic'):
+    """
+    Time the stages of the pipeline on synthetic graphs (see src.synthetic), generated once per size and seed and reused.
+        - train_epoch: median epoch of `src.train.train`, from its epoch telemetry,
+        - evaluate_emb_model: link prediction of `n_eval` test triples,
+        - predict: top 10 filtered tails of the same `n_eval` queries with `predict.evaluate`,
+        - generate: classifier dataset of the same triples with `src.embeddings.generate`.
+
+    Returns
+    -------
+    list of dict
+        One row per size, method and stage: seconds, triples_per_s and peak_rss_mib.
+    """
+    import predict
+    from src.embeddings import generate
+    from src.split import subgraph
+    from src.train import train, evaluate_emb_model
+    from torchkge.inference import EntityInference
+
+    logger = logging.getLogger('benchmarks')
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    timestart = dt.now().strftime("%Y-%m-%d_%H-%M-%S")
+    rows = []
+    for n_entities in sizes:
+        path = synthetic_path(n_entities, seed, data_dir)
+        if not is_encoded(path):
+            print(f'{dt.now()} - Generating {path}..')
+            write_graph(generate_graph(n_entities, seed=seed), path)
+        for method in methods:
+            print(f'{dt.now()} - {method} on {path}..')
+            config = bench_config(method, dim, n_epochs, batch_size)
+            events = os.path.join(BENCHMARK_DIR, f'.epochs_{os.getpid()}.jsonl')
+            os.makedirs(BENCHMARK_DIR, exist_ok=True)
+            saved = TELEMETRY.jsonl_path, TELEMETRY.prom_path, TELEMETRY.labels
+            TELEMETRY.configure(jsonl_path=events)
+            try:
+                emb_model, kg_train, kg_test = train(method, path, config, timestart, logger, device)
+            finally:
+                TELEMETRY.configure(*saved[:2], **saved[2])
+            with open(events, 'r') as f:
+                epochs = [event for event in map(json.loads, f) if event['event'] == 'epoch']
+            os.remove(events)
+
+            def row(stage, seconds, n_triples):
+                rows.append({'n_entities': n_entities, 'method': method, 'stage': stage, 'seconds': seconds,
+                             'triples_per_s': n_triples / max(seconds, 1e-9), 'peak_rss_mib': peak_rss_mib()})
+
+            row('train_epoch', statistics.median(event['seconds'] for event in epochs), kg_train.n_facts)
+            kg_eval = subgraph(kg_test, torch.randperm(kg_test.n_facts, generator=torch.Generator().manual_seed(seed))[:n_eval])
+            with Timer() as timer:
+                evaluate_emb_model(emb_model, kg_eval, 'link-prediction', device, logger)
+            row('evaluate_emb_model', timer.seconds, kg_eval.n_facts)
+            ent_inf = EntityInference(emb_model, kg_eval.head_idx, kg_eval.relations, top_k=10, missing='tails', dictionary=kg_train.dict_of_tails)
+            with Timer() as timer:
+                predict.evaluate(ent_inf, 264, filter_known_facts=True, verbose=False)
+            row('predict', timer.seconds, kg_eval.n_facts)
+            with Timer() as timer:
+                generate(emb_model, kg_eval, config, timestart, device)
+            row('generate', timer.seconds, kg_eval.n_facts)
+    return rows
+
+def compare(rows, baseline, tolerance=0.1):
+    """
+    Print each stage next to the same (n_entities, method, stage) of `baseline`, flagging those slower by more than `tolerance`.
+
+    Returns
+    -------
+    list of dict
+        The regressed rows, with their baseline seconds.
+    """
+    reference = {(r['n_entities'], r['method'], r['stage']): r for r in baseline}
+    regressions = []
+    print(f'{"entities":>9} {"method":<10}{"stage":<20}{"seconds":>10}{"baseline":>10}{"ratio":>8}')
+    for r in rows:
+        base = reference.get((r['n_entities'], r['method'], r['stage']))
+        ratio = r['seconds'] / base['seconds'] if base else None
+        flag = ''
+        if ratio is not None and ratio > 1 + tolerance:
+            regressions.append({**r, 'baseline_seconds': base['seconds']})
+            flag = '  REGRESSION'
+        print(f'{r["n_entities"]:>9} {r["method"]:<10}{r["stage"]:<20}{r["seconds"]:>10.3f}'
+              f'{base["seconds"] if base else float("nan"):>10.3f}{ratio if ratio is not None else float("nan"):>8.2f}{flag}')
+    return regressions
+
+if __name__ == '__main__':
+    # ex: python -m src.benchmarks --sizes 10000 100000 --methods TransE DistMult --baseline models/benchmarks/baseline.json
+    parser = argparse.ArgumentParser(description='Benchmark training, evaluation, prediction and embedding generation on synthetic WormBase-shaped graphs')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000], help='Numbers of entities of the synthetic graphs')
+    parser.add_argument('--methods', nargs='+', default=['TransE'], help='Models to benchmark')
+    parser.add_argument('--dim', type=int, default=50, help='Embedding size')
+    parser.add_argument('--n_epochs', type=int, default=2, help='Epochs trained, the median epoch is reported')
+    parser.add_argument('--batch_size', type=int, default=512, help='Training batch size')
+    parser.add_argument('--n_eval', type=int, default=1000, help='Number of test triples evaluated, predicted and embedded')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic graphs and of their split')
+    parser.add_argument('--output', type=str, default=None, help=f'Results file (.json). Defaults to {BENCHMARK_DIR}/bench_{{date}}.json')
+    parser.add_argument('--baseline', type=str, default=None, help='Results file of a previous run to compare to. Exits with status 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown of a stage over the baseline flagged as a regression')
+    args = parser.parse_args()
+
+    rows = run(args.sizes, args.methods, dim=args.dim, n_epochs=args.n_epochs, batch_size=args.batch_size, n_eval=args.n_eval, seed=args.seed)
+    output = args.output or os.path.join(BENCHMARK_DIR, f'bench_{dt.now().strftime("%Y-%m-%d_%H-%M-%S")}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'arguments': vars(args), 'results': rows}, f, indent=2)
+    print(f'Results saved to {output}')
+
+    baseline = {'results': []}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        differing = [key for key in ['dim', 'n_epochs', 'batch_size', 'n_eval', 'seed'] if baseline['arguments'][key] != vars(args)[key]]
+        differing += [key for key in ['torch', 'n_cores', 'threads', 'cuda'] if baseline['environment'][key] != environment()[key]]
+        if differing:
+            print(f'Warning: the baseline was run with other {", ".join(differing)}, timings are not comparable')
+    regressions = compare(rows, baseline['results'], args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} stages slower than the baseline by more than {100 * args.tolerance:.0f}%')
+        sys.exit(1)
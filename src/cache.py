@@ -0,0 +1,90 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime as dt
+from time import time
+
+CACHE_DIR = 'data/cache'
+
+
+def cache_key(keyword, query, endpoint):
+    """Hash identifying the result of `query` on `endpoint`. Any change to the query text invalidates it."""
+    return hashlib.sha256(f'{keyword}\n{endpoint}\n{query}'.encode()).hexdigest()
+
+def shard_path(cache_dir, keyword, key):
+    return os.path.join(cache_dir, f'{keyword}_{key[:16]}.txt')
+
+def lookup(cache_dir, keyword, query, endpoint, ttl=None):
+    """
+    Look up the cached triples of a keyword query.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache.
+    keyword : str
+        Keyword of the query (see sparql_queries/).
+    query : str
+        Full text of the query, prefixes included.
+    endpoint : str
+        URL of the SPARQL endpoint the query is sent to.
+    ttl : float, optional
+        Lifetime of a cache entry in hours. Entries never expire if None or 0.
+
+    Returns
+    -------
+    str / None
+        Path to the cached shard, or None if there is no valid entry for this keyword, query and endpoint.
+    """
+    key = cache_key(keyword, query, endpoint)
+    path = shard_path(cache_dir, keyword, key)
+    meta_path = f'{path}.json'
+    if not (os.path.exists(path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta['key'] != key:
+        return None
+    if ttl and time() - meta['fetched_at'] > ttl * 3600:
+        return None
+    return path
+
+def store(cache_dir, keyword, query, endpoint, src):
+    """
+    Move a freshly fetched result file `src` into the cache and record its metadata.
+    Previous shards of the same keyword and endpoint are evicted.
+
+    Returns
+    -------
+    str
+        Path to the cached shard.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(keyword, query, endpoint)
+    path = shard_path(cache_dir, keyword, key)
+
+    for meta_path in glob.glob(os.path.join(cache_dir, f'{keyword}_*.txt.json')): # Evict stale shards
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['keyword'] == keyword and meta['endpoint'] == endpoint and meta['key'] != key:
+            for stale in (meta_path, meta_path[:-len('.json')]):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+    shutil.move(src, path)
+    with open(path, 'r') as f:
+        n_triples = sum(1 for _ in f)
+    meta = {'keyword': keyword, 'endpoint': endpoint, 'key': key,
+            'fetched_at': time(), 'date': str(dt.now()), 'n_triples': n_triples}
+    with open(f'{path}.json', 'w') as f: # Written last: a shard without metadata is never considered valid
+        json.dump(meta, f, indent=2)
+    return path
+
+def merge(shards, output):
+    """Append cached shards to `output`, in order."""
+    with open(output, 'a') as out:
+        for shard in shards:
+            with open(shard, 'r') as f:
+                shutil.copyfileobj(f, out)
@@ -0,0 +1,97 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+from src.split import checksum
+
+CHECKPOINT_DIR = 'models/checkpoints'
+
+
+def checkpoint_paths(checkpoint_dir, method, timestart):
+    """Paths of the latest and of the best checkpoint of a run."""
+    prefix = os.path.join(checkpoint_dir, f'{method}_{timestart}')
+    return f'{prefix}_last.ckpt', f'{prefix}_best.ckpt'
+
+def save_checkpoint(path, method, timestart, epoch, emb_model, optimizer, kg=None, split_idx=None, best_val_loss=None, bad_epochs=0):
+    """
+    Save everything needed to resume training after `epoch`: model and optimizer states, RNG states
+    (negative sampling and batch shuffling draw from the torch RNG), early stopping counters and split indices.
+    The file is written next to `path` then renamed, so that a run killed while saving keeps its previous checkpoint.
+
+    Parameters
+    ----------
+    path : str
+        Checkpoint file.
+    method : str
+        The embedding method, checked when resuming.
+    timestart : str
+        Start time of the run, reused when resuming so that checkpoints keep the same names.
+    epoch : int
+        Number of epochs completed.
+    emb_model : torchkge.models.xxx
+        The embedding model.
+    optimizer : torch.optim.Optimizer
+        Its optimizer.
+    kg : torchkge.data_structures.KnowledgeGraph, optional
+        The graph that was split, its checksum is checked when resuming.
+    split_idx : tuple of torch.Tensor, optional
+        Train, validation and test indices in `kg` (see src.split.split_indices).
+    best_val_loss : float, optional
+        Lowest validation loss so far.
+    bad_epochs : int
+        Number of epochs since the validation loss last improved.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    state = {
+        'method': method,
+        'timestart': timestart,
+        'epoch': epoch,
+        'model': emb_model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'rng': {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()},
+        'best_val_loss': best_val_loss,
+        'bad_epochs': bad_epochs,
+        'split': split_idx,
+        'checksum': checksum(kg) if split_idx is not None else None,
+    }
+    if torch.cuda.is_available():
+        state['rng']['cuda'] = torch.cuda.get_rng_state_all()
+    torch.save(state, f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+
+def load_checkpoint(path, method, device):
+    """
+    Load a checkpoint saved by `save_checkpoint`.
+
+    Raises
+    ------
+    ValueError
+        If the checkpoint was saved by a run of another method.
+    """
+    state = torch.load(path, map_location=device, weights_only=False) # Holds numpy and python RNG states
+    if state['method'] != method:
+        raise ValueError(f"Checkpoint {path} was saved by a {state['method']} run, cannot resume it as {method}.")
+    return state
+
+def restore_rng(state):
+    """Restore the RNG states of a checkpoint. Called right before the training loop, after models are initialized."""
+    torch.set_rng_state(state['rng']['torch'].cpu())
+    np.random.set_state(state['rng']['numpy'])
+    random.setstate(state['rng']['python'])
+    if 'cuda' in state['rng'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['rng']['cuda']])
+
+def checkpoint_split(state, kg):
+    """
+    Split indices stored in a checkpoint, so that a resumed run trains and validates on the same triples.
+
+    Raises
+    ------
+    ValueError
+        If the indices were computed on another graph.
+    """
+    if state['checksum'] != checksum(kg):
+        raise ValueError('Checkpoint was saved for a different graph.')
+    return tuple(idx.cpu() if idx is not None else None for idx in state['split'])
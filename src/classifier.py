@@ -2,6 +2,9 @@ from pycaret.classification import *
 import pandas as pd
 import os
 
+from src.utils import timer_func
+
+@timer_func
 def train_classifier(model_type, data, timestart, logger, device, save=False):
     """
     Train binary classification models on the provided data.
@@ -0,0 +1,132 @@
+import copy
+import logging
+from time import time
+
+import torch
+from torch.optim import Adam
+
+from torchkge.sampling import BernoulliNegativeSampler
+from torchkge.utils import MarginLoss
+
+# Models whose training step and candidate scoring compile without graph breaks. Others are compiled too, falling back to eager if it fails.
+COMPILE_METHODS = ['TransE', 'TorusE', 'DistMult', 'ComplEx', 'ANALOGY']
+
+
+class Compiled:
+    """
+    torch.compile(fn), falling back to `fn` for good if compilation or the compiled call fails, so that models
+    or ops the compiler does not support still run, eagerly. Compilation happens on the first call,
+    and again on new input shapes until shapes are marked dynamic.
+
+    Parameters
+    ----------
+    fn : callable
+        The eager function.
+    name : str
+        Name used in the fallback warning.
+    logger : logging.Logger, optional
+    """
+    def __init__(self, fn, name, logger=None):
+        self.eager = fn
+        self.fn = torch.compile(fn)
+        self.name = name
+        self.logger = logger or logging.getLogger()
+
+    def __call__(self, *args, **kwargs):
+        if self.fn is self.eager:
+            return self.eager(*args, **kwargs)
+        try:
+            return self.fn(*args, **kwargs)
+        except Exception as e: # Errors of the eager function are raised again below
+            self.logger.warning(f'Compilation of {self.name} failed, falling back to eager mode: {type(e).__name__}: {str(e).splitlines()[0] if str(e) else ""}')
+            self.fn = self.eager
+            return self.eager(*args, **kwargs)
+
+def forward_loss(emb_model, criterion, h, t, r, n_h, n_t):
+    """Loss of a batch of positive triples and their negative samples, the part of a training step that is compiled."""
+    pos, neg = emb_model(h, t, r, n_h, n_t)
+    return criterion(pos, neg)
+
+def compiled_loss(logger=None):
+    """`forward_loss` compiled, with eager fallback."""
+    return Compiled(forward_loss, 'the training step', logger)
+
+def compiled_scoring(emb_model, logger=None):
+    """
+    A shallow copy of `emb_model`, sharing its parameters, whose `inference_scoring_function` (used by the torchkge evaluators
+    and predict.py to score all candidates of a batch) is compiled with eager fallback. `emb_model` itself is left untouched.
+    """
+    scoring = copy.copy(emb_model)
+    scoring.inference_scoring_function = Compiled(emb_model.inference_scoring_function, f'{type(emb_model).__name__} scoring', logger)
+    return scoring
+
+def benchmark(dataset, methods, dim=50, batch_size=512, b_size=264, n_steps=50, seed=0):
+    """
+    Print steps/sec of eager and compiled training steps (forward, loss, backward and Adam update of a batch)
+    and candidate scoring steps (tail completion of a batch of `b_size` triples against all entities) of each model,
+    and the time spent compiling. Compilation and warm-up steps are not timed.
+    """
+    from src.benchmarks import bench_model_config
+    from src.dataset import load_dataset
+    from src.train import build_model
+
+    kg = load_dataset(dataset)
+    sampler = BernoulliNegativeSampler(kg)
+    criterion = MarginLoss(margin=1)
+    config = bench_model_config(dim)
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for idx in torch.randperm(kg.n_facts, generator=generator)[:batch_size * n_steps].split(batch_size):
+        h, t, r = kg.head_idx[idx], kg.tail_idx[idx], kg.relations[idx]
+        batches.append((h, t, r, *sampler.corrupt_batch(h, t, r)))
+    queries = torch.randperm(kg.n_facts, generator=generator)[:b_size]
+
+    def time_steps(step, n):
+        step(0) # Warm-up, compiles
+        t1 = time()
+        for i in range(n):
+            step(i)
+        return n / (time() - t1)
+
+    print(f'{"model":<10}{"mode":<10}{"compile (s)":>12}{"train steps/s":>15}{"scoring steps/s":>17}')
+    for method in methods:
+        if method == 'TorusE':
+            config['dissimilarity_type'] = 'torus_L2'
+        torch.manual_seed(seed)
+        init = build_model(method, config, kg.n_ent, kg.n_rel)
+        config['dissimilarity_type'] = 'L2'
+        for mode in ['eager', 'compiled']:
+            torch._dynamo.reset()
+            emb_model = copy.deepcopy(init)
+            optimizer = Adam(emb_model.parameters(), lr=0.0001)
+            loss_fn = compiled_loss() if mode == 'compiled' else forward_loss
+            scoring = compiled_scoring(emb_model) if mode == 'compiled' else emb_model
+
+            def train_step(i):
+                optimizer.zero_grad()
+                loss_fn(emb_model, criterion, *batches[i % len(batches)]).backward()
+                optimizer.step()
+
+            h, t, r = kg.head_idx[queries], kg.tail_idx[queries], kg.relations[queries]
+            with torch.no_grad():
+                h_emb, t_emb, r_emb, candidates = emb_model.inference_prepare_candidates(h, t, r, entities=True)
+            def scoring_step(i):
+                with torch.no_grad():
+                    scoring.inference_scoring_function(h_emb, candidates, r_emb)
+
+            t1 = time()
+            train_step(0), scoring_step(0)
+            compile_time = time() - t1 if mode == 'compiled' else 0.0
+            train_speed = time_steps(train_step, n_steps)
+            scoring_speed = time_steps(scoring_step, n_steps)
+            print(f'{method:<10}{mode:<10}{compile_time:>12.1f}{train_speed:>15.1f}{scoring_speed:>17.1f}')
+
+if __name__ == '__main__':
+    # Compare eager and compiled steps, ex: python -m src.compile data/raw/toy-example.txt TransE DistMult ComplEx
+    from src.benchmarks import bench_parser
+    parser = bench_parser('Benchmark compiled training and scoring steps against eager mode')
+    parser.add_argument('--batch_size', type=int, default=512, help='Training batch size')
+    parser.add_argument('--b_size', type=int, default=264, help='Scoring batch size')
+    parser.add_argument('--n_steps', type=int, default=50, help='Number of timed steps')
+    args = parser.parse_args()
+    benchmark(args.dataset, args.methods, dim=args.dim, batch_size=args.batch_size, b_size=args.b_size, n_steps=args.n_steps)
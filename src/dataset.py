@@ -0,0 +1,172 @@
+import argparse
+import os
+import pickle
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import torch
+
+from torchkge.data_structures import KnowledgeGraph
+
+ENTITIES = 'entities.txt'
+RELATIONS = 'relations.txt'
+TRIPLES = 'triples.npy'
+FILTERS = 'filters.pkl'
+
+
+def is_encoded(path):
+    """Whether `path` is a directory holding an integer-encoded dataset (see `save_encoded`)."""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, TRIPLES))
+
+def read_triples(path):
+    """
+    Read a triple file as a DataFrame with columns [from, rel, to].
+
+    Parameters
+    ----------
+    path : str
+        Either a space separated file of (head, relation, tail) such as query_result.txt,
+        or a .csv file written by `KnowledgeGraph.get_df().to_csv` such as models/*_kg_train.csv.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path, sep=',', header=0, usecols=[1, 2, 3], names=['from', 'to', 'rel'], dtype=str)[['from', 'rel', 'to']]
+    return pd.read_csv(path, sep=' ', header=None, names=['from', 'rel', 'to'], dtype=str)
+
+def load_dataset(path):
+    """Load a triple file (see `read_triples`) or an integer-encoded dataset directory (see `load_encoded`) as a KnowledgeGraph."""
+    return load_encoded(path) if is_encoded(path) else KnowledgeGraph(read_triples(path))
+
+def encode(df):
+    """
+    Encode a DataFrame of string triples to integers.
+    Entities and relations are indexed in sorted order, like torchkge's `get_dictionaries`, so that
+    indices match those of a `KnowledgeGraph` built from the same DataFrame.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame with columns [from, rel, to].
+
+    Returns
+    -------
+    entities : np.ndarray
+        Sorted entity labels. The index of a label is its integer key.
+    relations : np.ndarray
+        Sorted relation labels.
+    triples : np.ndarray, shape (n_facts, 3), dtype int64
+        (h, r, t) integer keys of each triple.
+    """
+    codes, entities = pd.factorize(pd.concat([df['from'], df['to']], ignore_index=True), sort=True)
+    rel_codes, relations = pd.factorize(df['rel'], sort=True)
+    n = len(df)
+    triples = np.empty((n, 3), dtype=np.int64, order='F') # Column-major, so each of h, r, t is contiguous on disk
+    triples[:, 0] = codes[:n]
+    triples[:, 1] = rel_codes
+    triples[:, 2] = codes[n:]
+    return np.asarray(entities), np.asarray(relations), triples
+
+def save_encoded(path, entities, relations, triples):
+    """
+    Write an integer-encoded dataset to the directory `path`:
+        - entities.txt and relations.txt, one label per line, the line number being its integer key.
+        - triples.npy, the (n_facts, 3) int64 array of (h, r, t) keys, stored column-major.
+        - filters.pkl, the filter dictionaries of the triples (see `build_dicts`), so that loading does not rebuild them.
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, labels in [(ENTITIES, entities), (RELATIONS, relations)]:
+        with open(os.path.join(path, name), 'w') as f:
+            f.write('\n'.join(labels))
+            f.write('\n')
+    np.save(os.path.join(path, TRIPLES), np.asfortranarray(triples, dtype=np.int64))
+    triples = torch.from_numpy(np.ascontiguousarray(triples, dtype=np.int64))
+    with open(os.path.join(path, FILTERS), 'wb') as f:
+        pickle.dump(build_dicts(triples[:, 0], triples[:, 2], triples[:, 1]), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_encoded(path, mmap=True):
+    """
+    Load an integer-encoded dataset written by `save_encoded` as a torchkge KnowledgeGraph.
+    The triple array is memory-mapped (copy-on-write) and its columns are wrapped as tensors without copying them.
+    The filter dictionaries are unpickled from filters.pkl, or built from the triples for datasets encoded without it.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the encoded dataset.
+    mmap : bool
+        Whether to memory-map the triples instead of reading them in memory.
+
+    Returns
+    -------
+    torchkge.data_structures.KnowledgeGraph
+    """
+    ent2ix = _read_labels(os.path.join(path, ENTITIES))
+    rel2ix = _read_labels(os.path.join(path, RELATIONS))
+    triples = np.load(os.path.join(path, TRIPLES), mmap_mode='c' if mmap else None)
+    kg = {'heads': torch.from_numpy(triples[:, 0]),
+          'relations': torch.from_numpy(triples[:, 1]),
+          'tails': torch.from_numpy(triples[:, 2])}
+    filters = os.path.join(path, FILTERS)
+    if os.path.exists(filters):
+        with open(filters, 'rb') as f:
+            dicts = pickle.load(f)
+    else:
+        dicts = build_dicts(kg['heads'], kg['tails'], kg['relations'])
+    return KnowledgeGraph(kg=kg, ent2ix=ent2ix, rel2ix=rel2ix, **dicts)
+
+def build_dicts(heads, tails, relations):
+    """
+    Build the filter dictionaries of a KnowledgeGraph (dict_of_heads, dict_of_tails, dict_of_rels) from its triples.
+    Equivalent to `KnowledgeGraph.evaluate_dicts`, without its per-triple tensor indexing.
+    """
+    dict_of_heads, dict_of_tails, dict_of_rels = defaultdict(set), defaultdict(set), defaultdict(set)
+    for h, t, r in zip(heads.tolist(), tails.tolist(), relations.tolist()):
+        dict_of_heads[(t, r)].add(h)
+        dict_of_tails[(h, r)].add(t)
+        dict_of_rels[(h, t)].add(r)
+    return {'dict_of_heads': dict_of_heads, 'dict_of_tails': dict_of_tails, 'dict_of_rels': dict_of_rels}
+
+def save_snapshot(kg, path):
+    """
+    Save a KnowledgeGraph along with its filter dictionaries, so that it can be reloaded without rebuilding its indexes.
+    The filter dictionaries are computed from the triples of `kg` only, like a KnowledgeGraph built from `kg.get_df()` would.
+    """
+    snapshot = {'ent2ix': kg.ent2ix, 'rel2ix': kg.rel2ix,
+                'heads': kg.head_idx.numpy(), 'tails': kg.tail_idx.numpy(), 'relations': kg.relations.numpy(),
+                **build_dicts(kg.head_idx, kg.tail_idx, kg.relations)}
+    with open(path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_snapshot(path):
+    """Load a KnowledgeGraph saved by `save_snapshot`."""
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+    kg = {key: torch.from_numpy(snapshot.pop(key)) for key in ['heads', 'tails', 'relations']}
+    return KnowledgeGraph(kg=kg, **snapshot)
+
+def snapshot_path(graph_path):
+    """Path of the snapshot saved next to a models/*_kg_{train,test}.csv file."""
+    return f'{os.path.splitext(graph_path)[0]}.pkl'
+
+def _read_labels(path):
+    with open(path, 'r') as f:
+        return {label: i for i, label in enumerate(f.read().splitlines())}
+
+def convert(src, dst):
+    """Convert a triple file (query_result.txt or models/*_kg_train.csv) to an integer-encoded dataset in `dst`."""
+    entities, relations, triples = encode(read_triples(src))
+    save_encoded(dst, entities, relations, triples)
+    print(f'{src} -> {dst}: {len(entities)} entities, {len(relations)} relations, {len(triples)} triples')
+
+if __name__ == '__main__':
+    # Convert existing datasets to the integer-encoded format, ex:
+    # python -m src.dataset query_result.txt data/encoded/celegans
+    parser = argparse.ArgumentParser(description='Convert a triple file to an integer-encoded, memory-mappable dataset')
+    parser.add_argument('src', type=str, help='Space separated triple file or models/*_kg_{train,test}.csv file')
+    parser.add_argument('dst', type=str, help='Output directory')
+    args = parser.parse_args()
+    convert(args.src, args.dst)
@@ -0,0 +1,79 @@
+import os
+import re
+
+import numpy as np
+import torch
+
+PREFIXES_FILE = 'sparql_queries/PREFIXES.txt'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+UNKNOWN = 'other'
+
+
+def load_prefixes(path=PREFIXES_FILE):
+    """Namespaces of the SPARQL queries and their prefix, ex: {'https://wormbase.org/species/all/phenotype/WBPhenotype:': 'wbpheno'}."""
+    prefixes = {}
+    if not os.path.exists(path): # Run outside of the repository, URIs are left as they are
+        return prefixes
+    with open(path, 'r') as f:
+        for match in re.finditer(r'PREFIX\s+([\w-]+):\s*<([^>]+)>', f.read()):
+            prefixes.setdefault(match.group(2), match.group(1))
+    return prefixes
+
+class Compactor:
+    """
+    Compact URIs with the longest matching namespace, ex: wbpheno:0000704. `kind` gives the type of a URI: its prefix,
+    followed by the stem of its local name when it is a word and a number (wbdata:pheno for wbdata:pheno-345276,
+    wbdata:disease for wbdata:disease-12), so that annotation nodes sharing a namespace are told apart.
+    """
+    def __init__(self, prefixes=None):
+        self.prefixes = load_prefixes() if prefixes is None else prefixes
+        namespaces = sorted(self.prefixes, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(ns) for ns in namespaces)) if namespaces else None
+
+    def compact(self, uri):
+        match = self.pattern.match(uri) if self.pattern else None
+        return f'{self.prefixes[match.group(0)]}:{uri[match.end():]}' if match else uri
+
+    def kind(self, uri):
+        match = self.pattern.match(uri) if self.pattern else None
+        if match is None:
+            return UNKNOWN
+        stem = re.match(r'([A-Za-z]+(?:-[A-Za-z]+)*)-\d+$', uri[match.end():])
+        return f'{self.prefixes[match.group(0)]}:{stem.group(1)}' if stem else self.prefixes[match.group(0)]
+
+def entity_types(kg, entities, source='prefix', prefixes=None):
+    """
+    Type of some entities of a graph.
+
+    Parameters
+    ----------
+    kg : torchkge.data_structures.KnowledgeGraph
+        The graph, whose ent2ix labels are URIs. Its dict_of_tails holds the rdf:type triples used with source rdf:type.
+    entities : torch.Tensor
+        Indices of the entities to type.
+    source : str
+        prefix: the namespace of the entity (see Compactor.kind), ex: wbgene, wbpheno, doid, wbdata:pheno.
+        rdf:type: the class of the entity in the rdf:type triples of the graph (the first one if several), ex: sio:000985,
+        and its namespace for entities without rdf:type triple.
+    prefixes : dict, optional
+        Namespaces and their prefix. Defaults to those of sparql_queries/PREFIXES.txt.
+
+    Returns
+    -------
+    numpy.ndarray
+        Type of each entity of `entities`. Graphs without labels have a single type.
+    """
+    if source not in ('prefix', 'rdf:type'):
+        raise ValueError(f'Unknown entity type source {source}')
+    unique, inverse = torch.unique(entities, return_inverse=True)
+    labels = {ix: label for label, ix in (kg.ent2ix or {}).items()}
+    compactor = Compactor(prefixes)
+    type_rel = (kg.rel2ix or {}).get(RDF_TYPE)
+    types = []
+    for e in unique.tolist():
+        classes = kg.dict_of_tails.get((e, type_rel)) if source == 'rdf:type' and type_rel is not None else None
+        if classes:
+            types.append(compactor.compact(labels.get(min(classes), UNKNOWN)))
+        else:
+            types.append(compactor.kind(labels[e]) if e in labels else UNKNOWN)
+    return np.array(types, dtype=object)[inverse.numpy()]
@@ -0,0 +1,182 @@
+import argparse
+import gc
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime as dt
+from time import time
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from src.checkpoint import checkpoint_split
+from src.dataset import load_dataset
+from src.ranking import EVAL_MEMORY, overall
+from src.split import load_split, subgraph
+
+METHODS = ['TransE', 'TransH', 'TransR', 'TransD', 'TorusE', 'RESCAL', 'DistMult', 'HolE', 'ComplEx', 'ANALOGY', 'ConvKB']
+
+_kg_test = None # Test graph and filter index, set before the worker processes are forked so that they share it read-only
+_loaded = {} # States of the checkpoints loaded to find the split, reused by the workers instead of loading them again
+
+
+def load_state(path):
+    """
+    Method, epoch, weights and split indices of a checkpoint: a .ckpt saved by src.checkpoint, or a state dict saved
+    by --save_model as models/{method}_{timestart}.pt, whose method is read from its name (and epoch and split are None).
+    """
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    if 'model' in state and 'method' in state:
+        return state['method'], state['epoch'], state['model'], state
+    method = os.path.basename(path).split('_')[0]
+    if method not in METHODS:
+        raise ValueError(f'Cannot tell the method of {path} from its name, expected {{method}}_{{timestart}}.pt with a method among {METHODS}.')
+    return method, None, state, None
+
+def model_config(method, weights):
+    """Embedding sizes, number of filters (ConvKB) and scalar share (ANALOGY) of `src.train.build_model`, from the shapes of the weights."""
+    if method == 'ANALOGY':
+        scalar, complex_ = weights['sc_ent_emb.weight'].shape[1], weights['re_ent_emb.weight'].shape[1]
+        return {'ent_emb_dim': scalar + complex_, 'scalar_share': (scalar + 0.5) / (scalar + complex_)} # int(dim * share) gives back scalar
+    config = {'ent_emb_dim': weights['re_ent_emb.weight' if method == 'ComplEx' else 'ent_emb.weight'].shape[1]}
+    if 'rel_emb.weight' in weights:
+        config['rel_emb_dim'] = weights['rel_emb.weight'].shape[1]
+    if method == 'ConvKB':
+        config['n_filters'] = weights['convlayer.0.weight'].shape[0]
+    return config
+
+def evaluate_checkpoint(index, path, config, log_dir, n_threads):
+    """
+    Load a checkpoint and evaluate it on the shared test graph with `src.train.evaluate_emb_model`. Logs go to {log_dir}/checkpoint_{index}.log.
+
+    Returns
+    -------
+    dict
+        A row of the comparison table.
+    """
+    from src.train import build_model, evaluate_emb_model
+
+    torch.set_num_threads(n_threads)
+    logger = logging.getLogger(f'evaluate.checkpoint_{index}')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(os.path.join(log_dir, f'checkpoint_{index}.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+    method, epoch, weights, _ = _loaded[path] if path in _loaded else load_state(path)
+    hyperparameters = model_config(method, weights)
+    emb_model = build_model(method, {**config, **hyperparameters}, _kg_test.n_ent, _kg_test.n_rel)
+    try:
+        emb_model.load_state_dict(weights)
+    except RuntimeError as e:
+        raise ValueError(f'{path} does not fit the graph ({_kg_test.n_ent} entities, {_kg_test.n_rel} relations): {e}') from e
+    logger.info(f'{dt.now()} - {path}: {method} {hyperparameters}')
+
+    t1 = time()
+    evaluator = evaluate_emb_model(emb_model, _kg_test, config['eval_task'], torch.device('cpu'), logger, b_size=config['b_size'],
+                                   eval_memory=config['eval_memory'], eval_mode=config['eval_mode'], eval_candidates=config['eval_candidates'],
+                                   eval_typed=config['eval_typed'], eval_undirected=config['eval_undirected'], eval_types=config['eval_types'])
+    row = {'checkpoint': path, 'method': method, 'epoch': epoch, **hyperparameters, 'eval_time': time() - t1, **overall(evaluator)}
+    logger.removeHandler(handler)
+    handler.close()
+    return row
+
+def evaluate(checkpoints, dataset, config, split_file=None, n_eval=None, n_workers=1, output=None):
+    """
+    Evaluate several checkpoints of models trained on the same split, ex: the best and latest checkpoints of runs, or the
+    models saved by --save_model. The graph is loaded, and the test graph with its filter index built, once. Checkpoints
+    are then evaluated in `n_workers` forked processes sharing them read-only, and gathered in one table.
+
+    Parameters
+    ----------
+    checkpoints : list of str
+        .ckpt or .pt files (see `load_state`).
+    dataset : str
+        Space separated triple file or integer-encoded dataset directory the models were trained on.
+    config : dict
+        Evaluation arguments of `src.train.evaluate_emb_model` (eval_task, b_size, eval_memory, eval_mode...), and the
+        dissimilarity_type of TransE and TorusE, which checkpoints do not hold.
+    split_file : str, optional
+        Split indices (.npz) of the models (see src.split.save_split). Defaults to the split stored in the first .ckpt checkpoint
+        holding one. State dicts (.pt) hold no split and are not loaded to look for it.
+    n_eval : int, optional
+        Evaluate a random subset of this many test triples, the same for all checkpoints.
+    output : str, optional
+        Path of the comparison table (.csv). Defaults to models/evaluate_{timestart}.csv.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per checkpoint, sorted by filtered MRR.
+    """
+    global _kg_test
+    timestart = dt.now().strftime("%Y-%m-%d_%H-%M-%S")
+    kg = load_dataset(dataset)
+    if split_file:
+        test_idx = load_split(split_file, kg)[2]
+    else:
+        state = None
+        for path in (path for path in checkpoints if path.endswith('.ckpt')):
+            _loaded[path] = load_state(path)
+            if _loaded[path][3] is not None and _loaded[path][3]['split'] is not None:
+                state = _loaded[path][3]
+                break
+        if state is None:
+            raise ValueError('No split to evaluate on: pass the split file the models were trained with (see --split_file of main.py).')
+        test_idx = checkpoint_split(state, kg)[2]
+    if n_eval is not None:
+        test_idx = test_idx[torch.randperm(len(test_idx), generator=torch.Generator().manual_seed(0))[:n_eval]]
+    _kg_test = subgraph(kg, test_idx) # Shares the filter dictionaries of kg
+    gc.freeze() # Keeps the garbage collector of the workers from writing to the shared objects, which would copy their pages
+
+    log_dir = f'logs/evaluate_{timestart}'
+    os.makedirs(log_dir, exist_ok=True)
+    n_workers = max(1, min(n_workers, len(checkpoints)))
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    print(f'{len(checkpoints)} checkpoints, {_kg_test.n_facts} test triples, {n_workers} workers, logs in {log_dir}')
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('fork')) as executor:
+        futures = [executor.submit(evaluate_checkpoint, index, path, config, log_dir, n_threads) for index, path in enumerate(checkpoints)]
+        for future in as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            print(f'{dt.now()} - {row["checkpoint"]} evaluated in {row["eval_time"]:.1f}s, filt. MRR: {row["filt. MRR"]:.4f} ({len(rows)}/{len(checkpoints)})')
+    gc.unfreeze()
+    _loaded.clear()
+
+    results = pd.DataFrame(rows).sort_values('filt. MRR', ascending=False).reset_index(drop=True)
+    output = output or f'models/evaluate_{timestart}.csv'
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    results.to_csv(output, index=False)
+    print(results.to_string())
+    print(f'Results saved to {output}')
+    return results
+
+if __name__ == '__main__':
+    # ex: python -m src.evaluate --dataset toy-example --split_file models/TransE_[timestart]_split.npz --checkpoints models/*.pt models/checkpoints/*.ckpt
+    parser = argparse.ArgumentParser(description='Evaluate several checkpoints on the same test set and compare them')
+    parser.add_argument('--checkpoints', nargs='+', required=True, help='.ckpt checkpoints or .pt models saved by --save_model')
+    parser.add_argument('--dataset', required=True, help='Triple file or integer-encoded dataset directory the models were trained on. "toy-example" for the debug dataset.')
+    parser.add_argument('--split_file', default=None, help='Split indices (.npz) of the models. Defaults to the split stored in the .ckpt checkpoints')
+    parser.add_argument('--n_eval', default=None, type=int, help='Number of test triples evaluated. Defaults to all')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of checkpoints evaluated in parallel')
+    parser.add_argument('--output', default=None, help='Comparison table (.csv). Defaults to models/evaluate_{timestart}.csv')
+
+    # Evaluation arguments, see main.py
+    parser.add_argument('--eval_task', default='link-prediction', help='One of "link-prediction", "relation-prediction"')
+    parser.add_argument('--b_size', default=264, type=int, help='Number of test triples scored at once')
+    parser.add_argument('--eval_memory', default=EVAL_MEMORY, type=float, help='Approximate memory (MiB) of the candidate scores of a worker')
+    parser.add_argument('--eval_mode', default='full', choices=['full', 'sampled'], help='Link prediction against all entities ("full") or sampled negatives ("sampled")')
+    parser.add_argument('--eval_candidates', default=100, type=int, help='Negatives per test triple with --eval_mode sampled')
+    parser.add_argument('--eval_typed', action='store_true', help='Draw the sampled negatives of a relation among its heads or tails')
+    parser.add_argument('--eval_undirected', action='store_true', help='Relation prediction: also score relations from tail to head')
+    parser.add_argument('--eval_types', default='prefix', choices=['prefix', 'rdf:type'], help='Entity types of the logged per-type metrics, "prefix" or "rdf:type"')
+    parser.add_argument('--dissimilarity_type', default='L1', help='Dissimilarity of the TransE and TorusE models (not stored in checkpoints)')
+    args = vars(parser.parse_args())
+
+    dataset = 'data/raw/toy-example.txt' if args['dataset'] == 'toy-example' else args['dataset']
+    run = {key: args.pop(key) for key in ['checkpoints', 'dataset', 'split_file', 'n_eval', 'workers', 'output']}
+    evaluate(run['checkpoints'], dataset, args, split_file=run['split_file'], n_eval=run['n_eval'], n_workers=run['workers'], output=run['output'])
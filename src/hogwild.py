@@ -0,0 +1,155 @@
+import queue
+from time import time
+
+import torch
+import torch.multiprocessing as mp
+
+from src.pipeline import BatchPipeline
+from src.split import subgraph
+
+
+def _work(rank, emb_model, shard, sampler, make_optimizer, step, batch_size, n_threads, commands, results):
+    """Training worker: one pass over its shard for each command received, until it receives None."""
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(torch.initial_seed() + rank + 1) # Forked workers would otherwise draw the same negatives
+    optimizer = make_optimizer(emb_model)
+    batches = BatchPipeline(shard, sampler, batch_size, 'cpu', n_workers=0)
+    while commands.get() is not None:
+        try:
+            running_loss = sum(step(emb_model, optimizer, batch) for batch in batches)
+            results.put((running_loss, len(batches)))
+        except Exception as e:
+            results.put(e)
+
+
+class HogwildPool:
+    """
+    Hogwild data-parallel training on CPU: worker processes share the parameters of `emb_model` in shared memory
+    and update them without locks, each with its own optimizer and negative sampling, over its own shard of the triples.
+    Embedding updates of a batch only touch a few rows, so conflicting updates are rare.
+
+    Parameters
+    ----------
+    emb_model : torchkge.models.xxx
+        The model to train. Its parameters are moved to shared memory, `state_dict` and evaluation work as usual.
+    kg : torchkge.data_structures.KnowledgeGraph
+        The training knowledge graph, split in `n_workers` random shards.
+    sampler : torchkge.sampling.NegativeSampler
+        The negative sampler, ex: BernoulliNegativeSampler(kg).
+    n_workers : int
+        Number of worker processes.
+    make_optimizer : callable
+        Builds the optimizer of a worker from the model.
+    step : callable
+        step(emb_model, optimizer, batch) performs a training step on a batch (h, t, r, n_h, n_t) and returns its loss.
+    batch_size : int
+        Number of positive triples per batch.
+    """
+    def __init__(self, emb_model, kg, sampler, n_workers, make_optimizer, step, batch_size):
+        self.emb_model = emb_model.share_memory()
+        ctx = mp.get_context('fork') # Workers inherit the model, the graph and the callables without pickling them
+        n_threads = max(1, torch.get_num_threads() // n_workers)
+        self.commands = [ctx.SimpleQueue() for _ in range(n_workers)]
+        self.results = ctx.Queue()
+        self.workers = []
+        for rank, shard in enumerate(torch.randperm(kg.n_facts).chunk(n_workers)):
+            worker = ctx.Process(target=_work, args=(rank, emb_model, subgraph(kg, shard.sort().values), sampler, make_optimizer, step,
+                                                     batch_size, n_threads, self.commands[rank], self.results), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def run_epoch(self):
+        """
+        Train each worker over its shard once.
+
+        Returns
+        -------
+        running_loss : float
+            Sum of the batch losses of all workers.
+        n_batches : int
+            Number of batches of all workers.
+        """
+        for commands in self.commands:
+            commands.put('epoch')
+        running_loss, n_batches = 0.0, 0
+        for _ in self.workers:
+            while True:
+                try:
+                    result = self.results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        raise RuntimeError('A training worker died.')
+            if isinstance(result, Exception):
+                raise result
+            running_loss += result[0]
+            n_batches += result[1]
+        return running_loss, n_batches
+
+    def normalize_parameters(self):
+        """
+        `emb_model.normalize_parameters`, written back in place: torchkge models assign new tensors to .data,
+        which would detach the parameters from the memory shared with the workers.
+        """
+        shared = [p.data for p in self.emb_model.parameters()]
+        self.emb_model.normalize_parameters()
+        for p, data in zip(self.emb_model.parameters(), shared):
+            if p.data.data_ptr() != data.data_ptr():
+                data.copy_(p.data)
+                p.data = data
+
+    def close(self):
+        for commands in self.commands:
+            commands.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def benchmark(dataset, method, workers, dim=50, batch_size=512, lr=0.0001):
+    """
+    Train one epoch of `method` with each number of workers and print throughput and scaling efficiency,
+    the throughput with N workers divided by N times the throughput with one worker, which is always measured first.
+    """
+    from torch.optim import Adam
+    from torchkge.sampling import BernoulliNegativeSampler
+    from torchkge.utils import MarginLoss
+    from src.benchmarks import bench_model_config
+    from src.dataset import load_dataset
+    from src.train import build_model
+
+    kg = load_dataset(dataset)
+    sampler = BernoulliNegativeSampler(kg)
+    criterion = MarginLoss(margin=1)
+    config = bench_model_config(dim)
+
+    def step(emb_model, optimizer, batch):
+        optimizer.zero_grad()
+        pos, neg = emb_model(*batch)
+        loss = criterion(pos, neg)
+        loss.backward()
+        optimizer.step()
+        return loss.item()
+
+    print(f'{torch.get_num_threads()} threads available')
+    print(f'{"workers":<9}{"epoch (s)":>10}{"triples/s":>12}{"efficiency":>12}{"mean loss":>11}')
+    base = None
+    for n_workers in [1] + [n for n in workers if n != 1]: # The 1-worker run is the baseline of the efficiency
+        torch.manual_seed(0)
+        emb_model = build_model(method, config, kg.n_ent, kg.n_rel)
+        pool = HogwildPool(emb_model, kg, sampler, n_workers, lambda m: Adam(m.parameters(), lr=lr), step, batch_size)
+        t1 = time()
+        running_loss, n_batches = pool.run_epoch()
+        elapsed = time() - t1
+        pool.close()
+        speed = kg.n_facts / elapsed
+        base = base or speed
+        print(f'{n_workers:<9}{elapsed:>10.2f}{speed:>12.0f}{speed / (n_workers * base):>12.2f}{running_loss / n_batches:>11.4f}')
+
+if __name__ == '__main__':
+    # Scaling of Hogwild training, ex: python -m src.hogwild data/raw/toy-example.txt TransE --workers 1 2 4 8
+    from src.benchmarks import bench_parser
+    parser = bench_parser('Benchmark Hogwild training throughput per number of workers', methods=False)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Numbers of workers to compare')
+    parser.add_argument('--batch_size', type=int, default=512, help='Batch size')
+    args = parser.parse_args()
+    benchmark(args.dataset, args.method, args.workers, dim=args.dim, batch_size=args.batch_size)
@@ -0,0 +1,325 @@
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import tracemalloc
+import urllib.parse
+import urllib.request
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime as dt
+from time import time, sleep
+
+from SPARQLWrapper import SPARQLWrapper, JSON
+
+SPARQL_ENDPOINT = "http://cedre-14a.med.univ-rennes1.fr:3030/WS287-rdf/sparql"
+
+# One N-Triples statement: subject (IRI or blank node), predicate (IRI), object (IRI, blank node or literal)
+NT_LINE = re.compile(r'\s*(?:<([^>]*)>|_:(\S+))\s+<([^>]*)>\s+(?:<([^>]*)>|_:(\S+)|"((?:[^"\\]|\\.)*)"(?:@[\w-]+|\^\^<[^>]*>)?)\s*\.\s*$')
+NT_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+NT_CHARS = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+CONSTRUCT_TEMPLATE = re.compile(r'CONSTRUCT\s*\{(.*?)\}', re.IGNORECASE | re.DOTALL)
+VARIABLE = re.compile(r'[?$]\w+')
+ORDER_BY = re.compile(r'\bORDER\s+BY\b', re.IGNORECASE)
+
+
+def paginate(query, page_size, page):
+    """
+    Append LIMIT/OFFSET solution modifiers to a CONSTRUCT query to fetch a single page of it.
+    SPARQL does not guarantee the same order of solutions between requests, so unless the query has its own ORDER BY,
+    solutions are ordered by the variables of the CONSTRUCT template. Solutions tied on all of them build the same triples,
+    so that pages neither overlap nor skip triples. A query without template variables relies on the endpoint returning a stable order.
+    """
+    if not ORDER_BY.search(query):
+        template = CONSTRUCT_TEMPLATE.search(query)
+        variables = list(dict.fromkeys(VARIABLE.findall(template.group(1)))) if template else []
+        if variables:
+            query = f"{query}\nORDER BY {' '.join(variables)}"
+    return f"{query}\nLIMIT {page_size}\nOFFSET {page * page_size}"
+
+def write_triples(results, f, sep):
+    """
+    Write the triples of a converted CONSTRUCT result to an open file.
+
+    Parameters
+    ----------
+    results : rdflib.Graph
+        The converted result of a CONSTRUCT query.
+    f : file object
+        File the triples are written to, one triple per line.
+    sep : str
+        Separator between the head, relation and tail of a triple.
+
+    Returns
+    -------
+    int
+        The number of triples written.
+    """
+    n_triples = 0
+    for s, p, o in results:
+        if any(x.toPython() == '' for x in (s, p, o)): # Checks if the triple is complete
+            continue
+        f.write(f'{s}{sep}{p}{sep}{o}\n')
+        n_triples += 1
+    return n_triples
+
+def _unescape(match):
+    code = match.group(1) or match.group(2)
+    return chr(int(code, 16)) if code else NT_CHARS.get(match.group(3), match.group(3))
+
+def parse_ntriples(lines, f, sep, with_received=False):
+    """
+    Incrementally parse N-Triples and write the triples to an open file as they are read.
+    Terms are written the same way as `write_triples` does: IRIs and literals by their value, without datatype or language tag.
+    Literals keep the lexical form sent by the endpoint, whereas rdflib normalizes some typed literals (ex: "1.50"^^xsd:double to 1.5).
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of an N-Triples document, as str or bytes. Can be an HTTP response or an open file.
+    f : file object
+        File the triples are written to, one triple per line.
+    sep : str
+        Separator between the head, relation and tail of a triple.
+    with_received : bool
+        Whether to also return the number of triples received, incomplete ones included.
+
+    Returns
+    -------
+    int / (int, int)
+        The number of triples written, and the number of triples received if `with_received` is set.
+    """
+    n_triples, n_received = 0, 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        match = NT_LINE.match(line)
+        if match is None:
+            raise ValueError(f'Malformed N-Triples line: {line!r}')
+        n_received += 1
+        s_iri, s_bnode, p, o_iri, o_bnode, o_lit = match.groups()
+        s = s_iri if s_iri is not None else s_bnode
+        if o_iri is not None:
+            o = o_iri
+        elif o_bnode is not None:
+            o = o_bnode
+        else:
+            o = NT_ESCAPE.sub(_unescape, o_lit) if '\\' in o_lit else o_lit
+        if '' in (s, p, o): # Checks if the triple is complete
+            continue
+        f.write(f'{s}{sep}{p}{sep}{o}\n')
+        n_triples += 1
+    return (n_triples, n_received) if with_received else n_triples
+
+def stream_query(query, f, sep, endpoint=SPARQL_ENDPOINT, timeout=None, with_received=False):
+    """
+    Send a CONSTRUCT query asking for an N-Triples response, and parse it while it is being received.
+    Memory use is bounded by the length of a line, whatever the size of the result.
+
+    Returns
+    -------
+    int / (int, int)
+        The number of triples written, and the number of triples received if `with_received` is set (see `parse_ntriples`).
+    """
+    data = urllib.parse.urlencode({'query': query}).encode()
+    request = urllib.request.Request(endpoint, data=data, headers={'Accept': 'application/n-triples',
+                                                                    'Content-Type': 'application/x-www-form-urlencoded'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return parse_ntriples(response, f, sep, with_received=with_received)
+
+def _with_retries(func, max_retries, backoff):
+    """Call `func` until it succeeds, at most `max_retries` times, doubling the delay between attempts."""
+    for attempt in range(max_retries):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries - 1:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f'{dt.now()} - Request failed ({e}). Retrying in {delay:.1f}s..')
+            sleep(delay)
+
+def fetch_page(query, path, sep, endpoint=SPARQL_ENDPOINT, max_retries=5, backoff=1.0, ntriples=False):
+    """
+    Fetch a single page of a CONSTRUCT query and write its triples to `path`.
+    Failed requests are retried with an exponential backoff.
+
+    Parameters
+    ----------
+    query : str
+        The paginated SPARQL query.
+    path : str
+        File in which the triples of the page are stored.
+    sep : str
+        Separator between the head, relation and tail of a triple.
+    endpoint : str
+        URL of the SPARQL endpoint.
+    max_retries : int
+        Number of attempts before giving up on the page.
+    backoff : float
+        Delay in seconds before the first retry. Doubled after each failed attempt.
+    ntriples : bool
+        Whether to request an N-Triples response and stream it to `path` (see `stream_query`)
+        instead of converting a JSON response to an in-memory graph.
+
+    Returns
+    -------
+    (int, int)
+        The number of triples written and the number of triples the endpoint returned, incomplete ones included.
+        No triple returned means the query is exhausted.
+    """
+    if ntriples:
+        def stream():
+            with open(path, 'w') as f: # Truncates what a failed attempt may have written
+                return stream_query(query, f, sep, endpoint, with_received=True)
+        return _with_retries(stream, max_retries, backoff)
+
+    sparql = SPARQLWrapper(endpoint) # One wrapper per request, SPARQLWrapper instances are not thread-safe
+    sparql.setQuery(query)
+    sparql.setReturnFormat(JSON)
+    results = _with_retries(lambda: sparql.query().convert(), max_retries, backoff)
+
+    try:
+        with open(path, 'w') as f:
+            return write_triples(results, f, sep), len(results)
+    except Exception:
+        raise Exception("Check that the query output is a triple like ?s ?p ?o. Reminder: You must use a CONSTRUCT query")
+
+def ingest(queries, sep, output='query_result.txt', endpoint=SPARQL_ENDPOINT, page_size=10000, n_workers=4, max_retries=5, backoff=1.0, ntriples=False):
+    """
+    Concurrent, paginated counterpart of `src.utils.query_db`.
+    Each query is split into LIMIT/OFFSET pages which are fetched by a bounded pool of threads, across all queries at once.
+    Every page is streamed to its own part file as soon as it is received, so that no full query result is ever held in memory.
+    Part files are then concatenated in query and page order into `output`, or into one file per keyword if `output` is a dict.
+
+    A query is considered exhausted once the endpoint returns no triple for one of its pages (see `paginate` for their order).
+    A page whose triples are all incomplete does not end its query. Up to `n_workers` pages
+    of a query are in flight at the same time, which means a few empty pages are requested past the end of each query.
+
+    Parameters
+    ----------
+    queries : dict
+        Mapping of keywords to their SPARQL CONSTRUCT query (prefixes included).
+    sep : str
+        Separator between the head, relation and tail of a triple.
+    output : str / dict
+        File the triples are appended to. Can also be a dict mapping each keyword to its own file.
+    endpoint : str
+        URL of the SPARQL endpoint.
+    page_size : int
+        Number of solutions requested per page.
+    n_workers : int
+        Number of pages fetched concurrently.
+    max_retries : int
+        Number of attempts per page before giving up.
+    backoff : float
+        Delay in seconds before the first retry of a page.
+    ntriples : bool
+        Whether pages are requested as N-Triples and parsed while being received.
+
+    Returns
+    -------
+    dict
+        Per-keyword statistics: number of pages, number of triples, elapsed time and throughput (triples/s).
+    """
+    warnings.filterwarnings("ignore")
+    outputs = output if isinstance(output, dict) else {keyword: output for keyword in queries}
+    tmpdir = tempfile.mkdtemp(prefix='ingest_', dir=os.path.dirname(os.path.abspath(outputs[next(iter(queries))])))
+    stats = {keyword: {'pages': 0, 'triples': 0, 'start': time(), 'end': None} for keyword in queries}
+    next_page = {keyword: 0 for keyword in queries}
+    last_page = {keyword: None for keyword in queries} # First empty page of each query, once known
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pending = {}
+
+            def submit(keyword):
+                page = next_page[keyword]
+                next_page[keyword] += 1
+                path = os.path.join(tmpdir, f'{list(queries).index(keyword):03d}_{page:08d}.txt')
+                future = executor.submit(fetch_page, paginate(queries[keyword], page_size, page), path, sep,
+                                         endpoint, max_retries, backoff, ntriples)
+                pending[future] = (keyword, page)
+
+            # Prime the pool with a window of pages for every query
+            for keyword in queries:
+                for _ in range(n_workers):
+                    submit(keyword)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    keyword, page = pending.pop(future)
+                    n_triples, n_received = future.result()
+                    if n_received == 0:
+                        if last_page[keyword] is None or page < last_page[keyword]:
+                            last_page[keyword] = page
+                    else:
+                        stats[keyword]['pages'] += 1
+                        stats[keyword]['triples'] += n_triples
+                        if last_page[keyword] is None:
+                            submit(keyword) # Keep the window full until the end of the query is reached
+
+                    if last_page[keyword] is not None and not any(k == keyword for k, _ in pending.values()):
+                        stats[keyword]['end'] = time()
+                        print(_format_stats(keyword, stats[keyword]))
+
+        # Merge the part files in order. Pages past the first empty one are ignored.
+        for i, keyword in enumerate(queries):
+            with open(outputs[keyword], 'a') as out:
+                for page in range(last_page[keyword]):
+                    with open(os.path.join(tmpdir, f'{i:03d}_{page:08d}.txt'), 'r') as part:
+                        shutil.copyfileobj(part, out)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for keyword in stats:
+        stats[keyword]['elapsed'] = stats[keyword].pop('end') - stats[keyword].pop('start')
+        stats[keyword]['triples_per_s'] = stats[keyword]['triples'] / max(stats[keyword]['elapsed'], 1e-9)
+    print(f'{dt.now()} - Query executed !')
+    return stats
+
+def _format_stats(keyword, stats):
+    elapsed = stats['end'] - stats['start']
+    return f"{dt.now()} - {keyword}: {stats['triples']} triples in {stats['pages']} pages, " \
+           f"{elapsed:.2f}s ({stats['triples'] / max(elapsed, 1e-9):.0f} triples/s)"
+
+def benchmark(recording, sep=' '):
+    """
+    Compare the JSON/rdflib path of `query_db` with the streaming N-Triples parser on a recorded CONSTRUCT response.
+    The recording is an N-Triples file, ex: saved with
+        curl -H 'Accept: application/n-triples' --data-urlencode query@q.rq <endpoint> > recording.nt
+    Both paths write their output to /dev/null. Prints wall time, throughput and peak traced memory of each path.
+    """
+    from rdflib import Graph
+
+    def graph_path():
+        graph = Graph()
+        with open(recording, 'rb') as f:
+            graph.parse(f, format='nt') # Whole result materialized as an rdflib graph, like results.convert()
+        with open(os.devnull, 'w') as out:
+            return write_triples(graph, out, sep)
+
+    def streaming_path():
+        with open(recording, 'rb') as f, open(os.devnull, 'w') as out:
+            return parse_ntriples(f, out, sep)
+
+    for name, func in [('rdflib graph', graph_path), ('streaming N-Triples', streaming_path)]:
+        tracemalloc.start()
+        t1 = time()
+        n_triples = func()
+        elapsed = time() - t1
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:<20} {n_triples} triples in {elapsed:.2f}s ({n_triples / max(elapsed, 1e-9):.0f} triples/s), peak memory {peak / 2**20:.1f} MiB')
+
+if __name__ == '__main__':
+    # Benchmark parsing paths on a recorded response, ex: python -m src.ingest recording.nt
+    parser = argparse.ArgumentParser(description='Benchmark CONSTRUCT result parsing on a recorded N-Triples response')
+    parser.add_argument('recording', type=str, help='N-Triples file')
+    args = parser.parse_args()
+    benchmark(args.recording)
@@ -0,0 +1,222 @@
+import copy
+from time import time
+
+import torch
+from torch.optim import Adam
+
+from torchkge.evaluation import LinkPredictionEvaluator
+from torchkge.sampling import BernoulliNegativeSampler
+from torchkge.utils import MarginLoss
+
+NEG_SAMPLERS = ['bernoulli', 'adversarial', 'cached']
+
+
+def triple_keys(kg):
+    """Sorted int64 keys of the triples of `kg`, to test membership of candidate triples with `is_known`."""
+    return torch.sort((kg.head_idx * kg.n_rel + kg.relations) * kg.n_ent + kg.tail_idx).values
+
+def is_known(keys, heads, tails, relations, n_ent, n_rel):
+    """Mask of the (heads, tails, relations) triples, of any broadcastable shapes, that are in `keys`."""
+    query = (heads * n_rel + relations) * n_ent + tails
+    pos = torch.searchsorted(keys, query).clamp(max=len(keys) - 1)
+    return keys[pos] == query
+
+def model_device(emb_model):
+    return next(emb_model.parameters()).device
+
+
+class SelfAdversarialSampler(BernoulliNegativeSampler):
+    """
+    Self-adversarial negative sampling (after Sun et al., 2019, RotatE). For each positive triple, `n_candidates` Bernoulli
+    negatives are scored by the model being trained, and one of them is drawn with probability softmax(temperature * score),
+    so that the negatives the model finds plausible are drawn more often. Sampling by these weights, rather than weighting
+    the loss of every candidate, works with all torchkge losses. Candidates that are known training triples are never drawn.
+
+    Parameters
+    ----------
+    kg : torchkge.data_structures.KnowledgeGraph
+        The training knowledge graph.
+    emb_model : torchkge.models.xxx
+        The model being trained. Candidates are scored on its device without gradients.
+    n_candidates : int
+        Number of candidates scored per positive triple.
+    temperature : float
+        Inverse temperature of the softmax. 0 draws uniformly among candidates, like BernoulliNegativeSampler.
+    """
+    def __init__(self, kg, emb_model, n_candidates=32, temperature=1.0):
+        super().__init__(kg)
+        self.emb_model = emb_model
+        self.n_candidates = n_candidates
+        self.temperature = temperature
+        self.keys = triple_keys(kg)
+
+    def corrupt_batch(self, heads, tails, relations, n_neg=None):
+        k, b_size = self.n_candidates, heads.shape[0]
+        n_h, n_t = super().corrupt_batch(heads, tails, relations, n_neg=k) # (k * b_size), candidate i of triple j at i * b_size + j
+        r = relations.repeat(k)
+        device = model_device(self.emb_model)
+        with torch.no_grad():
+            scores = self.emb_model.scoring_function(n_h.to(device), n_t.to(device), r.to(device)).float().cpu().view(k, b_size)
+        logits = (self.temperature * scores).masked_fill(is_known(self.keys, n_h, n_t, r, self.n_ent, self.kg.n_rel).view(k, b_size),
+                                                         torch.finfo(scores.dtype).min)
+        choice = torch.multinomial(torch.softmax(logits.t(), dim=1), 1).squeeze(1) * b_size + torch.arange(b_size)
+        return n_h[choice], n_t[choice]
+
+
+class CachedHardSampler(BernoulliNegativeSampler):
+    """
+    Cache of hard negatives (after Zhang et al., 2019, NSCaching). Each (head, relation) pair of the training set holds a cache
+    of `cache_size` candidate tails, and each (tail, relation) pair a cache of candidate heads. A triple is corrupted by
+    replacing its head or tail (Bernoulli choice) by an entry of the matching cache drawn uniformly. `refresh` scores each
+    cache along with `n_candidates` new random entities and keeps `cache_size` of them drawn by softmax(temperature * score),
+    so that the caches follow the negatives the model currently finds plausible. Caches start uniformly random.
+
+    Parameters
+    ----------
+    kg : torchkge.data_structures.KnowledgeGraph
+        The training knowledge graph.
+    emb_model : torchkge.models.xxx
+        The model being trained.
+    cache_size : int
+        Number of candidates cached per (entity, relation) pair.
+    n_candidates : int
+        Number of new random candidates scored per pair at each refresh.
+    temperature : float
+        Inverse temperature of the softmax.
+    """
+    def __init__(self, kg, emb_model, cache_size=32, n_candidates=32, temperature=1.0):
+        super().__init__(kg)
+        self.emb_model = emb_model
+        self.cache_size = cache_size
+        self.n_candidates = n_candidates
+        self.temperature = temperature
+        self.keys = triple_keys(kg)
+        self.hr_keys = torch.unique(kg.head_idx * kg.n_rel + kg.relations) # Sorted
+        self.tr_keys = torch.unique(kg.tail_idx * kg.n_rel + kg.relations)
+        # In shared memory, so that refreshes reach Hogwild workers (see src.hogwild)
+        self.tail_cache = torch.randint(0, self.n_ent, (len(self.hr_keys), cache_size)).share_memory_()
+        self.head_cache = torch.randint(0, self.n_ent, (len(self.tr_keys), cache_size)).share_memory_()
+
+    def corrupt_batch(self, heads, tails, relations, n_neg=None):
+        corrupt_heads = torch.bernoulli(self.bern_probs[relations.cpu()]).bool()
+        h, t, r = heads.cpu(), tails.cpu(), relations.cpu()
+        col = torch.randint(0, self.cache_size, h.shape)
+        n_t = self.tail_cache[torch.searchsorted(self.hr_keys, h * self.kg.n_rel + r), col]
+        n_h = self.head_cache[torch.searchsorted(self.tr_keys, t * self.kg.n_rel + r), col]
+        return torch.where(corrupt_heads, n_h, h).to(heads.device), torch.where(corrupt_heads, t, n_t).to(heads.device)
+
+    def refresh(self, chunk_size=4096):
+        """Resample both caches from their current entries and new random candidates, scored by the current model."""
+        n_rel, device = self.kg.n_rel, model_device(self.emb_model)
+        for cache, keys, corrupt_heads in ((self.tail_cache, self.hr_keys, False), (self.head_cache, self.tr_keys, True)):
+            for start in range(0, len(keys), chunk_size):
+                ent, rel = keys[start:start + chunk_size] // n_rel, keys[start:start + chunk_size] % n_rel
+                candidates = torch.cat((cache[start:start + chunk_size], torch.randint(0, self.n_ent, (len(ent), self.n_candidates))), dim=1)
+                ent, rel = ent.unsqueeze(1).expand_as(candidates), rel.unsqueeze(1).expand_as(candidates)
+                h, t = (candidates, ent) if corrupt_heads else (ent, candidates)
+                with torch.no_grad():
+                    scores = self.emb_model.scoring_function(h.reshape(-1).to(device), t.reshape(-1).to(device), rel.reshape(-1).to(device))
+                scores = scores.float().cpu().view(candidates.shape)
+                known = is_known(self.keys, h, t, rel, self.n_ent, n_rel)
+                probs = torch.softmax((self.temperature * scores).masked_fill(known, torch.finfo(scores.dtype).min), dim=1)
+                keep = torch.empty(len(ent), self.cache_size, dtype=torch.long)
+                # Pairs with fewer allowed candidates than cache slots (dense pairs, small graphs) draw them with replacement
+                few = (~known).sum(dim=1) < self.cache_size
+                if (~few).any():
+                    keep[~few] = torch.multinomial(probs[~few], self.cache_size)
+                if few.any():
+                    keep[few] = torch.multinomial(probs[few], self.cache_size, replacement=True)
+                cache[start:start + chunk_size] = candidates.gather(1, keep)
+
+
+def make_sampler(kind, kg, emb_model, config):
+    """
+    Negative sampler of the training loop.
+
+    Parameters
+    ----------
+    kind : str
+        One of NEG_SAMPLERS: bernoulli (torchkge's BernoulliNegativeSampler), adversarial (SelfAdversarialSampler)
+        or cached (CachedHardSampler).
+    kg : torchkge.data_structures.KnowledgeGraph
+        The knowledge graph negatives are drawn for.
+    emb_model : torchkge.models.xxx
+        The model scoring candidates.
+    config : dict
+        CLI arguments: neg_candidates, neg_cache_size and neg_temperature.
+    """
+    match kind:
+        case 'bernoulli':
+            return BernoulliNegativeSampler(kg)
+        case 'adversarial':
+            return SelfAdversarialSampler(kg, emb_model, n_candidates=config.get('neg_candidates', 32), temperature=config.get('neg_temperature', 1.0))
+        case 'cached':
+            return CachedHardSampler(kg, emb_model, cache_size=config.get('neg_cache_size', 32), n_candidates=config.get('neg_candidates', 32),
+                                     temperature=config.get('neg_temperature', 1.0))
+        case _:
+            raise ValueError(f'Negative sampler {kind} not supported. One of {NEG_SAMPLERS}.')
+
+def benchmark(dataset, method, samplers, target_mrr, dim=50, n_epochs=30, batch_size=512, lr=0.001, eval_every=1, n_eval=1000, seed=0):
+    """
+    Train `method` from the same initialization with each negative sampler, evaluate the filtered MRR of tail and head prediction
+    on a sample of test triples every `eval_every` epochs, and print the first epoch reaching `target_mrr` and the training time
+    spent to reach it, sampling and cache refreshes included.
+    """
+    from src.benchmarks import bench_model_config
+    from src.dataset import load_dataset
+    from src.split import split_indices, subgraph
+    from src.train import build_model
+
+    kg = load_dataset(dataset)
+    train_idx, _, test_idx = split_indices(kg, share=0.8, seed=seed)
+    kg_train = subgraph(kg, train_idx)
+    kg_eval = subgraph(kg, test_idx[torch.randperm(len(test_idx), generator=torch.Generator().manual_seed(seed))[:n_eval]])
+    config = bench_model_config(dim)
+    criterion = MarginLoss(margin=1)
+    torch.manual_seed(seed)
+    init = build_model(method, config, kg.n_ent, kg.n_rel)
+
+    print(f'{"sampler":<13}{"epochs to target":>17}{"time to target (s)":>20}{"best MRR":>10}{"epoch time (s)":>16}')
+    for kind in samplers:
+        emb_model = copy.deepcopy(init)
+        optimizer = Adam(emb_model.parameters(), lr=lr)
+        sampler = make_sampler(kind, kg_train, emb_model, {})
+        torch.manual_seed(seed)
+        reached, elapsed, best = None, 0.0, 0.0
+        for epoch in range(n_epochs):
+            t1 = time()
+            for idx in torch.randperm(kg_train.n_facts).split(batch_size):
+                h, t, r = kg_train.head_idx[idx], kg_train.tail_idx[idx], kg_train.relations[idx]
+                n_h, n_t = sampler.corrupt_batch(h, t, r)
+                optimizer.zero_grad()
+                pos, neg = emb_model(h, t, r, n_h, n_t)
+                criterion(pos, neg).backward()
+                optimizer.step()
+            emb_model.normalize_parameters()
+            if hasattr(sampler, 'refresh'):
+                sampler.refresh()
+            elapsed += time() - t1
+            if (epoch + 1) % eval_every == 0:
+                evaluator = LinkPredictionEvaluator(emb_model, kg_eval)
+                evaluator.evaluate(b_size=264, verbose=False)
+                mrr = evaluator.mrr()[1]
+                best = max(best, mrr)
+                if mrr >= target_mrr:
+                    reached = epoch + 1
+                    break
+        print(f'{kind:<13}{str(reached or f">{n_epochs}"):>17}{elapsed:>20.1f}{best:>10.4f}{elapsed / (epoch + 1):>16.2f}')
+
+if __name__ == '__main__':
+    # Epochs to reach a filtered MRR per sampler, ex: python -m src.negatives data/raw/toy-example.txt TransE 0.2
+    from src.benchmarks import bench_parser
+    parser = bench_parser('Compare the convergence of negative samplers', methods=False)
+    parser.add_argument('target_mrr', type=float, help='Filtered MRR to reach')
+    parser.add_argument('--samplers', nargs='+', default=NEG_SAMPLERS, help='Samplers to compare')
+    parser.add_argument('--n_epochs', type=int, default=30, help='Maximum number of epochs')
+    parser.add_argument('--batch_size', type=int, default=512, help='Batch size')
+    parser.add_argument('--lr', type=float, default=0.001, help='Learning rate')
+    parser.add_argument('--eval_every', type=int, default=1, help='Evaluate every N epochs')
+    parser.add_argument('--n_eval', type=int, default=1000, help='Number of test triples evaluated')
+    args = parser.parse_args()
+    benchmark(args.dataset, args.method, args.samplers, args.target_mrr, dim=args.dim, n_epochs=args.n_epochs,
+              batch_size=args.batch_size, lr=args.lr, eval_every=args.eval_every, n_eval=args.n_eval)
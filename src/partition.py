@@ -0,0 +1,241 @@
+import math
+import os
+from time import time
+from resource import getrusage, RUSAGE_SELF
+
+import numpy as np
+import torch
+from torch import nn
+from torch.optim import Adagrad
+from tqdm import tqdm
+from datetime import datetime as dt
+
+from torchkge.sampling import BernoulliNegativeSampler
+
+from src.precision import autocast
+from src.sparse import make_sparse, touched_rows_penalty
+
+PARTITION_DIR = 'models/partitions'
+
+
+def entity_tables(emb_model):
+    """Names of the embedding tables of `emb_model` indexed by entity, ex: ['re_ent_emb', 'im_ent_emb'] for ComplEx. torchkge names them all *ent*."""
+    return [name for name, module in emb_model.named_children() if isinstance(module, nn.Embedding) and 'ent' in name]
+
+def n_partitions(n_ent, row_bytes, memory_budget):
+    """
+    Number of entity buckets such that two buckets (the ones of the heads and tails being trained) fit in `memory_budget`.
+
+    Parameters
+    ----------
+    n_ent : int
+        Number of entities.
+    row_bytes : int
+        Bytes held in memory per entity: its embeddings in every entity table and their optimizer state.
+    memory_budget : float
+        Memory allowed for the entity embeddings being trained, in MiB.
+    """
+    bucket_size = int(memory_budget * 2**20 // (2 * row_bytes))
+    if bucket_size < 1:
+        raise ValueError(f'A memory budget of {memory_budget} MiB cannot hold two entities ({2 * row_bytes} bytes).')
+    return max(1, math.ceil(n_ent / bucket_size))
+
+
+class PartitionedModel:
+    """
+    Embedding model whose entity tables live in memory-mapped files, trained two entity buckets at a time
+    like PyTorch-BigGraph. Entities are split in `n_parts` buckets of contiguous indices, and triples in edge buckets
+    by the buckets of their head and tail. Only the rows of the two buckets of the current edge bucket, and their
+    row-wise Adagrad state, are copied in a working model of 2 * bucket_size entities. Relation tables and other
+    parameters (ex: ConvKB layers) are small and stay in memory.
+
+    Parameters
+    ----------
+    make_model : callable
+        Builds a torchkge model for a given number of entities, ex: lambda n_ent: TransEModel(50, n_ent, n_rel).
+    n_ent : int
+        Number of entities of the graph.
+    n_parts : int
+        Number of entity buckets.
+    path : str
+        Directory of the memory-mapped tables. One {table}.npy file per entity table and one {table}_state.npy for its Adagrad state.
+    lr : float
+        Adagrad learning rate.
+    device : torch.device
+        Device of the working model.
+    """
+    def __init__(self, make_model, n_ent, n_parts, path, lr, device):
+        self.make_model = make_model
+        self.n_ent = n_ent
+        self.n_parts = n_parts
+        self.bucket_size = math.ceil(n_ent / n_parts)
+        self.path = path
+        self.device = torch.device(device)
+
+        self.working = make_sparse(make_model(2 * self.bucket_size)).to(self.device)
+        self.tables = entity_tables(self.working)
+        self.optimizer = Adagrad(self.working.parameters(), lr=lr) # Its sparse update only touches the rows of a batch, and its state is an elementwise sum of squared gradients, shaped like the table
+
+        # Entity tables, initialized like torchkge's init_embedding (Xavier uniform) on the full (n_ent, dim) table
+        os.makedirs(path, exist_ok=True)
+        self.weights, self.states = {}, {}
+        for name in self.tables:
+            dim = getattr(self.working, name).embedding_dim
+            bound = math.sqrt(6 / (n_ent + dim))
+            weight = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=np.float32, shape=(n_ent, dim))
+            for start in range(0, n_ent, self.bucket_size):
+                torch.from_numpy(weight[start:start + self.bucket_size]).uniform_(-bound, bound) # In place, in the mapped file
+            self.weights[name] = weight
+            self.states[name] = np.lib.format.open_memmap(os.path.join(path, f'{name}_state.npy'), mode='w+', dtype=np.float32, shape=(n_ent, dim))
+        self.loaded = [None, None] # Bucket held by each half of the working tables
+
+    def bounds(self, bucket):
+        start = bucket * self.bucket_size
+        return start, min(start + self.bucket_size, self.n_ent)
+
+    def swap(self, slot, bucket):
+        """Write back the rows held in `slot` (0 or 1) of the working tables, then load the rows of `bucket` in it."""
+        if self.loaded[slot] == bucket:
+            return
+        if bucket is not None and self.loaded[1 - slot] == bucket: # A bucket is only ever held by one slot
+            self.swap(1 - slot, None)
+        offset = slot * self.bucket_size
+        for name in self.tables:
+            param = getattr(self.working, name).weight
+            state = self.optimizer.state[param]['sum']
+            if self.loaded[slot] is not None:
+                start, end = self.bounds(self.loaded[slot])
+                self.weights[name][start:end] = param.data[offset:offset + end - start].cpu().numpy()
+                self.states[name][start:end] = state[offset:offset + end - start].cpu().numpy()
+            if bucket is not None:
+                start, end = self.bounds(bucket)
+                param.data[offset:offset + end - start] = torch.from_numpy(self.weights[name][start:end]).to(self.device)
+                state[offset:offset + end - start] = torch.from_numpy(self.states[name][start:end]).to(self.device)
+        self.loaded[slot] = bucket
+
+    def flush(self):
+        """Write back both halves of the working tables and flush the memory-mapped files."""
+        self.swap(0, None)
+        self.swap(1, None)
+        for name in self.tables:
+            self.weights[name].flush()
+            self.states[name].flush()
+
+    def full_model(self):
+        """
+        A torchkge model over all entities, whose entity tables are backed by the memory-mapped files rather than
+        held in memory. Used for validation, evaluation and saving. Call `flush` first.
+        """
+        emb_model = self.make_model(1)
+        state = {k: v for k, v in self.working.state_dict().items() if k.split('.')[0] not in self.tables}
+        emb_model.load_state_dict(state, strict=False)
+        for name in self.tables:
+            module = getattr(emb_model, name)
+            module.weight = nn.Parameter(torch.from_numpy(self.weights[name]), requires_grad=False)
+            module.num_embeddings = self.n_ent
+        emb_model.n_ent = self.n_ent
+        return emb_model.to(self.device)
+
+
+def edge_buckets(kg, bucket_size, n_parts):
+    """
+    Group the triples of `kg` by the buckets of their head and tail.
+
+    Returns
+    -------
+    heads, tails, relations : torch.Tensor
+        Triples sorted by edge bucket.
+    offsets : torch.Tensor, shape (n_parts * n_parts + 1)
+        Triples of edge bucket (i, j) are at offsets[i * n_parts + j]:offsets[i * n_parts + j + 1].
+    """
+    key = (kg.head_idx // bucket_size) * n_parts + kg.tail_idx // bucket_size
+    order = torch.argsort(key, stable=True)
+    counts = torch.bincount(key, minlength=n_parts * n_parts)
+    offsets = torch.cat((torch.zeros(1, dtype=torch.long), torch.cumsum(counts, dim=0)))
+    return kg.head_idx[order], kg.tail_idx[order], kg.relations[order], offsets
+
+def train_partitioned(method, make_model, kg_train, criterion, config, timestart, logger, device, val_loss=None):
+    """
+    Out-of-core training: peak memory of the entity embeddings is bounded by config['memory_budget'] (MiB) instead of n_ent x dim.
+    Each epoch visits every edge bucket (i, j) in turn, the head bucket i staying loaded while tail buckets j change.
+    Negative heads (resp. tails) are drawn uniformly in bucket i (resp. j), with torchkge's Bernoulli choice of the side to corrupt.
+
+    Parameters
+    ----------
+    method : str
+        The embedding method, used to name the directory of the tables.
+    make_model : callable
+        Builds the torchkge model for a given number of entities.
+    kg_train : torchkge.data_structures.KnowledgeGraph
+        The training knowledge graph.
+    criterion : torchkge.utils.LossFunction
+        The loss function.
+    config : dict
+        CLI arguments.
+    timestart : str
+        The starting time of the training, used to name the directory of the tables.
+    val_loss : callable, optional
+        Called with the full model at the end of each epoch, returns the validation loss.
+
+    Returns
+    -------
+    torchkge.models.xxx
+        The trained model, its entity tables memory-mapped from config['partition_dir'].
+    """
+    method_model = make_model(1)
+    row_bytes = 2 * 4 * sum(getattr(method_model, name).embedding_dim for name in entity_tables(method_model)) # float32 weights and Adagrad state
+    n_parts = n_partitions(kg_train.n_ent, row_bytes, config['memory_budget'])
+    path = os.path.join(config.get('partition_dir', PARTITION_DIR), f'{method}_{timestart}')
+    model = PartitionedModel(make_model, kg_train.n_ent, n_parts, path, config['lr'], device)
+    logger.info(f'Partitioned training: {n_parts} entity buckets of {model.bucket_size} entities, tables in {path}')
+
+    heads, tails, relations, offsets = edge_buckets(kg_train, model.bucket_size, n_parts)
+    bern_probs = BernoulliNegativeSampler(kg_train).bern_probs
+    precision = config.get('precision', 'fp32')
+
+    iterator = tqdm(range(config['n_epochs']), unit='epoch')
+    for epoch in iterator:
+        running_loss, n_batches = 0.0, 0
+        epoch_start = time()
+        for i in torch.randperm(n_parts).tolist():
+            model.swap(0, i)
+            for j in torch.randperm(n_parts).tolist():
+                start, end = offsets[i * n_parts + j].item(), offsets[i * n_parts + j + 1].item()
+                if start == end:
+                    continue
+                if j != i:
+                    model.swap(1, j)
+                h_start, h_end = model.bounds(i)
+                t_start, t_end = model.bounds(j)
+                t_offset = 0 if j == i else model.bucket_size # Local index of bucket j's first entity in the working tables
+
+                for idx in (start + torch.randperm(end - start)).split(config['batch_size']):
+                    h = (heads[idx] - h_start).to(device)
+                    t = (tails[idx] - t_start + t_offset).to(device)
+                    r = relations[idx].to(device)
+                    corrupt_heads = torch.bernoulli(bern_probs[relations[idx]]).bool().to(device)
+                    n_h = torch.where(corrupt_heads, torch.randint(0, h_end - h_start, h.shape, device=device), h)
+                    n_t = torch.where(corrupt_heads, t, torch.randint(0, t_end - t_start, t.shape, device=device) + t_offset)
+
+                    model.optimizer.zero_grad()
+                    with autocast(precision, device):
+                        pos, neg = model.working(h, t, r, n_h, n_t)
+                        loss = criterion(pos, neg)
+                    if config['weight_decay']:
+                        (loss + touched_rows_penalty(model.working, config['weight_decay'], torch.cat((h, t, n_h, n_t)), r)).backward()
+                    else:
+                        loss.backward()
+                    model.optimizer.step()
+                    running_loss += loss.item()
+                    n_batches += 1
+
+                if config['normalize_parameters']:
+                    model.working.normalize_parameters()
+
+        model.flush()
+        epoch_time = time() - epoch_start
+        validation_loss = val_loss(model.full_model()) if val_loss is not None else None
+        logger.info(f'{dt.now()} - Epoch {epoch + 1} | mean loss: {running_loss / max(n_batches, 1)}, val loss: {validation_loss}')
+        logger.info(f'\t epoch time: {epoch_time:.2f}s, peak RSS: {getrusage(RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+
+    return model.full_model()
@@ -0,0 +1,121 @@
+import queue
+import threading
+from time import time
+
+import torch
+
+
+class BatchPipeline:
+    """
+    Iterable over batches of positive triples and their negative samples, produced ahead of time by background threads.
+    Replaces the DataLoader + `sampler.corrupt_batch` pair of the training loop, so that sampling and
+    host-to-device copies overlap with the forward and backward passes.
+
+    Parameters
+    ----------
+    kg : torchkge.data_structures.KnowledgeGraph
+        The knowledge graph to iterate over.
+    sampler : torchkge.sampling.NegativeSampler
+        The negative sampler, ex: BernoulliNegativeSampler(kg).
+    batch_size : int
+        Number of positive triples per batch.
+    device : torch.device
+        Device the batches are moved to.
+    shuffle : bool
+        Whether triples are shuffled at each epoch.
+    n_workers : int
+        Number of producer threads. With 0, batches are produced synchronously when requested.
+    queue_depth : int
+        Maximum number of batches produced ahead of the training loop.
+
+    Attributes
+    ----------
+    wait_time : float
+        Time in seconds spent by the consumer waiting for a batch during the last epoch.
+    sample_time : float
+        Time in seconds spent producing batches (negative sampling included) during the last epoch, summed over producer threads.
+        Overlaps with the training loop unless n_workers is 0.
+    """
+    def __init__(self, kg, sampler, batch_size, device, shuffle=True, n_workers=1, queue_depth=4):
+        self.kg = kg
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.shuffle = shuffle
+        self.n_workers = n_workers
+        self.queue_depth = queue_depth
+        self.pin_memory = self.device.type == 'cuda'
+        self.wait_time = 0.0
+        self.sample_time = 0.0
+        self.time_lock = threading.Lock()
+
+    def __len__(self):
+        return (self.kg.n_facts + self.batch_size - 1) // self.batch_size
+
+    def make_batch(self, idx):
+        """Positive triples at `idx` and their negative samples, as CPU tensors (pinned if the device is a GPU)."""
+        t1 = time()
+        h, t, r = self.kg.head_idx[idx], self.kg.tail_idx[idx], self.kg.relations[idx]
+        n_h, n_t = self.sampler.corrupt_batch(h, t, r)
+        batch = (h, t, r, n_h, n_t)
+        if self.pin_memory:
+            batch = tuple(x.pin_memory() for x in batch)
+        with self.time_lock:
+            self.sample_time += time() - t1
+        return batch
+
+    def to_device(self, batch):
+        return tuple(x.to(self.device, non_blocking=self.pin_memory) for x in batch)
+
+    def __iter__(self):
+        self.wait_time, self.sample_time = 0.0, 0.0
+        order = torch.randperm(self.kg.n_facts) if self.shuffle else torch.arange(self.kg.n_facts)
+        batches = order.split(self.batch_size)
+
+        if self.n_workers == 0:
+            for idx in batches:
+                t1 = time()
+                batch = self.make_batch(idx)
+                self.wait_time += time() - t1
+                yield self.to_device(batch)
+            return
+
+        out = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        todo = iter(batches)
+        lock = threading.Lock()
+
+        def put(item):
+            while not stop.is_set(): # Bounded put, so that an interrupted epoch does not leave threads blocked
+                try:
+                    out.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                while not stop.is_set():
+                    with lock:
+                        idx = next(todo, None)
+                    if idx is None:
+                        return
+                    put(self.make_batch(idx))
+            except Exception as e:
+                put(e)
+
+        workers = [threading.Thread(target=produce, daemon=True) for _ in range(self.n_workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for _ in range(len(batches)):
+                t1 = time()
+                batch = out.get()
+                self.wait_time += time() - t1
+                if isinstance(batch, Exception):
+                    raise batch
+                yield self.to_device(batch)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
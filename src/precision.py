@@ -0,0 +1,111 @@
+import copy
+from time import time
+
+import torch
+from torch.optim import Adam
+
+from torchkge.evaluation import LinkPredictionEvaluator
+from torchkge.models import TransEModel, TorusEModel, DistMultModel, ComplExModel, AnalogyModel, ConvKBModel
+from torchkge.sampling import BernoulliNegativeSampler
+from torchkge.utils import MarginLoss
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+def autocast(precision, device):
+    """
+    Autocast context of a precision mode. With bf16, eligible ops (matmul, linear, convolutions) of the forward pass and loss
+    run in bfloat16 while parameters, gradients and optimizer states stay in float32. With fp32, it does nothing.
+    """
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+def scoring_model(emb_model, precision):
+    """
+    Model used to score candidates. With bf16, a bfloat16 copy of `emb_model`, so that embedding lookups and
+    the (batch, n_ent, dim) candidate products read and write half as many bytes. The float32 model is left untouched.
+    """
+    if precision == 'bf16':
+        return copy.deepcopy(emb_model).to(torch.bfloat16)
+    return emb_model
+
+def benchmark(dataset, methods, dim=50, n_epochs=2, batch_size=2048, lr=0.001, n_eval=2000, b_size=264, tolerance=0.01, seed=0):
+    """
+    Train each model in fp32 and in bf16 from the same initialization, then score a sample of test triples
+    with the matching precision. Prints training and scoring throughput, Hit@10 and MRR of both modes,
+    and whether the filtered MRR of bf16 stays within `tolerance` of fp32.
+
+    Parameters
+    ----------
+    dataset : str
+        Space separated triple file, or directory holding an integer-encoded dataset (see src.dataset).
+    methods : list of str
+        Models to benchmark, among TransE, TorusE, DistMult, ComplEx, ANALOGY, ConvKB.
+    n_eval : int
+        Number of test triples used for link prediction.
+    b_size : int
+        Evaluation batch size. Lower it for ConvKB on large graphs.
+    tolerance : float
+        Maximum absolute difference of filtered MRR between fp32 and bf16.
+    """
+    from src.dataset import load_dataset
+    from src.split import split_indices, subgraph
+
+    kg = load_dataset(dataset)
+    train_idx, _, test_idx = split_indices(kg, share=0.8, seed=seed)
+    kg_train = subgraph(kg, train_idx)
+    generator = torch.Generator().manual_seed(seed)
+    kg_eval = subgraph(kg, test_idx[torch.randperm(len(test_idx), generator=generator)[:n_eval]])
+
+    models = {
+        'TransE': lambda: TransEModel(dim, kg.n_ent, kg.n_rel, dissimilarity_type='L2'),
+        'TorusE': lambda: TorusEModel(dim, kg.n_ent, kg.n_rel, dissimilarity_type='torus_L2'),
+        'DistMult': lambda: DistMultModel(dim, kg.n_ent, kg.n_rel),
+        'ComplEx': lambda: ComplExModel(dim, kg.n_ent, kg.n_rel),
+        'ANALOGY': lambda: AnalogyModel(dim, kg.n_ent, kg.n_rel),
+        'ConvKB': lambda: ConvKBModel(dim, 10, kg.n_ent, kg.n_rel),
+    }
+    criterion = MarginLoss(margin=1)
+    sampler = BernoulliNegativeSampler(kg_train)
+
+    print(f'{"model":<10}{"precision":<11}{"train triples/s":>16}{"eval triples/s":>16}{"Hit@10":>9}{"MRR":>9}')
+    for method in methods:
+        torch.manual_seed(seed)
+        init = models[method]()
+        results = {}
+        for precision in PRECISIONS:
+            emb_model = copy.deepcopy(init)
+            optimizer = Adam(emb_model.parameters(), lr=lr)
+            torch.manual_seed(seed)
+            t1 = time()
+            for _ in range(n_epochs):
+                for idx in torch.randperm(kg_train.n_facts).split(batch_size):
+                    h, t, r = kg_train.head_idx[idx], kg_train.tail_idx[idx], kg_train.relations[idx]
+                    n_h, n_t = sampler.corrupt_batch(h, t, r)
+                    optimizer.zero_grad()
+                    with autocast(precision, 'cpu'):
+                        pos, neg = emb_model(h, t, r, n_h, n_t)
+                        loss = criterion(pos, neg)
+                    loss.backward()
+                    optimizer.step()
+            train_speed = n_epochs * kg_train.n_facts / (time() - t1)
+
+            evaluator = LinkPredictionEvaluator(scoring_model(emb_model, precision), kg_eval)
+            t1 = time()
+            with autocast(precision, 'cpu'):
+                evaluator.evaluate(b_size=b_size, verbose=False)
+            eval_speed = kg_eval.n_facts / (time() - t1)
+            results[precision] = evaluator.mrr()[1]
+            print(f'{method:<10}{precision:<11}{train_speed:>16.0f}{eval_speed:>16.0f}{evaluator.hit_at_k(10)[1]:>9.4f}{evaluator.mrr()[1]:>9.4f}')
+        delta = abs(results['bf16'] - results['fp32'])
+        print(f'{method:<10}filtered MRR difference {delta:.4f}: {"within" if delta <= tolerance else "OUT OF"} tolerance ({tolerance})')
+
+if __name__ == '__main__':
+    # Compare fp32 and bf16 throughput and accuracy, ex: python -m src.precision data/raw/toy-example.txt TransE ComplEx
+    from src.benchmarks import bench_parser
+    parser = bench_parser('Benchmark bf16 against fp32 training and scoring')
+    parser.add_argument('--n_epochs', type=int, default=2, help='Number of training epochs')
+    parser.add_argument('--n_eval', type=int, default=2000, help='Number of test triples scored')
+    parser.add_argument('--b_size', type=int, default=264, help='Evaluation batch size')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Maximum filtered MRR difference')
+    args = parser.parse_args()
+    benchmark(args.dataset, args.methods, dim=args.dim, n_epochs=args.n_epochs, n_eval=args.n_eval, b_size=args.b_size, tolerance=args.tolerance)
@@ -9,9 +9,9 @@ from torch.utils.data import Dataset
 from torchkge.models import *
 from torchkge.inference import *
  
-from utils import *
+from src.utils import *
 from predict import load_embedding_model, load_graph
-from classifier import *
+from src.classifier import *
 
 class KGDataset(Dataset):
     """
@@ -109,13 +109,13 @@ def annotation_matching(args, kg):
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Knowledge Graph Embedding Predictions')
-    parser.add_argument('--model', type=str, nargs='+', required=True, help='[Model type] [Model path] [embedding dim] [Additional param : One of dissmimilary func (L1/L2) (TorusE/TransE), nb_filter (ConvKB), scalar share (ANALOGY)]', required=True)
+    parser.add_argument('--model', type=str, nargs='+', help='[Model type] [Model path] [embedding dim] [Additional param : One of dissmimilary func (L1/L2) (TorusE/TransE), nb_filter (ConvKB), scalar share (ANALOGY)]', required=True)
     parser.add_argument('--filter_known_facts', action='store_true', help='Removes known facts from the predictions')
     parser.add_argument('--gene', type=str, help='Target gene URI')
     parser.add_argument('--phenotype', type=str, help='Target phenotype URI')
     parser.add_argument('--classifier', type=str, help='Path of the classifier model .pkl file')
 
-    parser.add_argument('--graph', type=str, required=True, help='Path of the model\'s training data file as .csv(required)')
+    parser.add_argument('--graph', type=str, required=True, help='Path of the model\'s training data file as .csv or .pkl snapshot (required)')
     parser.add_argument('--b_size', type=int, default=264, help='Batch size (optional, default=264)')
     parser.add_argument('--output', type=str, help='Path of the prediction output file')
     return parser.parse_args()
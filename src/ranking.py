@@ -0,0 +1,364 @@
+import copy
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from torchkge.evaluation import LinkPredictionEvaluator, RelationPredictionEvaluator
+
+from src.entity_types import Compactor, entity_types
+
+EVAL_MEMORY = 1024 # MiB
+
+
+def prepare(model, h_idx, t_idx, r_idx):
+    """
+    Embeddings of a batch of triples, as `model.inference_prepare_candidates`, a function returning the candidates [start, end)
+    of each triple and a function returning the candidates idx[i] of each triple i (idx of shape (b_size,) or (b_size, k)). Models caching entities
+    projected by relation (TransH, TransR, TransD) index their cache per block, so that the (b_size, n_ent, emb_dim) candidates
+    are never gathered at once.
+    """
+    rows = torch.arange(len(h_idx), device=h_idx.device)
+    if hasattr(model, 'projected_entities'):
+        model.inference_prepare_candidates(h_idx[:1], t_idx[:1], r_idx[:1], entities=False) # Projects entities once
+        projected = model.projected_entities
+        return (projected[r_idx, h_idx], projected[r_idx, t_idx], model.rel_emb(r_idx),
+                lambda start, end: projected[r_idx, start:end], lambda idx: projected[r_idx.view(-1, 1), idx.view(len(idx), -1)])
+    h_emb, t_emb, r_emb, candidates = model.inference_prepare_candidates(h_idx, t_idx, r_idx, entities=True)
+    # Views, candidates are an expanded view of the entity table (or a tuple of them, ex: real and imaginary parts for ComplEx)
+    return (h_emb, t_emb, r_emb, lambda start, end: parts(candidates, lambda x: x[:, start:end]),
+            lambda idx: parts(candidates, lambda x: x[rows.view(-1, 1), idx.view(len(idx), -1)]))
+
+def parts(x, fn):
+    """fn(x), applied to each part of x if it is a tuple."""
+    return tuple(fn(part) for part in x) if isinstance(x, tuple) else fn(x)
+
+def block_model(model, n_ent):
+    """Shallow copy of `model` scoring `n_ent` candidates at a time (ConvKB expands queries to model.n_ent candidates)."""
+    if not hasattr(model, 'n_ent') or model.n_ent == n_ent:
+        return model
+    block = copy.copy(model)
+    block.n_ent = n_ent
+    return block
+
+def score(model, query_emb, candidates, r_emb, tails):
+    """Scores of the candidate tails (or heads) of the queries, of shape (b_size, n_candidates)."""
+    return model.inference_scoring_function(query_emb, candidates, r_emb) if tails else model.inference_scoring_function(candidates, query_emb, r_emb)
+
+def known_pairs(dictionary, key1, key2, true_idx):
+    """
+    Known targets of each query but its true one, as parallel (row, entity) tensors, the entities that torchkge's
+    `filter_scores` removes from the candidates of row i.
+    """
+    rows, entities = [], []
+    for i, (k1, k2, true) in enumerate(zip(key1.tolist(), key2.tolist(), true_idx.tolist())):
+        targets = dictionary.get((k1, k2))
+        if targets:
+            others = [e for e in targets if e != true]
+            rows += [i] * len(others)
+            entities += others
+    return torch.tensor(rows, dtype=torch.long), torch.tensor(entities, dtype=torch.long)
+
+
+class ChunkedLinkPredictionEvaluator(LinkPredictionEvaluator):
+    """
+    Filtered link prediction evaluation streaming over blocks of candidate entities. For each query, only counts of the
+    candidates scoring at least as high as the true entity are kept, rather than (b_size, n_ent) raw and filtered score matrices,
+    so that peak memory is set by `memory_budget` instead of the number of entities. Ranks, hence Hit@k, MR and MRR, are those
+    of torchkge's LinkPredictionEvaluator: the raw rank counts candidates c with score(c) >= score(true), and the filtered rank
+    leaves out the known targets other than the true one (torchkge sets their scores to -inf).
+
+    Parameters
+    ----------
+    model : torchkge.models.xxx
+        The embedding model to evaluate.
+    knowledge_graph : torchkge.data_structures.KnowledgeGraph
+        The triples to rank. Its dict_of_heads and dict_of_tails are the known facts filtered.
+    memory_budget : float
+        Approximate memory (MiB) of the score blocks and their intermediates, shared by the threads.
+    n_threads : int
+        Number of threads ranking batches of queries concurrently.
+    """
+    def __init__(self, model, knowledge_graph, memory_budget=EVAL_MEMORY, n_threads=1):
+        super().__init__(model, knowledge_graph)
+        self.memory_budget = memory_budget
+        self.n_threads = n_threads
+
+    def block_size(self, b_size, emb_size):
+        """Number of candidates scored at once for `b_size` queries, given the budget of a thread."""
+        per_candidate = b_size * (4 * emb_size * 3 + 16) # Candidate embeddings, their combination with the query and its reduction, scores and masks
+        if hasattr(self.model, 'convlayer'): # ConvKB: concatenated triples and convolution buffers, measured about 12 times larger
+            per_candidate *= 12
+        return max(1, int(self.memory_budget * 2**20 / self.n_threads // per_candidate))
+
+    def rank(self, query_emb, r_emb, block, true_idx, pairs, tails):
+        """
+        Raw and filtered ranks of `true_idx` among all entities, completing tails (or heads) of the queries.
+        The true score of a query is read from the scores of the block holding its true entity, so that it is compared with
+        the other candidates on values computed the same way, and the true entity is always counted once in its own rank.
+        """
+        n_ent, b_size = self.kg.n_ent, len(true_idx)
+        rows, entities = (x.to(true_idx.device) for x in pairs)
+        first = block(0, 1)
+        step = self.block_size(b_size, sum(part[0, 0].numel() for part in (first if isinstance(first, tuple) else (first,))))
+
+        def block_scores(start):
+            end = min(start + step, n_ent)
+            return end, score(block_model(self.model, end - start), query_emb, block(start, end), r_emb, tails)
+
+        true_block, true_score = true_idx // step, None
+        for b in torch.unique(true_block).tolist(): # Blocks holding a true entity are scored once more, before the comparisons
+            _, scores = block_scores(b * step)
+            true_score = scores.new_empty(b_size) if true_score is None else true_score
+            sel = true_block == b
+            true_score[sel] = scores[sel, true_idx[sel] - b * step]
+
+        greater, known_greater = torch.zeros(b_size, dtype=torch.long, device=true_idx.device), torch.zeros_like(true_idx)
+        for start in range(0, n_ent, step):
+            end, scores = block_scores(start)
+            greater += (scores >= true_score.unsqueeze(1)).sum(dim=1)
+            in_block = (entities >= start) & (entities < end)
+            hit = scores[rows[in_block], entities[in_block] - start] >= true_score[rows[in_block]]
+            known_greater += torch.bincount(rows[in_block][hit], minlength=b_size)
+        # torchkge's filtered scores are -inf, counted as >= the true score only if it is -inf itself
+        n_known = torch.bincount(rows, minlength=b_size)
+        filtered = greater - known_greater + torch.where(true_score == -float('inf'), n_known, torch.zeros_like(n_known))
+        return greater, filtered
+
+    def evaluate_batch(self, start, end):
+        with torch.no_grad():
+            device = next(self.model.parameters()).device
+            h_idx, t_idx, r_idx = (x[start:end].to(device) for x in (self.kg.head_idx, self.kg.tail_idx, self.kg.relations))
+            h_emb, t_emb, r_emb, block, _ = prepare(self.model, h_idx, t_idx, r_idx)
+            self.rank_true_tails[start:end], self.filt_rank_true_tails[start:end] = (x.cpu() for x in self.rank(
+                h_emb, r_emb, block, t_idx, known_pairs(self.kg.dict_of_tails, h_idx.cpu(), r_idx.cpu(), t_idx.cpu()), tails=True))
+            self.rank_true_heads[start:end], self.filt_rank_true_heads[start:end] = (x.cpu() for x in self.rank(
+                t_emb, r_emb, block, h_idx, known_pairs(self.kg.dict_of_heads, t_idx.cpu(), r_idx.cpu(), h_idx.cpu()), tails=False))
+
+    def evaluate(self, b_size, verbose=True):
+        """
+        Rank the true heads and tails of all triples, `b_size` queries at a time.
+
+        Parameters
+        ----------
+        b_size : int
+            Number of triples per batch of queries.
+        verbose : bool
+            Whether to display a progress bar.
+        """
+        batches = [(start, min(start + b_size, self.kg.n_facts)) for start in range(0, self.kg.n_facts, b_size)]
+        progress = tqdm(total=len(batches), unit='batch', disable=(not verbose), desc='Link prediction evaluation')
+        if self.n_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor: # Torch ops release the GIL
+                for _ in executor.map(lambda batch: self.evaluate_batch(*batch), batches):
+                    progress.update()
+        else:
+            for batch in batches:
+                self.evaluate_batch(*batch)
+                progress.update()
+        progress.close()
+        self.evaluated = True
+
+
+class BatchedRelationPredictionEvaluator(RelationPredictionEvaluator):
+    """
+    Relation prediction evaluation in a single pass over the triples, filling preallocated rank and prediction buffers.
+    Ranks are those of torchkge's RelationPredictionEvaluator, including the undirected case where the relations of (t, h)
+    are ranked along with those of (h, t), and the predicted relation of each triple (best scoring one) is kept for
+    the confusion matrix and the per-relation breakdown of `report`.
+
+    Parameters
+    ----------
+    model : torchkge.models.xxx
+        The embedding model to evaluate.
+    knowledge_graph : torchkge.data_structures.KnowledgeGraph
+        The triples to rank. Its dict_of_rels are the known facts filtered.
+    directed : bool
+        Whether the orientation of the triples is known. If False, relations are also scored from tail to head.
+    """
+    def __init__(self, model, knowledge_graph, directed=True):
+        super().__init__(model, knowledge_graph, directed=directed)
+        self.predicted_rels = torch.empty(knowledge_graph.n_facts, dtype=torch.long)
+
+    def evaluate(self, b_size, verbose=True):
+        """
+        Rank the true relation of all triples, `b_size` triples at a time.
+
+        Parameters
+        ----------
+        b_size : int
+            Number of triples per batch.
+        verbose : bool
+            Whether to display a progress bar.
+        """
+        n_rel, device = self.kg.n_rel, next(self.model.parameters()).device
+        for start in tqdm(range(0, self.kg.n_facts, b_size), unit='batch', disable=(not verbose), desc='Relation prediction evaluation'):
+            end = min(start + b_size, self.kg.n_facts)
+            h_idx, t_idx, r_idx = (x[start:end] for x in (self.kg.head_idx, self.kg.tail_idx, self.kg.relations))
+            rows, rels = known_pairs(self.kg.dict_of_rels, h_idx, t_idx, r_idx)
+            with torch.no_grad():
+                h_emb, t_emb, _, candidates = self.model.inference_prepare_candidates(h_idx.to(device), t_idx.to(device), r_idx.to(device), entities=False)
+                scores = self.model.inference_scoring_function(h_emb, t_emb, candidates)
+                if not self.directed:
+                    scores = torch.cat((scores, self.model.inference_scoring_function(t_emb, h_emb, candidates)), dim=1)
+            scores = scores.cpu()
+            true_score = scores.gather(1, r_idx.view(-1, 1))
+            filt_scores = scores.clone()
+            filt_scores[rows, rels] = -float('inf')
+            if not self.directed: # torchkge filters the known relations of (h, t) in both orientations
+                filt_scores[rows, n_rel + rels] = -float('inf')
+            self.rank_true_rels[start:end] = (scores >= true_score).sum(dim=1)
+            self.filt_rank_true_rels[start:end] = (filt_scores >= true_score).sum(dim=1)
+            self.predicted_rels[start:end] = scores.argmax(dim=1) % n_rel
+        self.evaluated = True
+
+    def confusion(self):
+        """Confusion matrix of shape (n_rel, n_rel), true relations in rows and predicted ones in columns."""
+        n_rel = self.kg.n_rel
+        return torch.bincount(self.kg.relations * n_rel + self.predicted_rels, minlength=n_rel * n_rel).view(n_rel, n_rel)
+
+    def per_relation(self):
+        """Number of triples, raw and filtered MRR, Mean Rank and Hit@1/3/5/10 of the triples of each relation, indexed by name."""
+        names = relation_names(self.kg)
+        df = pd.DataFrame({'relation': [names[r] for r in self.kg.relations.tolist()],
+                           'rank': self.rank_true_rels.numpy(), 'filt_rank': self.filt_rank_true_rels.numpy()})
+        return breakdown(df, 'relation')
+
+    def report(self):
+        """Overall and per-relation metrics and the confusion matrix, keyed by relation names, as a JSON-serializable dict."""
+        names = relation_names(self.kg)
+        confusion = self.confusion()
+        return {'task': 'relation-prediction', 'directed': self.directed, 'n_triples': self.kg.n_facts,
+                'metrics': overall(self), 'relations': by_name(self.per_relation()),
+                'confusion': {names[i]: {names[j]: int(confusion[i, j]) for j in confusion[i].nonzero().view(-1).tolist()}
+                              for i in confusion.sum(dim=1).nonzero().view(-1).tolist()}}
+
+def relation_names(kg):
+    """Name of each relation index, the index itself for graphs built without labels."""
+    names = {ix: rel for rel, ix in (kg.rel2ix or {}).items()}
+    return [names.get(i, str(i)) for i in range(kg.n_rel)]
+
+def breakdown(df, key):
+    """
+    Metrics of the ranks (columns rank and filt_rank) of `df` grouped by `key`, as a DataFrame indexed by its values.
+    If `df` has a direction column (heads or tails, for link prediction), the filtered MRR of each direction is added.
+    """
+    df = df.assign(rr=1 / df['rank'], filt_rr=1 / df['filt_rank'],
+                   **{f'hit{k}': df['filt_rank'] <= k for k in [1, 3, 5, 10]})
+    grouped = df.groupby(key, sort=True)
+    metrics = pd.DataFrame({'count': grouped.size(), 'MRR': grouped['rr'].mean(), 'filt. MRR': grouped['filt_rr'].mean(),
+                            'filt. Mean Rank': grouped['filt_rank'].mean(),
+                            **{f'filt. Hit@{k}': grouped[f'hit{k}'].mean() for k in [1, 3, 5, 10]}})
+    if 'direction' in df:
+        metrics['count'] //= 2 # Triples, each ranked as a head and as a tail
+        for direction in ['heads', 'tails']:
+            metrics[f'filt. MRR ({direction})'] = df[df['direction'] == direction].groupby(key)['filt_rr'].mean()
+    return metrics
+
+def by_name(metrics):
+    """Rows of a `breakdown` as {index: {metric: value}}, missing values as None, for JSON reports."""
+    return metrics.astype(object).where(metrics.notna(), None).to_dict(orient='index')
+
+def link_prediction_breakdown(evaluator, type_source='prefix'):
+    """
+    Metrics of an evaluated link prediction evaluator (torchkge's, chunked or sampled) grouped by slices of its triples, from the
+    ranks of its single pass: by relation, by head type, by tail type and by signature (head type, relation, tail type),
+    ex: wbgene nt:001 wbdata:pheno. Each slice counts the head and tail ranks of its triples, as the global metrics.
+
+    Parameters
+    ----------
+    type_source : str
+        prefix or rdf:type (see src.entity_types.entity_types).
+
+    Returns
+    -------
+    dict
+        A `breakdown` DataFrame per slice: relation, head_type, tail_type and signature.
+    """
+    kg = evaluator.kg
+    names = np.array(relation_names(kg), dtype=object)
+    compactor = Compactor()
+    types = entity_types(kg, torch.cat([kg.head_idx, kg.tail_idx]), source=type_source)
+    triples = pd.DataFrame({'relation': names[kg.relations.numpy()], 'head_type': types[:kg.n_facts], 'tail_type': types[kg.n_facts:]})
+    triples['signature'] = triples['head_type'] + ' ' + triples['relation'].map(compactor.compact) + ' ' + triples['tail_type']
+    df = pd.concat([triples.assign(direction='heads', rank=evaluator.rank_true_heads.numpy(), filt_rank=evaluator.filt_rank_true_heads.numpy()),
+                    triples.assign(direction='tails', rank=evaluator.rank_true_tails.numpy(), filt_rank=evaluator.filt_rank_true_tails.numpy())],
+                   ignore_index=True)
+    return {key: breakdown(df, key) for key in ['relation', 'head_type', 'tail_type', 'signature']}
+
+def link_prediction_report(evaluator, slices, type_source='prefix'):
+    """Overall metrics and the `link_prediction_breakdown` slices of an evaluated link prediction evaluator, as a JSON-serializable dict."""
+    return {'task': 'link-prediction', 'evaluator': type(evaluator).__name__, 'entity_types': type_source, 'n_triples': evaluator.kg.n_facts,
+            'metrics': overall(evaluator), **{f'{key}s': by_name(metrics) for key, metrics in slices.items()}}
+
+def overall(evaluator):
+    """Raw and filtered Hit@1/3/5/10, Mean Rank and MRR of an evaluated torchkge evaluator."""
+    metrics = {}
+    for k in [1, 3, 5, 10]:
+        metrics[f'Hit@{k}'], metrics[f'filt. Hit@{k}'] = evaluator.hit_at_k(k)
+    metrics['Mean Rank'], metrics['filt. Mean Rank'] = evaluator.mean_rank()
+    metrics['MRR'], metrics['filt. MRR'] = evaluator.mrr()
+    return metrics
+
+def save_report(path, report):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def benchmark(dataset, method, n_eval=1000, budgets=(64, 256, 1024), n_threads=1, dim=50, b_size=264, seed=0):
+    """
+    Rank `n_eval` test triples with torchkge's LinkPredictionEvaluator and with ChunkedLinkPredictionEvaluator under each memory
+    budget (MiB), and print their time, peak memory above the model's and whether their ranks are identical. The model is untrained.
+    """
+    from src.autotune import reset_peak_memory, peak_memory
+    from src.benchmarks import bench_model_config
+    from src.dataset import load_dataset
+    from src.split import split_indices, subgraph
+    from src.train import build_model
+
+    kg = load_dataset(dataset)
+    _, _, test_idx = split_indices(kg, share=0.8, seed=seed)
+    kg_eval = subgraph(kg, test_idx[torch.randperm(len(test_idx), generator=torch.Generator().manual_seed(seed))[:n_eval]])
+    torch.manual_seed(seed)
+    emb_model = build_model(method, bench_model_config(dim), kg.n_ent, kg.n_rel)
+    device = torch.device('cpu')
+
+    rows, ranks = [], {}
+    for budget in [*budgets, None]: # torchkge last, so that the memory it leaves resident does not hide the peaks of the others
+        name = 'torchkge' if budget is None else f'chunked {budget:g} MiB'
+        evaluator = LinkPredictionEvaluator(emb_model, kg_eval) if budget is None else \
+            ChunkedLinkPredictionEvaluator(emb_model, kg_eval, memory_budget=budget, n_threads=n_threads)
+        reset_peak_memory(device)
+        base = peak_memory(device)
+        t1 = time()
+        try:
+            evaluator.evaluate(b_size=b_size, verbose=False)
+        except RuntimeError: # torchkge's dense score matrices may not fit
+            rows.append((name, None, None, None))
+            continue
+        rows.append((name, time() - t1, peak_memory(device) - base, evaluator.mrr()[1]))
+        ranks[name] = [evaluator.rank_true_heads, evaluator.rank_true_tails, evaluator.filt_rank_true_heads, evaluator.filt_rank_true_tails]
+
+    print(f'{"evaluator":<22}{"time (s)":>10}{"peak (MiB)":>12}{"filt. MRR":>11}{"same ranks as torchkge":>24}')
+    for name, elapsed, peak, mrr in rows:
+        if elapsed is None:
+            print(f'{name:<22}{"out of memory":>22}')
+            continue
+        identical = all(torch.equal(a, b) for a, b in zip(ranks[name], ranks['torchkge'])) if 'torchkge' in ranks else 'n/a'
+        print(f'{name:<22}{elapsed:>10.2f}{peak:>12.0f}{mrr:>11.4f}{str(identical):>24}')
+
+if __name__ == '__main__':
+    # Compare torchkge's and the chunked evaluation, ex: python -m src.ranking data/raw/toy-example.txt TransE --budgets 1 16
+    from src.benchmarks import bench_parser
+    parser = bench_parser('Benchmark the memory-bounded link prediction evaluation against torchkge', methods=False)
+    parser.add_argument('--n_eval', type=int, default=1000, help='Number of test triples ranked')
+    parser.add_argument('--budgets', nargs='+', type=float, default=[64, 256, 1024], help='Memory budgets (MiB) of the chunked evaluation')
+    parser.add_argument('--threads', type=int, default=1, help='Threads of the chunked evaluation')
+    parser.add_argument('--b_size', type=int, default=264, help='Number of queries per batch')
+    args = parser.parse_args()
+    benchmark(args.dataset, args.method, n_eval=args.n_eval, budgets=args.budgets, n_threads=args.threads, dim=args.dim, b_size=args.b_size)
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+from datetime import datetime as dt
+
+import torch
+
+from src.split import checksum
+
+REGISTRY_DIR = 'models/registry'
+
+# Arguments changing the weights trained by `src.train.train` on a given training graph, for all methods and for some of them.
+# Others (ex: n_filters for a TransE) do not change the key, so that the TransE init of ConvKB runs differing only by ConvKB arguments share it.
+HYPERPARAMETERS = ['ent_emb_dim', 'loss_fn', 'margin', 'lr', 'weight_decay', 'n_epochs', 'batch_size', 'normalize_parameters',
+                   'sparse', 'precision', 'patience', 'val_every', 'val_size', 'neg_sampler', 'neg_candidates', 'neg_cache_size',
+                   'neg_temperature', 'neg_refresh', 'workers', 'memory_budget']
+METHOD_HYPERPARAMETERS = {
+    'TransE': ['dissimilarity_type'],
+    'TorusE': ['dissimilarity_type'],
+    'TransR': ['rel_emb_dim'],
+    'TransD': ['rel_emb_dim'],
+    'ANALOGY': ['scalar_share'],
+    'ConvKB': ['n_filters'],
+}
+
+
+def hyperparameters(method, config):
+    return {key: config.get(key) for key in HYPERPARAMETERS + METHOD_HYPERPARAMETERS.get(method, [])}
+
+def registry_key(method, kg, config):
+    """Hash identifying a model trained with `method` and the hyperparameters of `config` on the triples of `kg` (the training set of a split)."""
+    graph = f'{checksum(kg)}\n{kg.n_ent}\n{kg.n_rel}'
+    return hashlib.sha256(f'{method}\n{graph}\n{json.dumps(hyperparameters(method, config), sort_keys=True)}'.encode()).hexdigest()
+
+def model_path(registry_dir, method, key):
+    return os.path.join(registry_dir, f'{method}_{key[:16]}.pt')
+
+def lookup(registry_dir, method, kg, config):
+    """
+    Look up a registered model.
+
+    Parameters
+    ----------
+    registry_dir : str
+        Directory holding the registry.
+    method : str
+        The embedding method, ex: TransE.
+    kg : torchkge.data_structures.KnowledgeGraph
+        The training knowledge graph the model must have been trained on.
+    config : dict
+        CLI arguments. Only the hyperparameters of `method` are compared (see METHOD_HYPERPARAMETERS).
+
+    Returns
+    -------
+    str / None
+        Path to the registered state_dict (.pt), or None if no model matches.
+    """
+    key = registry_key(method, kg, config)
+    path = model_path(registry_dir, method, key)
+    meta_path = f'{path}.json'
+    if not (os.path.exists(path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return path if meta['key'] == key else None
+
+def store(registry_dir, method, kg, config, emb_model):
+    """
+    Register the weights of `emb_model`, trained with `method` and `config` on `kg`, and record their metadata.
+
+    Returns
+    -------
+    str
+        Path to the registered state_dict.
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    key = registry_key(method, kg, config)
+    path = model_path(registry_dir, method, key)
+    torch.save({k: v.cpu() for k, v in emb_model.state_dict().items()}, path)
+    meta = {'method': method, 'key': key, 'graph_checksum': checksum(kg), 'n_ent': kg.n_ent, 'n_rel': kg.n_rel,
+            'n_facts': kg.n_facts, 'hyperparameters': hyperparameters(method, config), 'date': str(dt.now())}
+    with open(f'{path}.json', 'w') as f: # Written last: weights without metadata are never considered valid
+        json.dump(meta, f, indent=2)
+    return path
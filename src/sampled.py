@@ -0,0 +1,213 @@
+import argparse
+import json
+import logging
+import os
+from datetime import datetime as dt
+from time import time
+
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from torchkge.evaluation import LinkPredictionEvaluator
+
+from src.ranking import ChunkedLinkPredictionEvaluator, block_model, known_pairs, prepare, score
+
+MAX_REDRAWS = 10 # Redraws of the candidates that are known facts, those left are ignored
+N_BOOT = 1000
+
+
+def candidate_pools(dictionary, n_rel):
+    """
+    Entities seen as tails (dict_of_tails) or heads (dict_of_heads) of each relation, as a flat tensor of pools,
+    with the start and size of the pool of each relation in it: the range (or domain) constraint of type-constrained evaluation.
+    """
+    pools = [set() for _ in range(n_rel)]
+    for (_, r), entities in dictionary.items():
+        pools[r].update(entities)
+    size = torch.tensor([len(pool) for pool in pools], dtype=torch.long)
+    start = torch.cumsum(size, dim=0) - size
+    return torch.tensor([e for pool in pools for e in sorted(pool)], dtype=torch.long), start, size
+
+def bootstrap_intervals(head_ranks, tail_ranks, n_boot=N_BOOT, alpha=0.05, seed=0):
+    """
+    Percentile bootstrap confidence intervals of Hit@1/3/5/10, Mean Rank and MRR, resampling test triples
+    (with both their head and tail ranks), as computed by torchkge's LinkPredictionEvaluator.
+
+    Returns
+    -------
+    dict
+        (low, high) bounds of each metric, keyed as the logs of `src.train.evaluate_emb_model` (Hit@k, Mean Rank, MRR).
+    """
+    ranks = torch.stack([head_ranks, tail_ranks], dim=1).float()
+    n = len(ranks)
+    generator = torch.Generator().manual_seed(seed)
+    stats = {**{f'Hit@{k}': [] for k in [1, 3, 5, 10]}, 'Mean Rank': [], 'MRR': []}
+    chunk = max(1, 10**7 // (2 * n)) # Resamples drawn at once
+    for start in range(0, n_boot, chunk):
+        sample = ranks[torch.randint(0, n, (min(chunk, n_boot - start), n), generator=generator)]
+        for k in [1, 3, 5, 10]:
+            stats[f'Hit@{k}'].append((sample <= k).float().mean(dim=(1, 2)))
+        stats['Mean Rank'].append(sample.mean(dim=(1, 2)))
+        stats['MRR'].append((1 / sample).mean(dim=(1, 2)))
+    quantiles = torch.tensor([alpha / 2, 1 - alpha / 2])
+    return {name: tuple(torch.quantile(torch.cat(values), quantiles).tolist()) for name, values in stats.items()}
+
+
+class SampledLinkPredictionEvaluator(LinkPredictionEvaluator):
+    """
+    Filtered link prediction evaluation against `n_candidates` sampled negatives per query instead of all entities.
+    The true head (or tail) of each triple is ranked among candidates drawn uniformly (with replacement) from the entities,
+    or from the entities seen in this position of the relation if `typed`, known facts being redrawn so that negatives are
+    filtered. Ranks are then in [1, n_candidates + 1], and both the raw and filtered ranks hold them: Hit@k and MRR are
+    optimistic compared to the full evaluation, but rank models alike (see `correlation`) at a fraction of its cost.
+
+    Parameters
+    ----------
+    model : torchkge.models.xxx
+        The embedding model to evaluate.
+    knowledge_graph : torchkge.data_structures.KnowledgeGraph
+        The triples to rank. Its dict_of_heads and dict_of_tails are the known facts filtered, and the pools of `typed`.
+    n_candidates : int
+        Number of negatives per query.
+    typed : bool
+        Whether to draw the negative tails (heads) of a relation among the entities that are tails (heads) of this relation.
+    seed : int
+        Seed of the draws. The same seed gives the same negatives for the same triples.
+    """
+    def __init__(self, model, knowledge_graph, n_candidates=100, typed=False, seed=0):
+        super().__init__(model, knowledge_graph)
+        self.n_candidates = n_candidates
+        self.typed = typed
+        self.generator = torch.Generator().manual_seed(seed)
+        self.tail_pools = candidate_pools(knowledge_graph.dict_of_tails, knowledge_graph.n_rel) if typed else None
+        self.head_pools = candidate_pools(knowledge_graph.dict_of_heads, knowledge_graph.n_rel) if typed else None
+
+    def draw(self, r_idx, pools):
+        shape = (len(r_idx), self.n_candidates)
+        if pools is None:
+            return torch.randint(0, self.kg.n_ent, shape, generator=self.generator)
+        flat, start, size = pools
+        offsets = (torch.rand(shape, generator=self.generator) * size[r_idx].unsqueeze(1)).long()
+        return flat[start[r_idx].unsqueeze(1) + offsets]
+
+    def sample(self, r_idx, true_idx, pairs, pools):
+        """Negative candidates of each query, and the mask of those that are not known facts (nor the true entity)."""
+        n_ent, rows = self.kg.n_ent, torch.arange(len(true_idx))
+        excluded = torch.cat([pairs[0] * n_ent + pairs[1], rows * n_ent + true_idx])
+        candidates = self.draw(r_idx, pools)
+        for _ in range(MAX_REDRAWS):
+            known = torch.isin(rows.unsqueeze(1) * n_ent + candidates, excluded)
+            if not known.any():
+                break
+            candidates = torch.where(known, self.draw(r_idx, pools), candidates)
+        return candidates, ~torch.isin(rows.unsqueeze(1) * n_ent + candidates, excluded)
+
+    def rank(self, query_emb, r_emb, pick, r_idx, true_idx, pairs, pools, tails):
+        """Filtered ranks of `true_idx` among the sampled negatives, completing tails (or heads) of the queries."""
+        candidates, valid = self.sample(r_idx.cpu(), true_idx.cpu(), pairs, pools)
+        device = true_idx.device
+        true_score = score(block_model(self.model, 1), query_emb, pick(true_idx), r_emb, tails)
+        scores = score(block_model(self.model, self.n_candidates), query_emb, pick(candidates.to(device)), r_emb, tails)
+        return 1 + ((scores >= true_score) & valid.to(device)).sum(dim=1)
+
+    def evaluate_batch(self, start, end):
+        device = next(self.model.parameters()).device
+        h_idx, t_idx, r_idx = (x[start:end] for x in (self.kg.head_idx, self.kg.tail_idx, self.kg.relations))
+        with torch.no_grad():
+            h_emb, t_emb, r_emb, _, pick = prepare(self.model, h_idx.to(device), t_idx.to(device), r_idx.to(device))
+            tails = self.rank(h_emb, r_emb, pick, r_idx, t_idx.to(device), known_pairs(self.kg.dict_of_tails, h_idx, r_idx, t_idx),
+                              self.tail_pools, tails=True).cpu()
+            heads = self.rank(t_emb, r_emb, pick, r_idx, h_idx.to(device), known_pairs(self.kg.dict_of_heads, t_idx, r_idx, h_idx),
+                              self.head_pools, tails=False).cpu()
+        self.rank_true_tails[start:end] = self.filt_rank_true_tails[start:end] = tails
+        self.rank_true_heads[start:end] = self.filt_rank_true_heads[start:end] = heads
+
+    def evaluate(self, b_size, verbose=True):
+        """
+        Rank the true heads and tails of all triples, `b_size` queries at a time.
+
+        Parameters
+        ----------
+        b_size : int
+            Number of triples per batch of queries.
+        verbose : bool
+            Whether to display a progress bar.
+        """
+        for start in tqdm(range(0, self.kg.n_facts, b_size), unit='batch', disable=(not verbose), desc='Sampled link prediction evaluation'):
+            self.evaluate_batch(start, min(start + b_size, self.kg.n_facts))
+        self.evaluated = True
+
+    def confidence_intervals(self, n_boot=N_BOOT, alpha=0.05):
+        """Bootstrap confidence intervals of the metrics (see `bootstrap_intervals`)."""
+        return bootstrap_intervals(self.filt_rank_true_heads, self.filt_rank_true_tails, n_boot=n_boot, alpha=alpha)
+
+def correlation(dataset, methods, epochs, n_candidates=100, typed=False, dim=50, batch_size=512, n_eval=None, seed=0):
+    """
+    Reference run measuring how well the sampled evaluation agrees with the full one: a model is trained for each method and
+    number of epochs (on the same split), and evaluated on the same test triples by both. Models are compared by their MRR and
+    Hit@10 (Pearson and Spearman correlations across models), and ranks per triple (Spearman correlation, averaged over models).
+
+    Returns
+    -------
+    dict
+        rows (metrics and times of each model under both evaluations) and correlations.
+    """
+    from src.benchmarks import bench_config
+    from src.split import subgraph
+    from src.train import train
+
+    logger = logging.getLogger('sampled')
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    timestart = dt.now().strftime("%Y-%m-%d_%H-%M-%S")
+    rows, rank_correlations = [], []
+    for method in methods:
+        for n_epochs in epochs:
+            print(f'{dt.now()} - Training {method} for {n_epochs} epochs..')
+            emb_model, _, kg_test = train(method, dataset, bench_config(method, dim, n_epochs, batch_size), timestart, logger, device)
+            kg_eval = kg_test if n_eval is None else \
+                subgraph(kg_test, torch.randperm(kg_test.n_facts, generator=torch.Generator().manual_seed(seed))[:n_eval])
+            row = {'method': method, 'n_epochs': n_epochs}
+            ranks = {}
+            for name, evaluator in [('full', ChunkedLinkPredictionEvaluator(emb_model, kg_eval)),
+                                    ('sampled', SampledLinkPredictionEvaluator(emb_model, kg_eval, n_candidates, typed, seed))]:
+                t1 = time()
+                evaluator.evaluate(b_size=264, verbose=False)
+                row.update({f'{name}_seconds': time() - t1, f'{name}_MRR': evaluator.mrr()[1], f'{name}_Hit@10': evaluator.hit_at_k(10)[1]})
+                ranks[name] = torch.cat([evaluator.filt_rank_true_heads, evaluator.filt_rank_true_tails]).numpy()
+            row['sampled_MRR_low'], row['sampled_MRR_high'] = evaluator.confidence_intervals()['MRR']
+            rank_correlations.append(pd.Series(ranks['full']).corr(pd.Series(ranks['sampled']), method='spearman'))
+            rows.append(row)
+
+    df = pd.DataFrame(rows)
+    correlations = {'per_triple_rank_spearman': float(pd.Series(rank_correlations).mean())}
+    if len(df) > 1:
+        for metric in ['MRR', 'Hit@10']:
+            for kind in ['pearson', 'spearman']:
+                correlations[f'{metric}_{kind}'] = float(df[f'full_{metric}'].corr(df[f'sampled_{metric}'], method=kind))
+    return {'rows': rows, 'correlations': correlations}
+
+if __name__ == '__main__':
+    # ex: python -m src.sampled data/synthetic/wormbase_100000_0 --methods TransE DistMult --epochs 1 2 5 10 --n_candidates 100
+    parser = argparse.ArgumentParser(description='Measure the agreement of the sampled link prediction evaluation with the full one')
+    parser.add_argument('dataset', type=str, help='Triple file or integer-encoded dataset directory')
+    parser.add_argument('--methods', nargs='+', default=['TransE'], help='Models trained')
+    parser.add_argument('--epochs', nargs='+', type=int, default=[1, 2, 5, 10], help='Numbers of epochs of the models of each method')
+    parser.add_argument('--n_candidates', type=int, default=100, help='Negatives per query of the sampled evaluation')
+    parser.add_argument('--typed', action='store_true', help='Draw negatives among the entities seen in the same position of the relation')
+    parser.add_argument('--dim', type=int, default=50, help='Embedding size')
+    parser.add_argument('--batch_size', type=int, default=512, help='Training batch size')
+    parser.add_argument('--n_eval', type=int, default=None, help='Number of test triples evaluated. Defaults to all')
+    parser.add_argument('--output', type=str, default=None, help='Results file (.json). Defaults to models/sampled_{date}.json')
+    args = parser.parse_args()
+
+    result = correlation(args.dataset, args.methods, args.epochs, n_candidates=args.n_candidates, typed=args.typed, dim=args.dim,
+                         batch_size=args.batch_size, n_eval=args.n_eval)
+    print(pd.DataFrame(result['rows']).to_string(index=False))
+    for name, value in result['correlations'].items():
+        print(f'{name}: {value:.3f}')
+    output = args.output or f'models/sampled_{dt.now().strftime("%Y-%m-%d_%H-%M-%S")}.json'
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'arguments': vars(args), **result}, f, indent=2)
+    print(f'Results saved to {output}')
@@ -0,0 +1,45 @@
+from torch import nn
+from torch.optim import SparseAdam
+
+# Models whose parameters are all embedding tables, looked up by index in the training forward pass
+SPARSE_METHODS = ['TransE', 'TorusE', 'DistMult', 'ComplEx']
+
+
+def make_sparse(emb_model):
+    """Switch the embedding tables of `emb_model` to sparse gradients: a backward pass only produces gradients for the rows used by the batch."""
+    for module in emb_model.modules():
+        if isinstance(module, nn.Embedding):
+            module.sparse = True
+    return emb_model
+
+def sparse_optimizer(emb_model, lr):
+    """Lazy row-wise Adam: moments and updates are only computed for the rows present in the sparse gradient."""
+    return SparseAdam(list(emb_model.parameters()), lr=lr)
+
+def touched_rows_penalty(emb_model, weight_decay, ent_idx, rel_idx):
+    """
+    L2 regularization restricted to the embedding rows used by a batch.
+    Its gradient, weight_decay * row, is what Adam's weight_decay adds for these rows, without touching the rest of the tables.
+
+    Parameters
+    ----------
+    emb_model : torchkge.models.xxx
+        A model of SPARSE_METHODS.
+    weight_decay : float
+        Regularization factor.
+    ent_idx : torch.Tensor
+        Entities of the batch (heads, tails and negative samples). Duplicates are penalized once.
+    rel_idx : torch.Tensor
+        Relations of the batch.
+
+    Returns
+    -------
+    torch.Tensor
+        The penalty, to be added to the loss.
+    """
+    ent_idx, rel_idx = ent_idx.unique(), rel_idx.unique()
+    penalty = 0
+    for name, module in emb_model.named_children():
+        if isinstance(module, nn.Embedding):
+            penalty = penalty + module(ent_idx if 'ent' in name else rel_idx).pow(2).sum() # torchkge names entity tables *ent*
+    return weight_decay / 2 * penalty
@@ -0,0 +1,117 @@
+import hashlib
+
+import numpy as np
+import torch
+
+from torchkge.data_structures import KnowledgeGraph
+
+
+def split_indices(kg, share=0.8, validation=False, stratify=False, seed=None):
+    """
+    Split the triples of a knowledge graph in train/test (and optionally validation) sets,
+    guaranteeing that every entity and every relation appears at least once in the training set.
+
+    Triples are shuffled, then a spanning set made of the first triple (in shuffled order) involving each entity
+    and each relation is reserved for training. The remaining triples fill the training set up to `share`,
+    and what is left goes to the test set, or is halved between validation and test sets.
+    All of it is done with vectorized scatter / cumsum operations, in O(n_facts). Stratification additionally sorts triples by relation.
+
+    Parameters
+    ----------
+    kg : torchkge.data_structures.KnowledgeGraph
+        The knowledge graph to split.
+    share : float
+        Share of the triples allocated to the training set.
+    validation : bool
+        Whether to also return a validation set, made of half of the triples not used for training.
+    stratify : bool
+        Whether `share` is applied per relation rather than globally, so that each relation keeps the same proportions in all sets.
+    seed : int, optional
+        Seed of the shuffle.
+
+    Returns
+    -------
+    train_idx, val_idx, test_idx : torch.Tensor
+        Sorted indices of the triples of each set in `kg`. val_idx is None if `validation` is False.
+    """
+    n = kg.n_facts
+    generator = torch.Generator()
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    perm = torch.randperm(n, generator=generator)
+    heads, tails, rels = kg.head_idx[perm], kg.tail_idx[perm], kg.relations[perm]
+    pos = torch.arange(n)
+
+    # Position of the first triple involving each entity / relation
+    first_ent = torch.full((kg.n_ent,), n, dtype=torch.long).scatter_reduce_(0, torch.cat((heads, tails)), torch.cat((pos, pos)), reduce='amin')
+    first_rel = torch.full((kg.n_rel,), n, dtype=torch.long).scatter_reduce_(0, rels, pos, reduce='amin')
+    reserved = torch.zeros(n, dtype=torch.bool)
+    reserved[first_ent[first_ent < n]] = True
+    reserved[first_rel[first_rel < n]] = True
+
+    if stratify:
+        order = torch.argsort(rels, stable=True) # Groups triples by relation, keeping the shuffled order within a relation
+    else:
+        order = pos
+    group = rels[order] if stratify else torch.zeros(n, dtype=torch.long)
+    n_groups = kg.n_rel if stratify else 1
+    free = ~reserved[order]
+
+    # Rank of each free triple among the free triples of its group
+    counts = torch.bincount(group, minlength=n_groups)
+    free_counts = torch.bincount(group[free], minlength=n_groups)
+    reserved_counts = counts - free_counts
+    cum_free = torch.cumsum(free.long(), dim=0)
+    group_start = torch.cumsum(counts, dim=0) - counts
+    offset = torch.where(group_start > 0, cum_free[(group_start - 1).clamp(min=0)], torch.zeros_like(group_start))
+    rank = cum_free - 1 - offset[group]
+
+    n_train_free = ((counts * share).long() - reserved_counts).clamp(min=0)
+    n_val_free = (free_counts - n_train_free).clamp(min=0) // 2 if validation else torch.zeros_like(free_counts)
+
+    is_train = ~free | (rank < n_train_free[group])
+    is_val = free & ~is_train & (rank < (n_train_free + n_val_free)[group])
+    is_test = ~(is_train | is_val)
+
+    train_idx = perm[order[is_train]].sort().values
+    test_idx = perm[order[is_test]].sort().values
+    val_idx = perm[order[is_val]].sort().values if validation else None
+    return train_idx, val_idx, test_idx
+
+def subgraph(kg, idx):
+    """Knowledge graph made of the triples of `kg` at `idx`. Dictionaries are shared with `kg`, like in `KnowledgeGraph.split_kg`."""
+    return KnowledgeGraph(kg={'heads': kg.head_idx[idx], 'tails': kg.tail_idx[idx], 'relations': kg.relations[idx]},
+                          ent2ix=kg.ent2ix, rel2ix=kg.rel2ix,
+                          dict_of_heads=kg.dict_of_heads, dict_of_tails=kg.dict_of_tails, dict_of_rels=kg.dict_of_rels)
+
+def checksum(kg):
+    """Hash of the triples of `kg`, used to check that saved split indices apply to the same graph."""
+    sha = hashlib.sha1()
+    for tensor in (kg.head_idx, kg.tail_idx, kg.relations):
+        sha.update(np.ascontiguousarray(tensor.numpy()).tobytes())
+    return sha.hexdigest()
+
+def save_split(path, kg, train_idx, val_idx, test_idx):
+    """Save split indices as a .npz file, along with the checksum of the graph they apply to."""
+    arrays = {'train': train_idx.numpy(), 'test': test_idx.numpy(), 'checksum': np.array(checksum(kg))}
+    if val_idx is not None:
+        arrays['val'] = val_idx.numpy()
+    with open(path, 'wb') as f: # np.savez would otherwise append .npz to the path
+        np.savez(f, **arrays)
+
+def load_split(path, kg):
+    """
+    Load split indices saved by `save_split`.
+
+    Raises
+    ------
+    ValueError
+        If the indices were computed on another graph.
+    """
+    arrays = np.load(path)
+    if str(arrays['checksum']) != checksum(kg):
+        raise ValueError(f'Split {path} was computed on a different graph.')
+    val_idx = torch.from_numpy(arrays['val']) if 'val' in arrays else None
+    return torch.from_numpy(arrays['train']), val_idx, torch.from_numpy(arrays['test'])
@@ -0,0 +1,241 @@
+import argparse
+import gc
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime as dt
+from time import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from src.dataset import load_dataset
+from src.split import subgraph
+
+# Hyperparameters that can be swept, and the methods or losses they apply to. Values of a hyperparameter that does not apply
+# to a configuration are not crossed with the others, ex: DistMult is not trained once per dissimilarity_type.
+GRID = ['method', 'ent_emb_dim', 'lr', 'margin', 'loss_fn', 'batch_size', 'dissimilarity_type', 'n_filters']
+APPLIES = {
+    'margin': lambda config: config['loss_fn'] == 'margin',
+    'dissimilarity_type': lambda config: config['method'] in ['TransE', 'TorusE'],
+    'n_filters': lambda config: config['method'] == 'ConvKB',
+}
+
+_split = None # (kg_train, kg_val, kg_test), set before the worker processes are forked so that they share it read-only
+
+
+def grid(space):
+    """
+    Configurations of a grid search, without duplicates differing only by hyperparameters that do not apply to them.
+
+    Parameters
+    ----------
+    space : dict
+        Values of each hyperparameter, ex: {'method': ['TransE', 'DistMult'], 'lr': [0.001, 0.0001]}.
+
+    Returns
+    -------
+    list of dict
+    """
+    configs, seen = [], set()
+    for values in itertools.product(*space.values()):
+        config = dict(zip(space.keys(), values))
+        for key, applies in APPLIES.items():
+            if key in config and not applies(config):
+                config[key] = space[key][0]
+        if tuple(config.values()) not in seen:
+            seen.add(tuple(config.values()))
+            configs.append(config)
+    return configs
+
+
+class ASHA:
+    """
+    Asynchronous successive halving (Li et al., 2020, "A System for Massively Parallel Hyperparameter Tuning").
+    Rungs are at min_epochs * eta^k epochs. A trial reaching a rung keeps training only if its validation loss is
+    among the best 1/eta of the losses recorded at that rung so far, so that roughly one trial in eta reaches the next rung.
+    Decisions never wait for other trials: workers stay busy and early trials are judged against fewer competitors.
+
+    Parameters
+    ----------
+    min_epochs : int
+        Epochs of the first rung.
+    max_epochs : int
+        Epochs of the trials that are never stopped.
+    eta : int
+        Reduction factor between rungs.
+    manager : multiprocessing.managers.SyncManager
+        Holds the rung records shared by the worker processes.
+    """
+    def __init__(self, min_epochs, max_epochs, eta, manager):
+        self.eta = eta
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.records = [manager.list() for _ in self.rungs]
+        self.lock = manager.Lock()
+
+    def should_stop(self, epoch, loss):
+        """Record `loss` if `epoch` is a rung, and whether the trial should stop there."""
+        if epoch not in self.rungs:
+            return False
+        if not np.isfinite(loss):
+            return True
+        records = self.records[self.rungs.index(epoch)]
+        with self.lock:
+            records.append(loss)
+            cutoff = np.percentile(list(records), 100 / self.eta)
+        return loss > cutoff
+
+
+def run_trial(trial, config, scheduler, timestart, log_dir, n_threads):
+    """
+    Train one configuration on the shared split until `scheduler` stops it or config['n_epochs'] is reached,
+    then evaluate it on the test set if it was not stopped. Logs go to {log_dir}/trial_{trial}.log.
+
+    Returns
+    -------
+    dict
+        A row of the results table.
+    """
+    from src.train import train, evaluate_emb_model
+
+    torch.set_num_threads(n_threads)
+    logger = logging.getLogger(f'sweep.trial_{trial}')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(os.path.join(log_dir, f'trial_{trial}.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+    history = []
+    def on_epoch(epoch, loss):
+        history.append(loss)
+        return scheduler.should_stop(epoch, loss)
+
+    t1 = time()
+    emb_model, _, kg_test = train(config['method'], _split, {**config, 'eval_task': None}, f'{timestart}_trial{trial}',
+                                  logger, torch.device('cpu'), on_epoch=on_epoch)
+    row = {'trial': trial, **{key: config[key] for key in GRID}, 'epochs': len(history),
+           'val_loss': history[-1], 'best_val_loss': min(history), 'train_time': time() - t1}
+    if len(history) == config['n_epochs'] and config['eval_task']: # Stopped trials are not evaluated
+        evaluator = evaluate_emb_model(emb_model, kg_test, config['eval_task'], torch.device('cpu'), logger, eval_mode=config['eval_mode'],
+                                       eval_candidates=config['eval_candidates'], eval_typed=config['eval_typed'])
+        row.update({f'Hit@{k}': evaluator.hit_at_k(k)[0] for k in [1, 3, 5, 10]})
+        row.update({'Mean Rank': evaluator.mean_rank()[0], 'MRR': evaluator.mrr()[0]})
+        if hasattr(evaluator, 'confidence_intervals'): # Sampled evaluation
+            row['MRR low'], row['MRR high'] = evaluator.confidence_intervals()['MRR']
+    logger.removeHandler(handler)
+    handler.close()
+    return row
+
+def sweep(dataset, space, config, min_epochs=1, eta=3, n_workers=1, output=None):
+    """
+    Grid search with asynchronous successive halving. The graph is loaded and split once, then trials run
+    in `n_workers` forked processes sharing the split, and are stopped at the rungs of `ASHA`
+    using the validation loss computed by `train` after each epoch.
+
+    Parameters
+    ----------
+    dataset : str
+        Space separated triple file or integer-encoded dataset directory.
+    space : dict
+        Values of each swept hyperparameter (see GRID).
+    config : dict
+        Fixed arguments of `train`. config['n_epochs'] is the budget of the trials that are never stopped.
+    output : str, optional
+        Path of the results table (.csv). Defaults to models/sweep_{timestart}.csv.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per trial, sorted by final validation loss.
+    """
+    from src.train import split
+
+    global _split
+    timestart = dt.now().strftime("%Y-%m-%d_%H-%M-%S")
+    kg = load_dataset(dataset)
+    train_idx, val_idx, test_idx = split(kg, split_ratio=config['split_ratio'], validation=True, stratify=config['stratify'],
+                                         seed=config['seed'], split_file=config['split_file'])
+    if val_idx is None: # Trials are scheduled on their validation loss
+        raise ValueError(f'The split file {config["split_file"]} has no validation set: pass one saved with --validation (see main.py).')
+    _split = subgraph(kg, train_idx), subgraph(kg, val_idx), subgraph(kg, test_idx)
+    gc.freeze() # Moves the split out of the collected generations, as src.evaluate does for its test graph
+
+    configs = grid(space)
+    log_dir = f'logs/sweep_{timestart}'
+    os.makedirs(log_dir, exist_ok=True)
+    print(f'{len(configs)} configurations, {n_workers} workers, trial logs in {log_dir}')
+
+    ctx = mp.get_context('fork')
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    rows = []
+    with ctx.Manager() as manager:
+        scheduler = ASHA(min_epochs, config['n_epochs'], eta, manager)
+        print(f'Rungs at epochs {scheduler.rungs}, budget {config["n_epochs"]} epochs')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+            futures = [executor.submit(run_trial, trial, {**config, **params}, scheduler, timestart, log_dir, n_threads)
+                       for trial, params in enumerate(configs)]
+            for future in as_completed(futures):
+                row = future.result()
+                rows.append(row)
+                print(f'{dt.now()} - trial {row["trial"]} done after {row["epochs"]} epochs, val loss: {row["val_loss"]:.4f} '
+                      f'({len(rows)}/{len(configs)})')
+    gc.unfreeze()
+
+    results = pd.DataFrame(rows).sort_values('val_loss').reset_index(drop=True)
+    output = output or f'models/sweep_{timestart}.csv'
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    results.to_csv(output, index=False)
+    print(results.to_string())
+    print(f'Results saved to {output}')
+    return results
+
+if __name__ == '__main__':
+    # ex: python -m src.sweep --dataset toy-example --method TransE DistMult --lr 0.001 0.0001 --ent_emb_dim 50 100 --n_epochs 27
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep with asynchronous successive halving')
+    parser.add_argument('--dataset', required=True, help='Triple file or integer-encoded dataset directory. "toy-example" for the debug dataset.')
+
+    # Swept hyperparameters, one or more values each
+    parser.add_argument('--method', nargs='+', required=True, help='Names of the methods')
+    parser.add_argument('--ent_emb_dim', nargs='+', default=[50], type=int, help='Sizes of entity embeddings')
+    parser.add_argument('--lr', nargs='+', default=[0.0001], type=float, help='Learning rates')
+    parser.add_argument('--margin', nargs='+', default=[1], type=float, help='Margins of the margin loss')
+    parser.add_argument('--loss_fn', nargs='+', default=['margin'], help='Loss functions, among "margin", "bce", "logistic"')
+    parser.add_argument('--batch_size', nargs='+', default=[128], type=int, help='Batch sizes')
+    parser.add_argument('--dissimilarity_type', nargs='+', default=['L1'], help='Dissimilarities of TransE and TorusE')
+    parser.add_argument('--n_filters', nargs='+', default=[10], type=int, help='Numbers of ConvKB filters')
+
+    # Scheduling
+    parser.add_argument('--n_epochs', default=27, type=int, help='Epochs of the trials that are never stopped')
+    parser.add_argument('--min_epochs', default=1, type=int, help='Epochs of the first rung')
+    parser.add_argument('--eta', default=3, type=int, help='Reduction factor: about 1/eta of the trials reaching a rung reach the next one')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of trials trained in parallel')
+    parser.add_argument('--output', default=None, help='Results table (.csv). Defaults to models/sweep_{timestart}.csv')
+
+    # Fixed arguments, see main.py
+    parser.add_argument('--rel_emb_dim', default=50, type=int, help='Size of relation embeddings')
+    parser.add_argument('--weight_decay', default=0.0001, type=float, help='Weight decay')
+    parser.add_argument('--normalize_parameters', action='store_true', help='Whether to normalize entity embeddings')
+    parser.add_argument('--eval_task', default='relation-prediction', help='Task on which the trials trained for n_epochs are evaluated')
+    parser.add_argument('--eval_mode', default='full', choices=['full', 'sampled'], help='Link prediction against all entities ("full") or sampled negatives ("sampled")')
+    parser.add_argument('--eval_candidates', default=100, type=int, help='Negatives per test triple with --eval_mode sampled')
+    parser.add_argument('--eval_typed', action='store_true', help='Draw the sampled negatives of a relation among its heads or tails')
+    parser.add_argument('--split_ratio', default=0.8, type=float, help='train/test ratio')
+    parser.add_argument('--stratify', action='store_true', help='Apply split_ratio per relation')
+    parser.add_argument('--seed', default=None, type=int, help='Seed of the train/validation/test split')
+    parser.add_argument('--split_file', default=None, help='Split indices (.npz) are loaded from this file if it exists, else written to it')
+    args = vars(parser.parse_args())
+
+    dataset = 'data/raw/toy-example.txt' if args['dataset'] == 'toy-example' else args['dataset']
+    space = {key: args.pop(key) for key in GRID}
+    scheduling = {key: args.pop(key) for key in ['dataset', 'min_epochs', 'eta', 'workers', 'output']}
+    config = {**args, 'init_transe': False, 'scalar_share': 0.5, 'save_model': False, 'prefetch_workers': 0}
+    sweep(dataset, space, config, min_epochs=scheduling['min_epochs'], eta=scheduling['eta'], n_workers=scheduling['workers'],
+          output=scheduling['output'])
@@ -0,0 +1,144 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.dataset import encode, save_encoded
+
+# Namespaces of the SPARQL exports (see sparql_queries/PREFIXES.txt)
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+SUBCLASS_OF = 'http://www.w3.org/2000/01/rdf-schema#subClassOf'
+NT = 'http://www.semanticweb.org/needed-terms#'
+SIO = 'http://semanticscience.org/resource/SIO_'
+WBGENE = 'https://wormbase.org/species/c_elegans/gene/WBGene'
+WBPHENO = 'https://wormbase.org/species/all/phenotype/WBPhenotype:'
+WBDATA = 'https://wormbase.org/wbdata/'
+WBINTER = 'https://wormbase.org/wbinter/'
+WBEXP = 'https://wormbase.org/species/all/expr_pattern/Expr'
+WBLS = 'https://wormbase.org/search/life_stage/WBls:'
+DOID = 'https://disease-ontology.org/?id=DOID:'
+
+# Gene types of the molecular-entity query, the first ones most frequent
+GENE_TYPES = ['000985', '010035', '000988', '000790', '001230', '001182', '001227', '001228', '001229']
+INTERACTION_TYPES = ['physical', 'genetic', 'regulatory', 'predicted']
+
+# Share of the entities of each kind. Annotation nodes (phenotype, disease, interaction, expression pattern) link genes to terms.
+SHARES = {
+    'gene': 0.25,
+    'phenotype_annotation': 0.35,
+    'not_phenotype_annotation': 0.05,
+    'phenotype': 0.03,
+    'disease_annotation': 0.04,
+    'disease': 0.02,
+    'interaction': 0.17,
+    'expression_pattern': 0.085,
+    'lifestage': 0.005,
+}
+
+
+def zipf(rng, n, size, exponent=1.0):
+    """`size` indices in [0, n) drawn with probability proportional to 1 / rank**exponent, the ranks of the indices being shuffled."""
+    p = 1.0 / np.arange(1, n + 1) ** exponent
+    return rng.permutation(n)[rng.choice(n, size=size, p=p / p.sum())]
+
+def hierarchy(rng, n):
+    """
+    Parent of each term of an ontology of `n` terms, -1 for the root. Each term picks its parent among the terms before it,
+    with probability proportional to their number of children + 1 (preferential attachment), so that a few terms are broad classes.
+    """
+    parents = np.full(n, -1)
+    pool = [0] # Each term once, and once more per child
+    draws = rng.random(n)
+    for i in range(1, n):
+        parents[i] = pool[int(draws[i] * len(pool))]
+        pool += [parents[i], i]
+    return parents
+
+def generate_graph(n_entities, seed=0, exponent=1.0):
+    """
+    Synthetic graph with the schema of the SPARQL exports (see sparql_queries), for benchmarks:
+        - genes typed with SIO gene classes (rdf:type),
+        - phenotype, disease and life stage ontologies (rdfs:subClassOf),
+        - phenotype annotations (nt:001 gene, sio:001279 phenotype, or sio:000281 for not-phenotypes),
+        - disease annotations (nt:001 gene, nt:009 disease),
+        - interactions (nt:001 gene twice, sio:000628 interaction type),
+        - expression patterns (nt:001 gene, nt:002 life stage).
+    Genes and terms are picked by annotations from Zipf distributions, so that degrees are skewed as in the real data.
+
+    Parameters
+    ----------
+    n_entities : int
+        Approximate number of entities, split between kinds by SHARES.
+    seed : int
+        Seed of the generator. The same seed and size give the same graph.
+    exponent : float
+        Exponent of the Zipf distributions. Larger values concentrate annotations on fewer genes and terms.
+
+    Returns
+    -------
+    pd.DataFrame
+        Triples with columns [from, rel, to], like `src.dataset.read_triples`.
+    """
+    rng = np.random.default_rng(seed)
+    n = {kind: max(2, int(share * n_entities)) for kind, share in SHARES.items()}
+    genes = np.array([f'{WBGENE}{i:08d}' for i in range(n['gene'])], dtype=object)
+    phenotypes = np.array([f'{WBPHENO}{i:07d}' for i in range(n['phenotype'])], dtype=object)
+    diseases = np.array([f'{DOID}{i}' for i in range(n['disease'])], dtype=object)
+    lifestages = np.array([f'{WBLS}{i:07d}' for i in range(n['lifestage'])], dtype=object)
+    parts = []
+
+    def add(heads, rel, tails):
+        parts.append(pd.DataFrame({'from': heads, 'rel': rel, 'to': tails}))
+
+    # Genes and ontologies
+    type_p = 1.0 / np.arange(1, len(GENE_TYPES) + 1) ** 3
+    add(genes, RDF_TYPE, np.array([SIO + t for t in GENE_TYPES], dtype=object)[rng.choice(len(GENE_TYPES), n['gene'], p=type_p / type_p.sum())])
+    for terms in (phenotypes, diseases, lifestages):
+        parents = hierarchy(rng, len(terms))
+        add(terms[1:], SUBCLASS_OF, terms[parents[1:]])
+
+    # Annotation nodes, each linked to a gene and a term
+    annotations = [('phenotype_annotation', 'pheno-', phenotypes, SIO + '001279'),
+                   ('not_phenotype_annotation', 'not-pheno-', phenotypes, SIO + '000281'),
+                   ('disease_annotation', 'disease-', diseases, NT + '009'),
+                   ('expression_pattern', WBEXP, lifestages, NT + '002')]
+    for kind, prefix, terms, rel in annotations:
+        nodes = np.array([f'{prefix if prefix.startswith("http") else WBDATA + prefix}{i}' for i in range(n[kind])], dtype=object)
+        add(nodes, NT + '001', genes[zipf(rng, len(genes), len(nodes), exponent)])
+        add(nodes, rel, terms[zipf(rng, len(terms), len(nodes), exponent)])
+
+    # Interactions between two distinct genes
+    nodes = np.array([f'{WBINTER}{i}' for i in range(n['interaction'])], dtype=object)
+    first = zipf(rng, len(genes), len(nodes), exponent)
+    second = (first + 1 + rng.integers(0, len(genes) - 1, len(nodes))) % len(genes)
+    add(nodes, NT + '001', genes[first])
+    add(nodes, NT + '001', genes[second])
+    add(nodes, SIO + '000628', np.array([f'{WBINTER}type/{t}' for t in INTERACTION_TYPES], dtype=object)[rng.integers(0, len(INTERACTION_TYPES), len(nodes))])
+
+    return pd.concat(parts, ignore_index=True)
+
+def synthetic_path(n_entities, seed=0, directory='data/synthetic'):
+    return os.path.join(directory, f'wormbase_{n_entities}_{seed}')
+
+def write_graph(df, path, encoded=True):
+    """Write triples as an integer-encoded dataset directory (see `src.dataset.save_encoded`), or as a space separated file like query_result.txt."""
+    if encoded:
+        save_encoded(path, *encode(df))
+    else:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        df.to_csv(path, sep=' ', header=False, index=False)
+
+if __name__ == '__main__':
+    # ex: python -m src.synthetic 100000 -> data/synthetic/wormbase_100000_0, to be used as --dataset
+    parser = argparse.ArgumentParser(description='Generate a synthetic graph with the schema of the WormBase SPARQL exports')
+    parser.add_argument('n_entities', type=int, help='Approximate number of entities, ex: 10000 to 1000000')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generator')
+    parser.add_argument('--exponent', type=float, default=1.0, help='Exponent of the Zipf degree distributions')
+    parser.add_argument('--output', type=str, default=None, help='Output path. Defaults to data/synthetic/wormbase_{n_entities}_{seed}')
+    parser.add_argument('--text', action='store_true', help='Write a space separated triple file instead of an integer-encoded dataset directory')
+    args = parser.parse_args()
+    df = generate_graph(args.n_entities, seed=args.seed, exponent=args.exponent)
+    output = args.output or synthetic_path(args.n_entities, args.seed) + ('.txt' if args.text else '')
+    write_graph(df, output, encoded=not args.text)
+    print(f'{len(df)} triples, {pd.concat([df["from"], df["to"]]).nunique()} entities, {df["rel"].nunique()} relations written to {output}')
@@ -0,0 +1,103 @@
+import json
+import os
+from datetime import datetime as dt
+from resource import getrusage, RUSAGE_SELF
+from time import time
+
+PROM_PREFIX = 'kgene'
+PROM_SKIP = {'epoch'} # Values identifying an event rather than measuring it, kept in the JSON lines only
+
+
+def peak_rss_mib():
+    """Peak resident set size of the process since it started, in MiB."""
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024
+
+def prom_labels(labels):
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(escaped.items())) + '}'
+
+
+class Telemetry:
+    """
+    Structured metrics of a run. Each event is appended to a JSON lines file as soon as it is emitted, and its numeric values
+    are exported as gauges in a Prometheus textfile (for the node_exporter textfile collector), rewritten after each event.
+    A gauge is named {PROM_PREFIX}_{event}_{key} and keeps the last value emitted for its labels, ex: the metrics of the last epoch.
+    Events are dropped until `configure` is called, so that instrumented code runs unchanged without telemetry.
+
+    Attributes
+    ----------
+    labels : dict
+        Labels of the run (ex: method, dataset, start time), added to every event and gauge.
+    """
+    def __init__(self):
+        self.jsonl_path = None
+        self.prom_path = None
+        self.labels = {}
+        self.gauges = {}
+
+    @property
+    def enabled(self):
+        return self.jsonl_path is not None or self.prom_path is not None
+
+    def configure(self, jsonl_path=None, prom_path=None, **labels):
+        """Start writing events to `jsonl_path` and/or gauges to `prom_path`, with `labels` on all of them."""
+        for path in (jsonl_path, prom_path):
+            if path and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.jsonl_path, self.prom_path = jsonl_path, prom_path
+        self.labels = labels
+        self.gauges = {}
+
+    def emit(self, event, labels=None, **values):
+        """
+        Record an event.
+
+        Parameters
+        ----------
+        event : str
+            Name of the event, ex: stage or epoch.
+        labels : dict, optional
+            Labels of the event besides the run labels, ex: {'stage': 'split'}.
+        **values : int / float / str
+            Values of the event. Numeric ones, but those of PROM_SKIP, are exported as gauges.
+        """
+        if not self.enabled:
+            return
+        labels = {**self.labels, **(labels or {})}
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f: # One write per line, so that processes of a sweep can share the file
+                f.write(json.dumps({'time': str(dt.now()), 'event': event, **labels, **values}) + '\n')
+        if self.prom_path:
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key not in PROM_SKIP:
+                    self.gauges[(f'{PROM_PREFIX}_{event}_{key}', prom_labels(labels))] = value
+            self.write_prom()
+
+    def stage(self, name, seconds, **values):
+        """Record the wall time of a pipeline stage (query, split, train, evaluation, ...) and the peak RSS at its end."""
+        self.emit('stage', labels={'stage': name}, seconds=seconds, peak_rss_mib=peak_rss_mib(), **values)
+
+    def write_prom(self):
+        lines = []
+        for name in sorted({name for name, _ in self.gauges}):
+            lines.append(f'# TYPE {name} gauge')
+            lines += [f'{name}{labels} {value}' for (metric, labels), value in sorted(self.gauges.items()) if metric == name]
+        tmp = f'{self.prom_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f: # Renamed into place, so that the collector never reads a partial file
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom_path)
+
+
+class Timer:
+    """Context manager measuring wall time, ex: `with Timer() as t: ...` then `t.seconds`."""
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time() - self.start
+        return False
+
+
+# Telemetry of the current process, configured by main.py
+TELEMETRY = Telemetry()
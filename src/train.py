@@ -2,6 +2,8 @@ import pandas as pd
 from tqdm import tqdm
 from datetime import datetime as dt
 import os
+from time import time
+from resource import getrusage, RUSAGE_SELF
 # import wandb
 
 # from ignite.engine import Engine, Events
@@ -16,12 +18,29 @@ from torchkge.models import *
 from torchkge.sampling import BernoulliNegativeSampler
 from torchkge.utils import MarginLoss, LogisticLoss, BinaryCrossEntropyLoss, DataLoader
 from torchkge.data_structures import KnowledgeGraph
-from sklearn.metrics import confusion_matrix
 
-from src.utils import timer_func, evaluate_emb_model
+from src.utils import timer_func
+from src.dataset import is_encoded, load_encoded, save_snapshot
+from src.split import split_indices, subgraph, save_split, load_split
+from src.pipeline import BatchPipeline
+from src.sparse import SPARSE_METHODS, make_sparse, sparse_optimizer, touched_rows_penalty
+from src.precision import autocast, scoring_model
+from src.compile import forward_loss, compiled_loss, compiled_scoring
+from src.partition import train_partitioned
+from src.hogwild import HogwildPool
+from src.validation import Validator
+from src.negatives import make_sampler
+from src.autotune import autotune, AUTOTUNE_FILE
+from src.telemetry import TELEMETRY, Timer, peak_rss_mib
+from src.ranking import ChunkedLinkPredictionEvaluator, BatchedRelationPredictionEvaluator, EVAL_MEMORY, save_report, \
+    link_prediction_breakdown, link_prediction_report
+from src.sampled import SampledLinkPredictionEvaluator
+from src.registry import REGISTRY_DIR
+import src.registry
+from src.checkpoint import CHECKPOINT_DIR, checkpoint_paths, save_checkpoint, load_checkpoint, restore_rng, checkpoint_split
 
 @timer_func
-def train(method, dataset, config, timestart, logger, device):
+def train(method, dataset, config, timestart, logger, device, on_epoch=None):
     """
     Train the embedding model using the specified method and dataset.
 
@@ -30,12 +49,16 @@ def train(method, dataset, config, timestart, logger, device):
     method : str
         The embedding method to use.
     dataset : str / tuple
-        The file location of the dataset.
+        The file location of the dataset. Either a space separated triple file or a directory
+        holding an integer-encoded dataset (see src.dataset).
         Can also be a tuple containing the train/test split in case of a TransE init of convkb.
     config : dict
         CLI arguments.
     timestart : datetime.datetime
         The starting time of the training. Used for logging.
+        When resuming from a checkpoint (config['resume']), the starting time of the resumed run is used instead for checkpoint names.
+    on_epoch : callable, optional
+        Called with the epoch number and the validation loss after each epoch. Training stops when it returns True (see src.sweep).
 
     Returns
     -------
@@ -47,23 +70,38 @@ def train(method, dataset, config, timestart, logger, device):
         The test knowledge graph.
     """
 
+    checkpoint = load_checkpoint(config['resume'], method, device) if config.get('resume') else None
+    if checkpoint is not None:
+        timestart = checkpoint['timestart']
+
     # Dataset loading and splitting
     if type(dataset) == str:
-        df = pd.read_csv(dataset, sep=' ', header=None, names=['from', 'rel', 'to'])
-        kg = KnowledgeGraph(df) # Create a knowledge graph from the dataframe
+        if is_encoded(dataset):
+            kg = load_encoded(dataset) # Memory-mapped integer triples, no string parsing
+        else:
+            df = pd.read_csv(dataset, sep=' ', header=None, names=['from', 'rel', 'to'])
+            kg = KnowledgeGraph(df) # Create a knowledge graph from the dataframe
+
+        if checkpoint is not None and checkpoint['split'] is not None:
+            logger.info('Reusing the split of the checkpoint..')
+            split_idx = checkpoint_split(checkpoint, kg)
+        else:
+            logger.info('Splitting knowledge graph..')
+            split_idx = split(kg, split_ratio=config['split_ratio'], validation=config.get('validation', False),
+                              stratify=config.get('stratify', False), seed=config.get('seed'), split_file=config.get('split_file'))
+        kg_train, kg_test = subgraph(kg, split_idx[0]), subgraph(kg, split_idx[2])
+        kg_val = subgraph(kg, split_idx[1]) if split_idx[1] is not None else kg_test # Validation loss is computed on the test set if there is no validation set
 
-        logger.info('Splitting knowledge graph..')
-        kg_train, kg_test = split(kg, split_ratio=config['split_ratio'], validation=False)
-        
-        if kg.n_ent != kg_train.n_ent:
-            raise ValueError('Some entities are not present in the training set. \n \
-                            All entities should be seen during training, else the model will not be able to generate an embedding for unseen entities.')
         # logger.info number of entities and relations in each set:
         logger.info(f'Train set')
         logger.info(f'Number of entities: {kg_train.n_ent}')
         logger.info(f'Number of relation types: {kg_train.n_rel}')
         logger.info(f'Number of triples: {kg_train.n_facts} \n')
 
+        if split_idx[1] is not None:
+            logger.info(f'Validation set')
+            logger.info(f'Number of triples: {kg_val.n_facts}\n')
+
         logger.info(f'Test set')
         logger.info(f'Number of entities: {kg_test.n_ent}')
         logger.info(f'Number of relation types: {kg_test.n_rel}')
@@ -74,42 +112,59 @@ def train(method, dataset, config, timestart, logger, device):
                 This is usually due to a relation not being present in the validation or test set. \n \
                 It usually boils down to one directed relation type leading to an unconnected node. A classical example are "label" relations.')
 
-    else: # In case of a transe init, reuse the split to avoid data leakage
-        logger.info('Initializing ConvKB by training a TransE from scratch. Reusing split..')
-        kg_train, kg_test = dataset
+    else: # A split given by the caller (TransE init of ConvKB, sweeps), reused to avoid data leakage
+        logger.info('Reusing the given split..')
+        kg_train, kg_val, kg_test = dataset
+        kg, split_idx = None, None
 
 
+    # Define the loss function
+    # Add your own custom losses as another case
+    match config['loss_fn']:
+        case "margin":
+            criterion = MarginLoss(margin=config['margin'])
+        case "logistic":
+            criterion = LogisticLoss()
+        case "bce":
+            criterion = BinaryCrossEntropyLoss()
+        case _:
+            raise ValueError(f"Loss function {config['loss_fn']} not supported.")
+
+    if config.get('memory_budget'): # Out-of-core training, the full entity tables are never held in memory (see src.partition)
+        if method == 'ConvKB' and type(config['init_transe']) == list:
+            raise ValueError('init_transe is not supported with memory_budget.')
+        if config.get('neg_sampler', 'bernoulli') != 'bernoulli':
+            raise ValueError('Only the bernoulli negative sampler is supported with memory_budget.')
+        if method in ('TransH', 'TransR', 'TransD'): # Their projected_entities cache is (n_rel, n_ent, dim), larger than the tables being partitioned
+            raise ValueError(f'{method} is not supported with memory_budget.')
+        validator = Validator(kg_val, criterion, None, {**config, 'val_background': False}, device) # Snapshots would hold the full tables
+        emb_model = train_partitioned(method, lambda n_ent: build_model(method, config, n_ent, kg_train.n_rel), kg_train, criterion, config, timestart,
+                                      logger, device, val_loss=validator)
+        logger.info(f'{dt.now()} - Finished Training of {method} !\n')
+        return save_and_evaluate(emb_model, kg, kg_train, kg_test, split_idx, method, config, timestart, logger, device)
+
     # Initialize the embedding model
     match method:
-        case "TransE":
-            emb_model = TransEModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel, dissimilarity_type=config['dissimilarity_type'])
-        case "TransH":
-            emb_model = TransHModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "TransR":
-            emb_model = TransRModel(config['ent_emb_dim'], config['rel_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "TransD":
-            emb_model = TransDModel(config['ent_emb_dim'], config['rel_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "TorusE":
-            emb_model = TorusEModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel, dissimilarity_type=config['dissimilarity_type']) #dissim type one of  ‘torus_L1’, ‘torus_L2’, ‘torus_eL2’.
-        case "RESCAL":
-            emb_model = RESCALModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "DistMult":
-            emb_model = DistMultModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "HolE":
-            emb_model = HolEModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "ComplEx":
-            emb_model = ComplExModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel)
-        case "ANALOGY":
-            emb_model = AnalogyModel(config['ent_emb_dim'], kg_train.n_ent, kg_train.n_rel, config['scalar_share'])
         case "ConvKB":
-            if type(config['init_transe']) == list:
+            if type(config['init_transe']) == list and checkpoint is None: # Resumed weights replace the TransE init anyway
                 # Decide whether to train a TransE from scratch or load a pretrained one
                 if not config['init_transe']: # No args
                     config['init_transe'] = 'True'
-                    # Train a TransE model to initialize the embeddings.
+                    # Reuse the TransE trained with the same hyperparameters on the same training set if registered, else train one and register it.
                     # Config will be the same as the one used for ConvKB unless a path is specified as arg.
-                    init_model, _, _ = train('TransE', (kg_train, kg_test), config, timestart, logger, device)
-                    logger.info('TransE model trained.')
+                    registry_dir = config.get('registry_dir', REGISTRY_DIR)
+                    path = None if config.get('no_registry') else src.registry.lookup(registry_dir, 'TransE', kg_train, config)
+                    if path is not None:
+                        init_model = build_model('TransE', config, kg_train.n_ent, kg_train.n_rel)
+                        init_model.load_state_dict(torch.load(path, map_location='cpu'))
+                        logger.info(f'TransE model loaded from the registry: {path}')
+                    else:
+                        logger.info('Initializing ConvKB by training a TransE from scratch.')
+                        # On a copy, so that arguments tuned by this run (ex: --autotune batch_size) do not change the key it is stored under
+                        init_model, _, _ = train('TransE', (kg_train, kg_val, kg_test), dict(config), timestart, logger, device)
+                        logger.info('TransE model trained.')
+                        if not config.get('no_registry'):
+                            logger.info(f'TransE model registered: {src.registry.store(registry_dir, "TransE", kg_train, config, init_model)}')
 
                 else:
                     # Load a pretrained TransE model
@@ -125,41 +180,103 @@ def train(method, dataset, config, timestart, logger, device):
 
                 # Initialize the ConvKB model's weights with the TransE embeddings
                 ent_emb, rel_emb = init_model.get_embeddings()
-                emb_model = ConvKBModel(config['ent_emb_dim'], config['n_filters'], kg_train.n_ent, kg_train.n_rel)
+                emb_model = build_model(method, config, kg_train.n_ent, kg_train.n_rel)
                 emb_model.ent_emb.weight.data = ent_emb
                 emb_model.rel_emb.weight.data = rel_emb
                 logger.info('ConvKB model initialized with TransE embeddings.')
             else:
-                emb_model = ConvKBModel(config['ent_emb_dim'], config['n_filters'], kg_train.n_ent, kg_train.n_rel)
+                emb_model = build_model(method, config, kg_train.n_ent, kg_train.n_rel)
 
         case _:
-            raise ValueError(f"Method {method} not supported.")
+            emb_model = build_model(method, config, kg_train.n_ent, kg_train.n_rel)
         
     # wandb.watch(emb_model, log="all")
 
-    # Define the loss function, the dataloaders, the optimizer and the negative samplers
-    # Add your own custom losses as another case
-    match config['loss_fn']:
-        case "margin":
-            criterion = MarginLoss(margin=config['margin'])
-        case "logistic":
-            criterion = LogisticLoss()
-        case "bce":
-            criterion = BinaryCrossEntropyLoss()
-        case _:
-            raise ValueError(f"Loss function {config['loss_fn']} not supported.")
- 
-    dataloader = DataLoader(kg_train, batch_size=config['batch_size'], use_cuda='None')
-    optimizer = Adam(emb_model.parameters(), lr=config['lr'], weight_decay=1e-5)
-    sampler = BernoulliNegativeSampler(kg_train)
-
-    test_dataloader = DataLoader(kg_test, batch_size=config['batch_size'], use_cuda='None')
-    test_sampler = BernoulliNegativeSampler(kg_test)
+    # Define the dataloaders, the optimizer and the negative samplers
+    sparse = config.get('sparse', False)
+    precision = config.get('precision', 'fp32')
+    if sparse: # Only the embedding rows used by a batch get gradients, optimizer updates and regularization
+        if method not in SPARSE_METHODS:
+            raise ValueError(f"Sparse training is only supported for {SPARSE_METHODS}.")
+        make_sparse(emb_model)
+
+    def make_optimizer(emb_model):
+        if sparse:
+            return sparse_optimizer(emb_model, lr=config['lr'])
+        return Adam(emb_model.parameters(), lr=config['lr'], weight_decay=config['weight_decay'])
+
+    loss_fn = compiled_loss(logger) if config.get('compile') else forward_loss # Forward and loss compiled on the first batch (see src.compile)
+
+    # Time spent in each phase of the steps of the current epoch. GPU work is awaited at phase ends only if telemetry is on (see src.telemetry)
+    phase_time = dict.fromkeys(['forward', 'backward', 'optimizer'], 0.0)
+    sync = cuda.synchronize if device.type == 'cuda' and TELEMETRY.enabled else lambda: None
+
+    def step(emb_model, optimizer, batch):
+        h, t, r, n_h, n_t = batch # Positive triples and their negative samples, already on device
+        t1 = time()
+        optimizer.zero_grad()
+
+        # forward + backward + optimize
+        with autocast(precision, device): # bf16 forward and loss, fp32 weights and optimizer
+            loss = loss_fn(emb_model, criterion, h, t, r, n_h, n_t)
+        sync()
+        t2 = time()
+        if sparse and config['weight_decay']:
+            (loss + touched_rows_penalty(emb_model, config['weight_decay'], torch.cat((h, t, n_h, n_t)), r)).backward()
+        else:
+            loss.backward()
+        sync()
+        t3 = time()
+        optimizer.step()
+        loss = loss.item()
+        t4 = time()
+        phase_time['forward'] += t2 - t1
+        phase_time['backward'] += t3 - t2
+        phase_time['optimizer'] += t4 - t3
+        return loss
+
+    optimizer = make_optimizer(emb_model)
+    sampler = make_sampler(config.get('neg_sampler', 'bernoulli'), kg_train, emb_model, config) # Hard negatives are scored by emb_model (see src.negatives)
+    if config.get('autotune'): # Batch size and threads measured on a few steps, or reused from the profile of this model size (see src.autotune)
+        settings = autotune('train', method, emb_model, kg_train, device, path=config.get('autotune_file', AUTOTUNE_FILE), logger=logger,
+                            precision=precision, make_optimizer=make_optimizer, step=step, sampler=sampler, memory_limit=config.get('autotune_memory'))
+        config['batch_size'] = settings['batch_size']
+        torch.set_num_threads(settings['threads'])
+    # Positive batches and their negatives are produced ahead of time by background threads
+    dataloader = BatchPipeline(kg_train, sampler, config['batch_size'], device,
+                               n_workers=config.get('prefetch_workers', 1), queue_depth=config.get('prefetch_depth', 4))
 
     # Move to gpu if available
     emb_model.to(device)
     criterion.to(device)
 
+    # Validation every val_every epochs, on all of kg_val or a fixed subsample, in the loop or in a background process (see src.validation)
+    val_every = config.get('val_every', 1)
+    if config.get('val_background') and (config.get('patience') or on_epoch is not None):
+        raise ValueError('val_background is not supported with patience: early stopping needs the validation loss before the next epoch.')
+    validator = Validator(kg_val, criterion, emb_model, config, device)
+
+    # Resume from a checkpoint, early stopping state included
+    start_epoch, best_val_loss, bad_epochs = 0, None, 0
+    if checkpoint is not None:
+        emb_model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        start_epoch, best_val_loss, bad_epochs = checkpoint['epoch'], checkpoint['best_val_loss'], checkpoint['bad_epochs']
+        restore_rng(checkpoint)
+        logger.info(f'Resuming training from {config["resume"]} after epoch {start_epoch}.')
+    checkpoint_every, patience = config.get('checkpoint_every', 0), config.get('patience')
+    last_path, best_path = checkpoint_paths(config.get('checkpoint_dir', CHECKPOINT_DIR), method, timestart)
+
+    # Hogwild data-parallel training: worker processes update the shared model, each with its own optimizer and negatives (see src.hogwild)
+    pool = None
+    if config.get('workers', 1) > 1:
+        if device.type != 'cpu':
+            raise ValueError('workers is only supported on CPU.')
+        if checkpoint is not None:
+            raise ValueError('resume is not supported with workers: the optimizer states of the workers are not checkpointed.')
+        pool = HogwildPool(emb_model, kg_train, sampler, config['workers'], make_optimizer, step, config['batch_size'])
+        logger.info(f'Hogwild training with {config["workers"]} workers')
+
     # Log parameters
     logger.info(f'{dt.now()} - PARAMETERS')
     for i in config.items():
@@ -167,33 +284,129 @@ def train(method, dataset, config, timestart, logger, device):
 
     # Training loop
     logger.info(f'Training model {method} for {config["n_epochs"]} epochs...')
-    iterator = tqdm(range(config['n_epochs']), unit='epoch')
+    iterator = tqdm(range(start_epoch, config['n_epochs']), unit='epoch', initial=start_epoch, total=config['n_epochs'])
     for epoch in iterator:
-        running_loss = 0.0
-        for i, batch in enumerate(dataloader):
-            h, t, r = batch[0], batch[1], batch[2] # Generate batches of positive triples
-            n_h, n_t = sampler.corrupt_batch(h, t, r) # Generate negative samples
-
-            optimizer.zero_grad()
-
-            # forward + backward + optimize
-            h, t, r, n_h, n_t = h.to(device), t.to(device), r.to(device), n_h.to(device), n_t.to(device)
-            pos, neg = emb_model(h, t, r, n_h, n_t)
-            loss = criterion(pos, neg)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-        
-        validation_loss = val_loss(test_dataloader, test_sampler, emb_model, criterion, device) # Compute validation loss
-        logger.info(f'{dt.now()} - {method} - Epoch {epoch + 1} | mean loss: { running_loss / len(dataloader)}, val loss: {validation_loss}')
+        epoch_start = time()
+        phase_time.update(dict.fromkeys(phase_time, 0.0))
+        if pool is not None:
+            running_loss, n_batches = pool.run_epoch()
+        else:
+            running_loss, n_batches = 0.0, len(dataloader)
+            for batch in dataloader:
+                running_loss += step(emb_model, optimizer, batch)
+
+        epoch_time = time() - epoch_start
+        validation_loss = None
+        if (epoch + 1) % val_every == 0 or epoch + 1 == config['n_epochs']:
+            with Timer() as val_timer:
+                validation_loss = validator(emb_model, epoch + 1) # None when computed in the background
+            TELEMETRY.stage('validation', val_timer.seconds, epoch=epoch + 1, background=bool(config.get('val_background')))
+        logger.info(f'{dt.now()} - {method} - Epoch {epoch + 1} | mean loss: { running_loss / n_batches}, val loss: {validation_loss}')
+        logger.info(f'\t epoch time: {epoch_time:.2f}s ({kg_train.n_facts / max(epoch_time, 1e-9):.0f} triples/s), data wait: {dataloader.wait_time:.2f}s ({100 * dataloader.wait_time / max(epoch_time, 1e-9):.1f}%), '
+                    f'val data wait: {validator.wait_time:.2f}s, peak RSS: {getrusage(RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+        # Phases are timed in the workers' processes with Hogwild, only totals are known here
+        phases = {} if pool is not None else {f'{phase}_seconds': seconds for phase, seconds in phase_time.items()}
+        TELEMETRY.emit('epoch', epoch=epoch + 1, loss=running_loss / n_batches, val_loss=validation_loss, seconds=epoch_time,
+                       sampling_seconds=dataloader.sample_time if pool is None else None, data_wait_seconds=dataloader.wait_time if pool is None else None,
+                       **phases, triples_per_second=kg_train.n_facts / max(epoch_time, 1e-9), peak_rss_mib=peak_rss_mib())
         # wandb.log({'loss': running_loss / len(dataloader)})
         # wandb.log({'val_loss': validation_loss})
 
         if config['normalize_parameters']: # Normalize embeddings after each epoch
-            emb_model.normalize_parameters()
+            if pool is not None:
+                pool.normalize_parameters() # In place, the workers keep training the same tensors
+            else:
+                emb_model.normalize_parameters()
+        if hasattr(sampler, 'refresh') and (epoch + 1) % config.get('neg_refresh', 1) == 0: # Hard negative caches follow the model
+            sampler.refresh()
+
+        for val_epoch, loss in validator.collect(): # Background validations finished meanwhile
+            logger.info(f'{dt.now()} - {method} - Epoch {val_epoch} | val loss: {loss}')
+
+        # Keep the best checkpoint, save the latest one every checkpoint_every epochs and stop early after `patience` validations without improvement
+        if validation_loss is not None:
+            if best_val_loss is None or validation_loss < best_val_loss:
+                best_val_loss, bad_epochs = validation_loss, 0
+                if checkpoint_every or patience:
+                    save_checkpoint(best_path, method, timestart, epoch + 1, emb_model, optimizer, kg, split_idx, best_val_loss, bad_epochs)
+            else:
+                bad_epochs += 1
+        if checkpoint_every and (epoch + 1) % checkpoint_every == 0:
+            save_checkpoint(last_path, method, timestart, epoch + 1, emb_model, optimizer, kg, split_idx, best_val_loss, bad_epochs)
+        if patience and bad_epochs >= patience:
+            logger.info(f'{dt.now()} - Early stopping after epoch {epoch + 1}: val loss did not improve for {patience} validations.')
+            break
+        if on_epoch is not None and validation_loss is not None and on_epoch(epoch + 1, validation_loss):
+            logger.info(f'{dt.now()} - Training stopped by the caller after epoch {epoch + 1}.')
+            break
+
+    for val_epoch, loss in validator.close():
+        logger.info(f'{dt.now()} - {method} - Epoch {val_epoch} | val loss: {loss}')
+    if pool is not None:
+        pool.close()
+
+    if patience and bad_epochs and os.path.exists(best_path): # Keep the weights of the best epoch
+        emb_model.load_state_dict(torch.load(best_path, map_location=device, weights_only=False)['model'])
+        logger.info(f'Restored the weights of the best epoch (val loss: {best_val_loss}) from {best_path}')
 
     logger.info(f'{dt.now()} - Finished Training of {method} !\n')
 
+    return save_and_evaluate(emb_model, kg, kg_train, kg_test, split_idx, method, config, timestart, logger, device)
+
+def build_model(method, config, n_ent, n_rel):
+    """
+    Build a freshly initialized embedding model. ConvKB is built without its TransE initialization (see `train`).
+
+    Parameters
+    ----------
+    method : str
+        The embedding method to use.
+    config : dict
+        CLI arguments.
+    n_ent : int
+        Number of entities.
+    n_rel : int
+        Number of relations.
+
+    Returns
+    -------
+    emb_model : torchkge.models.xxx
+    """
+    match method:
+        case "TransE":
+            return TransEModel(config['ent_emb_dim'], n_ent, n_rel, dissimilarity_type=config['dissimilarity_type'])
+        case "TransH":
+            return TransHModel(config['ent_emb_dim'], n_ent, n_rel)
+        case "TransR":
+            return TransRModel(config['ent_emb_dim'], config['rel_emb_dim'], n_ent, n_rel)
+        case "TransD":
+            return TransDModel(config['ent_emb_dim'], config['rel_emb_dim'], n_ent, n_rel)
+        case "TorusE":
+            return TorusEModel(config['ent_emb_dim'], n_ent, n_rel, dissimilarity_type=config['dissimilarity_type']) #dissim type one of  ‘torus_L1’, ‘torus_L2’, ‘torus_eL2’.
+        case "RESCAL":
+            return RESCALModel(config['ent_emb_dim'], n_ent, n_rel)
+        case "DistMult":
+            return DistMultModel(config['ent_emb_dim'], n_ent, n_rel)
+        case "HolE":
+            return HolEModel(config['ent_emb_dim'], n_ent, n_rel)
+        case "ComplEx":
+            return ComplExModel(config['ent_emb_dim'], n_ent, n_rel)
+        case "ANALOGY":
+            return AnalogyModel(config['ent_emb_dim'], n_ent, n_rel, config['scalar_share'])
+        case "ConvKB":
+            return ConvKBModel(config['ent_emb_dim'], config['n_filters'], n_ent, n_rel)
+        case _:
+            raise ValueError(f"Method {method} not supported.")
+
+def save_and_evaluate(emb_model, kg, kg_train, kg_test, split_idx, method, config, timestart, logger, device):
+    """
+    Save the trained model and its data if config['save_model'], then evaluate it on kg_test unless config['eval_task'] is None.
+
+    Returns
+    -------
+    emb_model, kg_train, kg_test
+        As returned by `train`.
+    """
     # Save the model and/or the data
     if os.path.exists('models') == False:
         os.mkdir('models')
@@ -202,51 +415,65 @@ def train(method, dataset, config, timestart, logger, device):
         torch.save(emb_model.state_dict(), f'models/{method}_{timestart}.pt')
         kg_train.get_df().to_csv(f'models/{method}_{timestart}_kg_train.csv')
         kg_test.get_df().to_csv(f'models/{method}_{timestart}_kg_test.csv')
+        save_snapshot(kg_train, f'models/{method}_{timestart}_kg_train.pkl') # Loaded by predict.py instead of the .csv
+        if split_idx is not None:
+            save_split(f'models/{method}_{timestart}_split.npz', kg, *split_idx)
 
     # Evaluate the model on a task to get performance (Hit@k, MRR)
-    evaluate_emb_model(emb_model, kg_test, config["eval_task"], device, logger=logger)
+    if config['eval_task']:
+        b_size = 264
+        report_path = config.get('eval_report') or (f'models/{method}_{timestart}_eval.json' if config['save_model'] else None)
+        if config.get('autotune'):
+            settings = autotune('eval', method, scoring_model(emb_model, config.get('precision', 'fp32')), kg_test, device,
+                                path=config.get('autotune_file', AUTOTUNE_FILE), logger=logger, precision=config.get('precision', 'fp32'),
+                                memory_limit=config.get('autotune_memory'), eval_mode=config.get('eval_mode', 'full'),
+                                eval_memory=config.get('eval_memory', EVAL_MEMORY), eval_threads=config.get('eval_threads', 1),
+                                eval_candidates=config.get('eval_candidates', 100), eval_typed=config.get('eval_typed', False))
+            b_size = settings['b_size']
+            torch.set_num_threads(settings['threads'])
+        evaluate_emb_model(emb_model, kg_test, config["eval_task"], device, logger=logger, precision=config.get('precision', 'fp32'),
+                           compile=config.get('compile', False), b_size=b_size, eval_memory=config.get('eval_memory', EVAL_MEMORY),
+                           eval_threads=config.get('eval_threads', 1), eval_mode=config.get('eval_mode', 'full'),
+                           eval_candidates=config.get('eval_candidates', 100), eval_typed=config.get('eval_typed', False),
+                           eval_undirected=config.get('eval_undirected', False),
+                           eval_types=config.get('eval_types', 'prefix'), report_path=report_path)
     return emb_model, kg_train, kg_test
 
 @timer_func
-def split(kg, split_ratio=0.8, validation=False):
-    return kg.split_kg(share=split_ratio, validation=validation)
-
-def val_loss(dataloader, sampler, emb_model, criterion, device='cpu'):
+def split(kg, split_ratio=0.8, validation=False, stratify=False, seed=None, split_file=None):
     """
-    Compute the validation loss of the embedding model.
+    Split a knowledge graph so that every entity and relation is seen during training (see src.split.split_indices).
 
     Parameters
     ----------
-    dataloader : torchkge.utils.DataLoader
-        The dataloader for the validation set.
-    sampler : torchkge.sampling.NegativeSampler
-        The negative sampler.
-    emb_model : torchkge.models.xxx
-        The embedding model.
-    criterion : torchkge.utils.LossFunction
-        The loss function.
+    kg : torchkge.data_structures.KnowledgeGraph
+        The knowledge graph to split.
+    split_ratio : float
+        Share of the triples in the training set.
+    validation : bool
+        Whether to also produce a validation set.
+    stratify : bool
+        Whether to apply `split_ratio` per relation.
+    seed : int, optional
+        Seed of the split.
+    split_file : str, optional
+        Split indices are loaded from this .npz file if it exists, else they are computed and written to it.
 
     Returns
     -------
-    float
-        The validation loss, averaged over all batches of the validation set.
+    tuple of torch.Tensor
+        Indices of the train, validation (None if `validation` is False) and test triples in `kg`.
     """
-    with torch.no_grad():
-        running_loss = 0.0
-        for i, batch in enumerate(dataloader):
-            h, t, r = batch[0], batch[1], batch[2]
-            n_h, n_t = sampler.corrupt_batch(h, t, r) # generate negative samples
-
-            # forward
-            h, t, r, n_h, n_t = h.to(device), t.to(device), r.to(device), n_h.to(device), n_t.to(device)
-            pos, neg = emb_model(h, t, r, n_h, n_t)
-            loss = criterion(pos, neg)
-            running_loss += loss.item()
-    return running_loss / len(dataloader)
-
+    if split_file and os.path.exists(split_file):
+        return load_split(split_file, kg)
+    split_idx = split_indices(kg, share=split_ratio, validation=validation, stratify=stratify, seed=seed)
+    if split_file:
+        save_split(split_file, kg, *split_idx)
+    return split_idx
 
 @timer_func
-def evaluate_emb_model(emb_model, kg_eval, task, device, logger):
+def evaluate_emb_model(emb_model, kg_eval, task, device, logger, precision='fp32', compile=False, b_size=264, eval_memory=EVAL_MEMORY, eval_threads=1,
+                       eval_mode='full', eval_candidates=100, eval_typed=False, eval_undirected=False, eval_types='prefix', report_path=None):
     """
     Evaluate the trained embedding model on a knowledge graph.
 
@@ -256,93 +483,89 @@ def evaluate_emb_model(emb_model, kg_eval, task, device, logger):
         The embedding model to be evaluated.
     kg_eval : torchkge.data_structures.KnowledgeGraph
         The knowledge graph used for evaluation.
+    precision : str
+        One of fp32, bf16. With bf16, candidates are scored by a bfloat16 copy of the model (see src.precision.scoring_model).
+    compile : bool
+        Whether candidates are scored by a compiled scoring function (see src.compile.compiled_scoring).
+    b_size : int
+        Number of test triples scored at once. Lower it if OOM error during evaluation (see src.autotune).
+    eval_memory : float
+        Link prediction: approximate memory (MiB) of the candidate score blocks (see src.ranking.ChunkedLinkPredictionEvaluator).
+    eval_threads : int
+        Link prediction: number of threads ranking batches of test triples concurrently.
+    eval_mode : str
+        Link prediction: full ranks test triples against all entities. sampled ranks them against `eval_candidates` filtered
+        negatives (see src.sampled.SampledLinkPredictionEvaluator) and logs bootstrap confidence intervals of the metrics.
+    eval_candidates : int
+        Number of negatives per test triple with eval_mode sampled.
+    eval_typed : bool
+        With eval_mode sampled, draw the negatives of a relation among the entities seen in the same position of this relation.
+    eval_undirected : bool
+        Relation prediction: also score the relations from tail to head, when the orientation of the test triples is unknown.
+    eval_types : str
+        Link prediction: types of the entities of the per-type metrics, from their namespace (prefix) or their rdf:type triples
+        (rdf:type), see src.entity_types.entity_types.
+    report_path : str, optional
+        Write the metrics per slice (link prediction: relation, head and tail type and signature, see src.ranking.link_prediction_breakdown;
+        relation prediction: relation, and the confusion matrix) to this .json file.
 
     Returns
     -------
-    None
+    evaluator : torchkge.evaluation.LinkPredictionEvaluator / RelationPredictionEvaluator
+        The evaluator holding the ranks of the test triples.
     """
         
     logger.info(f'{dt.now()} - Evaluating..')
-    b_size = 264 # Lower batch size if OOM error during evaluation
+    emb_model = scoring_model(emb_model, precision)
+    if compile:
+        emb_model = compiled_scoring(emb_model, logger)
 
     match task:
         case 'link-prediction':
-            evaluator = LinkPredictionEvaluator(emb_model, kg_eval)
+            if eval_mode == 'sampled':
+                evaluator = SampledLinkPredictionEvaluator(emb_model, kg_eval, n_candidates=eval_candidates, typed=eval_typed)
+            elif eval_mode == 'full':
+                evaluator = ChunkedLinkPredictionEvaluator(emb_model, kg_eval, memory_budget=eval_memory, n_threads=eval_threads)
+            else:
+                raise ValueError(f"Unknown eval_mode {eval_mode}, one of 'full', 'sampled'.")
             evaluator.evaluate(b_size=b_size, verbose=True)
             
             print(evaluator.rank_true_tails)
+            slices = link_prediction_breakdown(evaluator, type_source=eval_types)
+            for key in ['relation', 'signature']:
+                logger.info(f'Per {key}:\n{slices[key].to_string()}')
+            if report_path:
+                save_report(report_path, link_prediction_report(evaluator, slices, type_source=eval_types))
+                logger.info(f'{dt.now()} - Evaluation report saved to {report_path}')
         case 'relation-prediction':
-            evaluator = RelationPredictionEvaluator(emb_model, kg_eval)
-
-            use_cuda = next(evaluator.model.parameters()).is_cuda
-
-            if use_cuda:
-                dataloader = DataLoader(evaluator.kg, batch_size=b_size, use_cuda='batch')
-                evaluator.rank_true_rels = evaluator.rank_true_rels.cuda()
-                evaluator.filt_rank_true_rels = evaluator.filt_rank_true_rels.cuda()
-            else:
-                dataloader = DataLoader(evaluator.kg, batch_size=b_size)
-
-            all_scores, all_true_ranks = torch.tensor([]).to(device), torch.tensor([]).to(device)
-            for i, batch in tqdm(enumerate(dataloader), total=len(dataloader),
-                                    unit='batch', disable=(not True),
-                                    desc='Relation prediction evaluation'):
-                h_idx, t_idx, r_idx = batch[0], batch[1], batch[2]
-                h_emb, t_emb, r_emb, candidates = evaluator.model.inference_prepare_candidates(h_idx, t_idx, r_idx, entities=False)
-
-                scores = evaluator.model.inference_scoring_function(h_emb, t_emb, candidates)
-                filt_scores = filter_scores(scores, evaluator.kg.dict_of_rels, h_idx, t_idx, r_idx)
-
-                if not evaluator.directed:
-                    scores_bis = evaluator.model.inference_scoring_function(t_emb, h_emb, candidates)
-                    filt_scores_bis = filter_scores(scores_bis, evaluator.kg.dict_of_rels, h_idx, t_idx, r_idx)
-
-                    scores = cat((scores, scores_bis), dim=1)
-                    filt_scores = cat((filt_scores, filt_scores_bis), dim=1)
-
-                true_data = scores.gather(1, r_idx.long().view(-1, 1))
-                
-                ranks = (scores >= true_data).sum(dim=1).detach()
-                evaluator.rank_true_rels[i * b_size: (i + 1) * b_size] = ranks
-                evaluator.filt_rank_true_rels[i * b_size: (i + 1) * b_size] = (filt_scores >= true_data).sum(dim=1).detach()
-
-                ranks = (scores >= true_data).sum(dim=1).detach()
-                max_scores = torch.argmax(scores, dim=1)
-                all_scores = torch.cat((all_scores, max_scores), dim=0)
-                all_true_ranks = torch.cat((all_true_ranks, ranks), dim=0)
-
-            evaluator.evaluated = True
-
-            if use_cuda:
-                evaluator.rank_true_rels = evaluator.rank_true_rels.cpu()
-                evaluator.filt_rank_true_rels = evaluator.filt_rank_true_rels.cpu()
-
-
-            # Compute the confusion matrix for the relation prediction task
-            logger.info(kg_eval.rel2ix)
-            # Convert tensors to numpy arrays
-            all_scores_np = all_scores.cpu().numpy()
-            all_true_ranks_np = all_true_ranks.cpu().numpy()
-            cm = confusion_matrix(all_true_ranks_np, all_scores_np)
-
-            # logger.info the confusion matrix
-            logger.info(f'\n {cm}')
+            evaluator = BatchedRelationPredictionEvaluator(emb_model, kg_eval, directed=not eval_undirected)
+            evaluator.evaluate(b_size=b_size, verbose=True)
+            logger.info(f'Per relation:\n{evaluator.per_relation().to_string()}')
+            if report_path:
+                save_report(report_path, evaluator.report())
+                logger.info(f'{dt.now()} - Evaluation report saved to {report_path}')
         case _:
             raise ValueError(f'Unknown task {task}')
 
     # Log results to logfile
     logger.info(f'{dt.now()} - EMBEDDING MODEL EVALUATION RESULTS:')
     logger.info(f'Task : {task}')
+    intervals = {}
+    if isinstance(evaluator, SampledLinkPredictionEvaluator):
+        logger.info(f'Ranked against {eval_candidates} sampled{" typed" if eval_typed else ""} negatives, with 95% bootstrap confidence intervals')
+        intervals = evaluator.confidence_intervals()
+    ci = lambda name: f' [{intervals[name][0]}, {intervals[name][1]}]' if name in intervals else ''
     for k in [1, 3, 5, 10]:
-        logger.info(f'Hit@{k} : {evaluator.hit_at_k(k)[0]}')
-    logger.info(f'Mean Rank : {evaluator.mean_rank()[0]}')
-    logger.info(f'MRR : {evaluator.mrr()[0]}')
+        logger.info(f'Hit@{k} : {evaluator.hit_at_k(k)[0]}{ci(f"Hit@{k}")}')
+    logger.info(f'Mean Rank : {evaluator.mean_rank()[0]}{ci("Mean Rank")}')
+    logger.info(f'MRR : {evaluator.mrr()[0]}{ci("MRR")}')
 
     # Log results to wandb
     # for k in range(1, 11):
     #     wandb.log({f'Hit@{k}': evaluator.hit_at_k(k)[0]})
     # wandb.log({'Mean Rank': evaluator.mean_rank()[0]})
     # wandb.log({'MRR': evaluator.mrr()[0]})
+    return evaluator
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
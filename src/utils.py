@@ -9,132 +9,82 @@ import glob
 
 from torchkge.evaluation import *
 
+from src.ingest import SPARQL_ENDPOINT, ingest, write_triples, stream_query
+import src.cache
+from src.telemetry import TELEMETRY
+
 
 def timer_func(func):
-    # This function shows the execution time of the function object passed
+    # This function shows the execution time of the function object passed, and records it as a stage of the run (see src.telemetry)
     def wrap_func(*args, **kwargs):
         t1 = time()
         result = func(*args, **kwargs)
         t2 = time()
         print(f'Function {func.__name__!r} executed in {(t2-t1):.4f}s')
+        TELEMETRY.stage(func.__name__, t2 - t1)
         return result
     return wrap_func
 
 @timer_func
-def evaluate_emb_model(emb_model, kg_eval, task, device, logger):
-    """
-    Evaluate the trained embedding model on a knowledge graph.
-
-    Parameters
-    ----------
-    emb_model : torchkge.models.xxx
-        The embedding model to be evaluated.
-    kg_eval : torchkge.data_structures.KnowledgeGraph
-        The knowledge graph used for evaluation.
-
-    Returns
-    -------
-    None
+def load_celegans(keywords, sep, endpoint=SPARQL_ENDPOINT, page_size=None, n_workers=4, max_retries=5, cache_dir=src.cache.CACHE_DIR, cache_ttl=None, ntriples=False):
     """
-        
-    logger.info(f'{dt.now()} - Evaluating..')
-    b_size = 264 # Lower batch size if OOM error during evaluation
-
-    match task:
-        case 'link-prediction':
-            evaluator = LinkPredictionEvaluator(emb_model, kg_eval)
-            evaluator.evaluate(b_size=b_size, verbose=True)
-            
-        case 'relation-prediction':
-            evaluator = RelationPredictionEvaluator(emb_model, kg_eval)
-
-            use_cuda = next(evaluator.model.parameters()).is_cuda
-
-            if use_cuda:
-                dataloader = DataLoader(evaluator.kg, batch_size=b_size, use_cuda='batch')
-                evaluator.rank_true_rels = evaluator.rank_true_rels.cuda()
-                evaluator.filt_rank_true_rels = evaluator.filt_rank_true_rels.cuda()
-            else:
-                dataloader = DataLoader(evaluator.kg, batch_size=b_size)
-
-            all_scores, all_true_ranks = torch.tensor([]).to(device), torch.tensor([]).to(device)
-            for i, batch in tqdm(enumerate(dataloader), total=len(dataloader),
-                                    unit='batch', disable=(not True),
-                                    desc='Relation prediction evaluation'):
-                h_idx, t_idx, r_idx = batch[0], batch[1], batch[2]
-                h_emb, t_emb, r_emb, candidates = evaluator.model.inference_prepare_candidates(h_idx, t_idx, r_idx, entities=False)
-
-                scores = evaluator.model.inference_scoring_function(h_emb, t_emb, candidates)
-                filt_scores = filter_scores(scores, evaluator.kg.dict_of_rels, h_idx, t_idx, r_idx)
-
-                if not evaluator.directed:
-                    scores_bis = evaluator.model.inference_scoring_function(t_emb, h_emb, candidates)
-                    filt_scores_bis = filter_scores(scores_bis, evaluator.kg.dict_of_rels, h_idx, t_idx, r_idx)
-
-                    scores = cat((scores, scores_bis), dim=1)
-                    filt_scores = cat((filt_scores, filt_scores_bis), dim=1)
-
-                true_data = scores.gather(1, r_idx.long().view(-1, 1))
-                
-                ranks = (scores >= true_data).sum(dim=1).detach()
-                evaluator.rank_true_rels[i * b_size: (i + 1) * b_size] = ranks
-                evaluator.filt_rank_true_rels[i * b_size: (i + 1) * b_size] = (filt_scores >= true_data).sum(dim=1).detach()
-
-                ranks = (scores >= true_data).sum(dim=1).detach()
-                max_scores = torch.argmax(scores, dim=1)
-                all_scores = torch.cat((all_scores, max_scores), dim=0)
-                all_true_ranks = torch.cat((all_true_ranks, ranks), dim=0)
-
-            evaluator.evaluated = True
-
-            if use_cuda:
-                evaluator.rank_true_rels = evaluator.rank_true_rels.cpu()
-                evaluator.filt_rank_true_rels = evaluator.filt_rank_true_rels.cpu()
-
-
-            # Compute the confusion matrix for the relation prediction task
-            logger.info(kg_eval.rel2ix)
-            # Convert tensors to numpy arrays
-            all_scores_np = all_scores.cpu().numpy()
-            all_true_ranks_np = all_true_ranks.cpu().numpy()
-            cm = confusion_matrix(all_true_ranks_np, all_scores_np)
-
-            # logger.info the confusion matrix
-            logger.info(f'\n {cm}')
-        case _:
-            raise ValueError(f'Unknown task {task}')
-
-    # Log results to logfile
-    logger.info(f'{dt.now()} - EMBEDDING MODEL EVALUATION RESULTS:')
-    logger.info(f'Task : {task}')
-    for k in [1, 3, 5, 10]:
-        logger.info(f'Hit@{k} : {evaluator.hit_at_k(k)[0]}')
-    logger.info(f'Mean Rank : {evaluator.mean_rank()[0]}')
-    logger.info(f'MRR : {evaluator.mrr()[0]}')
-
-    # Log results to wandb
-    # for k in range(1, 11):
-    #     wandb.log({f'Hit@{k}': evaluator.hit_at_k(k)[0]})
-    # wandb.log({'Mean Rank': evaluator.mean_rank()[0]})
-    # wandb.log({'MRR': evaluator.mrr()[0]})
+    Query the celegans SPARQL endpoint with the queries matching `keywords` and store the triples in query_result.txt.
+    If `page_size` is set, queries are paginated and fetched concurrently by `n_workers` threads (see `src.ingest.ingest`).
 
-@timer_func
-def load_celegans(keywords, sep):
+    Results are cached per keyword in `cache_dir`, keyed by keyword, query text and endpoint. Only keywords without a valid
+    cache entry (new keyword, edited query or entry older than `cache_ttl` hours) are fetched, then all shards are merged.
+    Set `cache_dir` to None to bypass the cache.
+    If `ntriples` is set, results are requested as N-Triples and parsed while being received (see `src.ingest.stream_query`).
+    """
     print(f'{dt.now()} - Querying celegans SPARQL endpoint with the following queries : {keywords}.')
     queries = queries_from_features(keywords)
-    query_db(queries, sep)
+    if not cache_dir:
+        if page_size:
+            ingest(dict(zip(keywords, queries)), sep, endpoint=endpoint, page_size=page_size, n_workers=n_workers, max_retries=max_retries, ntriples=ntriples)
+        else:
+            query_db(queries, sep, endpoint=endpoint, ntriples=ntriples)
+        return 'query_result.txt'
+
+    shards = {keyword: src.cache.lookup(cache_dir, keyword, query, endpoint, ttl=cache_ttl) for keyword, query in zip(keywords, queries)}
+    missing = {keyword: query for keyword, query in zip(keywords, queries) if shards[keyword] is None}
+    print(f'{dt.now()} - Cached keywords: {[k for k in keywords if k not in missing]}. Fetching: {list(missing)}.')
+
+    if missing:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = {keyword: os.path.join(cache_dir, f'.{keyword}.part') for keyword in missing}
+        for path in tmp.values():
+            open(path, 'w').close() # Truncate leftovers from an interrupted run
+        if page_size:
+            ingest(missing, sep, output=tmp, endpoint=endpoint, page_size=page_size, n_workers=n_workers, max_retries=max_retries, ntriples=ntriples)
+        else:
+            for keyword, query in missing.items():
+                query_db([query], sep, endpoint=endpoint, output=tmp[keyword], ntriples=ntriples)
+        for keyword, query in missing.items():
+            shards[keyword] = src.cache.store(cache_dir, keyword, query, endpoint, tmp[keyword])
+
+    src.cache.merge([shards[keyword] for keyword in keywords], 'query_result.txt')
     return 'query_result.txt'
 
-def load_by_query(query):
+@timer_func
+def load_by_query(query, endpoint=SPARQL_ENDPOINT):
     query = add_prefixes(query)
-    query_db([query])
+    query_db([query], sep=' ', endpoint=endpoint)
+    return 'query_result.txt'
 
-def query_db(queries, sep):
-    """Queries the database with a SPARQL query that returns a graph (ie uses a CONSTRUCT clause)."""
+def query_db(queries, sep, endpoint=SPARQL_ENDPOINT, output='query_result.txt', ntriples=False):
+    """Queries the database with a SPARQL query that returns a graph (ie uses a CONSTRUCT clause).
+    With `ntriples`, the response is requested as N-Triples and streamed to `output` instead of being converted to an in-memory graph."""
     # Set up the SPARQL endpoint
-    sparql = SPARQLWrapper("http://cedre-14a.med.univ-rennes1.fr:3030/WS287-rdf/sparql") #TODO: make this endpoint default, but allow other endpoint in arguments
+    sparql = SPARQLWrapper(endpoint)
     warnings.filterwarnings("ignore")
     for query in tqdm(queries, desc="Querying SPARQL endpoint..."):
+        if ntriples:
+            t1 = time()
+            with open(output, 'a') as f:
+                n_triples = stream_query(query, f, sep, endpoint)
+            t2 = time()
+            print(f'{dt.now()} - {n_triples} triples in {(t2-t1):.2f}s ({n_triples / max(t2-t1, 1e-9):.0f} triples/s)')
+            continue
 
         # Set the query
         sparql.setQuery(query)
@@ -145,11 +95,8 @@ def query_db(queries, sep):
         results = results.convert()
         # Store the constructed subgraph
         try:
-            with open('query_result.txt', 'a') as f:
-                for s, p, o in results:
-                    if any(x.toPython() == '' for x in (s, p, o)): # Checks if the triple is complete
-                        continue
-                    f.write(f'{s}{sep}{p}{sep}{o}\n')       
+            with open(output, 'a') as f:
+                write_triples(results, f, sep)
         except:
             raise Exception("Check that the query output is a triple like ?s ?p ?o. Reminder: You must use a CONSTRUCT query")
     print(f'{dt.now()} - Query executed !')
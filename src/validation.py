@@ -0,0 +1,176 @@
+import copy
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+from torchkge.sampling import BernoulliNegativeSampler
+
+from src.pipeline import BatchPipeline
+from src.precision import autocast
+
+
+def val_loss(dataloader, emb_model, criterion, precision='fp32'):
+    """
+    Compute the validation loss of the embedding model.
+
+    Parameters
+    ----------
+    dataloader : src.pipeline.BatchPipeline / CachedBatches
+        Batches of validation triples and their negative samples.
+    emb_model : torchkge.models.xxx
+        The embedding model.
+    criterion : torchkge.utils.LossFunction
+        The loss function.
+    precision : str
+        One of fp32, bf16 (see src.precision.autocast).
+
+    Returns
+    -------
+    float
+        The validation loss, averaged over all batches of the validation set.
+    """
+    with torch.no_grad():
+        running_loss = 0.0
+        for i, (h, t, r, n_h, n_t) in enumerate(dataloader):
+            # forward
+            with autocast(precision, h.device):
+                pos, neg = emb_model(h, t, r, n_h, n_t)
+                loss = criterion(pos, neg)
+            running_loss += loss.item()
+    return running_loss / len(dataloader)
+
+
+class CachedBatches:
+    """
+    Fixed batches of a random subsample of `kg` and their negative samples, drawn once with `seed`
+    without consuming the global random state of the training. Iterating them again yields the same triples and negatives,
+    so that losses are comparable across epochs.
+
+    Parameters
+    ----------
+    kg : torchkge.data_structures.KnowledgeGraph
+        The validation knowledge graph.
+    size : int
+        Number of triples kept. All of them if larger than kg.n_facts.
+    batch_size : int
+        Number of positive triples per batch.
+    device : torch.device
+        Device the batches are kept on.
+    seed : int
+        Seed of the subsample and of the negatives.
+    """
+    def __init__(self, kg, size, batch_size, device, seed=0):
+        idx = torch.randperm(kg.n_facts, generator=torch.Generator().manual_seed(seed))[:size]
+        h, t, r = kg.head_idx[idx], kg.tail_idx[idx], kg.relations[idx]
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            n_h, n_t = BernoulliNegativeSampler(kg).corrupt_batch(h, t, r)
+        self.batches = [tuple(x.to(device) for x in batch) for batch in zip(*(x.split(batch_size) for x in (h, t, r, n_h, n_t)))]
+        self.wait_time = 0.0 # Nothing is produced while iterating
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def _validate(emb_model, batches, criterion, precision, snapshots, results):
+    """Background validation worker: loss of each (epoch, state_dict) snapshot received, until it receives None."""
+    torch.set_num_threads(1) # Leave the cores to the training
+    while (item := snapshots.get()) is not None:
+        epoch, state = item
+        emb_model.load_state_dict(state)
+        try:
+            results.put((epoch, val_loss(batches, emb_model, criterion, precision)))
+        except Exception as e:
+            results.put((epoch, e))
+
+
+class Validator:
+    """
+    Validation loss of the model during training, computed on all of `kg_val` with fresh negatives (the default),
+    or on a fixed subsample with cached negatives (config['val_size']). With config['val_background'], the loss
+    is computed on CPU by a background process from a snapshot of the weights, and the training loop only waits
+    when two snapshots are already pending.
+
+    Parameters
+    ----------
+    kg_val : torchkge.data_structures.KnowledgeGraph
+        The validation knowledge graph.
+    criterion : torchkge.utils.LossFunction
+        The loss function.
+    emb_model : torchkge.models.xxx
+        The model being trained. In background mode, the validation process works on a copy of it.
+    config : dict
+        CLI arguments.
+    device : torch.device
+        Device of the training.
+    """
+    def __init__(self, kg_val, criterion, emb_model, config, device):
+        self.criterion = criterion
+        self.precision = config.get('precision', 'fp32')
+        self.background = config.get('val_background', False)
+        batch_device = 'cpu' if self.background else device
+        if config.get('val_size'):
+            self.batches = CachedBatches(kg_val, config['val_size'], config['batch_size'], batch_device, seed=config.get('seed') or 0)
+        else:
+            self.batches = BatchPipeline(kg_val, BernoulliNegativeSampler(kg_val), config['batch_size'], batch_device, shuffle=False,
+                                         n_workers=0 if self.background else config.get('prefetch_workers', 1),
+                                         queue_depth=config.get('prefetch_depth', 4))
+
+        if self.background:
+            ctx = mp.get_context('fork')
+            model = copy.deepcopy(emb_model).cpu() # Never the model being trained, whose parameters may be in shared memory (see src.hogwild)
+            self.snapshots = ctx.Queue(maxsize=2)
+            self.results = ctx.Queue()
+            self.pending = 0
+            self.worker = ctx.Process(target=_validate, args=(model, self.batches, criterion, self.precision, self.snapshots, self.results), daemon=True)
+            self.worker.start()
+
+    @property
+    def wait_time(self):
+        return self.batches.wait_time
+
+    def __call__(self, emb_model, epoch=None):
+        """
+        Validation loss of `emb_model`. In background mode, submit a snapshot of its weights for `epoch` instead and return None,
+        the loss being returned by `collect` once computed.
+        """
+        if not self.background:
+            return val_loss(self.batches, emb_model, self.criterion, self.precision)
+        state = {k: v.detach().to('cpu', copy=True) for k, v in emb_model.state_dict().items()}
+        self.snapshots.put((epoch, state))
+        self.pending += 1
+        return None
+
+    def collect(self, wait=False):
+        """
+        (epoch, loss) of the background validations finished since the last call, all pending ones if `wait`.
+        Always empty when validation is not in the background.
+        """
+        done = []
+        while self.background and self.pending:
+            try:
+                epoch, loss = self.results.get(timeout=1) if wait else self.results.get_nowait()
+            except queue.Empty:
+                if not wait:
+                    break
+                if not self.worker.is_alive():
+                    raise RuntimeError('The validation process died.')
+                continue
+            if isinstance(loss, Exception):
+                raise loss
+            self.pending -= 1
+            done.append((epoch, loss))
+        return done
+
+    def close(self):
+        """Wait for the pending background validations and stop the validation process. Returns them like `collect`."""
+        if not self.background:
+            return []
+        done = self.collect(wait=True)
+        self.snapshots.put(None)
+        self.worker.join()
+        return done
@@ -0,0 +1,93 @@
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('SPARQLWrapper')
+
+from src.ingest import ingest
+
+QUERY = 'CONSTRUCT { ?s ?p ?o . } WHERE { ?s ?p ?o . }'
+
+
+class StandInEndpoint(ThreadingHTTPServer):
+    """
+    Local stand-in of a SPARQL endpoint answering paginated CONSTRUCT queries as N-Triples: the LIMIT/OFFSET page of `triples`.
+    The first request of each offset in `fail_once` gets a 500 error, so that retries are exercised.
+    """
+    def __init__(self, triples, fail_once=()):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.triples = triples
+        self.fail_once = set(fail_once)
+        self.queries = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/sparql'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        query = urllib.parse.parse_qs(body)['query'][0]
+        limit = int(re.search(r'LIMIT (\d+)', query).group(1))
+        offset = int(re.search(r'OFFSET (\d+)', query).group(1))
+        with self.server.lock:
+            self.server.queries.append(query)
+            fail = offset in self.server.fail_once
+            self.server.fail_once.discard(offset)
+        if fail:
+            self.send_error(500)
+            return
+        page = ''.join(f'{triple}\n' for triple in self.server.triples[offset:offset + limit])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/n-triples')
+        self.end_headers()
+        self.wfile.write(page.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    servers = []
+    def start(triples, fail_once=()):
+        server = StandInEndpoint(triples, fail_once)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def complete(i):
+    return f'<http://ex.org/s{i}> <http://ex.org/p> <http://ex.org/o{i}> .'
+
+def incomplete(i):
+    return f'<http://ex.org/s{i}> <http://ex.org/p> "" .'
+
+def test_pages_are_merged_in_order_with_retries(endpoint, tmp_path):
+    server = endpoint([complete(i) for i in range(23)], fail_once=[5, 15])
+    output = tmp_path / 'triples.txt'
+    stats = ingest({'toy': QUERY}, ' ', output=str(output), endpoint=server.url, page_size=5, n_workers=3, backoff=0.01, ntriples=True)
+    assert output.read_text().splitlines() == [f'http://ex.org/s{i} http://ex.org/p http://ex.org/o{i}' for i in range(23)]
+    assert stats['toy']['pages'] == 5 and stats['toy']['triples'] == 23
+    assert all('ORDER BY ?s ?p ?o' in query for query in server.queries) # Stable order between pages
+
+def test_page_of_incomplete_triples_does_not_end_the_query(endpoint, tmp_path):
+    server = endpoint([complete(0), complete(1)] + [incomplete(i) for i in range(2, 4)] + [complete(4), complete(5)])
+    output = tmp_path / 'triples.txt'
+    stats = ingest({'toy': QUERY}, ' ', output=str(output), endpoint=server.url, page_size=2, n_workers=1, backoff=0.01, ntriples=True)
+    assert [line.split()[0] for line in output.read_text().splitlines()] == [f'http://ex.org/s{i}' for i in (0, 1, 4, 5)]
+    assert stats['toy']['pages'] == 3 and stats['toy']['triples'] == 4
+
+def test_failing_page_raises_after_max_retries(endpoint, tmp_path):
+    server = endpoint([complete(i) for i in range(4)], fail_once=[0])
+    with pytest.raises(Exception):
+        ingest({'toy': QUERY}, ' ', output=str(tmp_path / 'triples.txt'), endpoint=server.url, page_size=2, n_workers=1, max_retries=1,
+               backoff=0.01, ntriples=True)
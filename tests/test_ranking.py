@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchkge')
+
+from torchkge.evaluation import LinkPredictionEvaluator
+
+from src.benchmarks import bench_model_config
+from src.dataset import load_dataset
+from src.ranking import ChunkedLinkPredictionEvaluator
+from src.train import build_model
+
+METHODS = ['TransE', 'TransH', 'TransR', 'TransD', 'TorusE', 'RESCAL', 'DistMult', 'HolE', 'ComplEx', 'ANALOGY', 'ConvKB']
+TOY_EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'data', 'raw', 'toy-example.txt')
+
+
+@pytest.fixture(scope='module')
+def kg():
+    return load_dataset(TOY_EXAMPLE)
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('memory_budget', [0.01, 1024]) # Many candidate blocks, and a single one
+def test_ranks_match_torchkge(kg, method, memory_budget):
+    torch.manual_seed(0)
+    emb_model = build_model(method, bench_model_config(20), kg.n_ent, kg.n_rel)
+    expected = LinkPredictionEvaluator(emb_model, kg)
+    expected.evaluate(b_size=32, verbose=False)
+    chunked = ChunkedLinkPredictionEvaluator(emb_model, kg, memory_budget=memory_budget)
+    chunked.evaluate(b_size=32, verbose=False)
+    for name in ['rank_true_heads', 'rank_true_tails', 'filt_rank_true_heads', 'filt_rank_true_tails']:
+        assert torch.equal(getattr(chunked, name), getattr(expected, name)), name